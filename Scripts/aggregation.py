@@ -0,0 +1,277 @@
+import numpy as np
+import pandas as pd
+import instrumentation
+import query_database
+import snapshot
+
+# Metrics of complete.csv and the names the query_database functions give to their sums
+METRICS = ["Confirmed", "Deaths", "Recovered", "Active"]
+TOTAL_COLUMNS = ["Total_Confirmed_Cases", "Total_Deaths", "Total_Recovered", "Total_Active_Cases"]
+
+
+class AggregationCube:
+    """Dense [location x day x metric] arrays of complete.csv with the roll-ups per level precomputed.
+
+    The levels are province (every row location of complete.csv), country, WHO region and global.
+    Every request for a location and a date window is answered by slicing these arrays.
+    """
+
+    def __init__(self, manifest, arrays, populations):
+        self.version = snapshot.manifest_version(manifest)
+
+        columns = manifest["columns"]
+        regions = columns["WHO.Region"]["categories"]
+        countries = columns["Country.Region"]["categories"]
+        provinces = columns["Province.State"]["categories"]
+
+        days = np.asarray(arrays["Date"])
+        self.first_day = int(days.min())
+        self.last_day = int(days.max())
+        self.dates = np.datetime_as_string(snapshot.day_to_date(np.arange(self.first_day, self.last_day + 1)), unit="D")
+
+        region_codes = np.asarray(arrays["WHO.Region"]).astype(np.int64)
+        country_codes = np.asarray(arrays["Country.Region"]).astype(np.int64)
+        province_codes = np.asarray(arrays["Province.State"]).astype(np.int64)
+
+        # Province level: one location per distinct (WHO.Region, Country.Region, Province.State)
+        leaf_keys = np.stack([region_codes, country_codes, province_codes], axis=1)
+        leaf_keys, leaf_of_row = np.unique(leaf_keys, axis=0, return_inverse=True)
+        leaf_of_row = leaf_of_row.ravel()
+
+        # Country level: one location per distinct (WHO.Region, Country.Region)
+        country_keys, country_of_leaf = np.unique(leaf_keys[:, :2], axis=0, return_inverse=True)
+        country_of_leaf = country_of_leaf.ravel()
+
+        # WHO region level
+        region_keys, region_of_country = np.unique(country_keys[:, 0], return_inverse=True)
+        region_of_country = region_of_country.ravel()
+
+        day_of_row = days.astype(np.int64) - self.first_day
+        day_count = self.last_day - self.first_day + 1
+
+        values = np.stack([np.asarray(arrays[metric]) for metric in METRICS], axis=1).astype(np.int64)
+
+        self.province = np.zeros((len(leaf_keys), day_count, len(METRICS)), dtype=np.int64)
+        np.add.at(self.province, (leaf_of_row, day_of_row), values)
+
+        # Number of rows behind every cell, days without any row are left out just like GROUP BY date does
+        self.province_rows = np.zeros((len(leaf_keys), day_count), dtype=np.int32)
+        np.add.at(self.province_rows, (leaf_of_row, day_of_row), 1)
+
+        self.country = np.zeros((len(country_keys), day_count, len(METRICS)), dtype=np.int64)
+        np.add.at(self.country, country_of_leaf, self.province)
+        self.country_rows = np.zeros((len(country_keys), day_count), dtype=np.int32)
+        np.add.at(self.country_rows, country_of_leaf, self.province_rows)
+
+        self.region = np.zeros((len(region_keys), day_count, len(METRICS)), dtype=np.int64)
+        np.add.at(self.region, region_of_country, self.country)
+        self.region_rows = np.zeros((len(region_keys), day_count), dtype=np.int32)
+        np.add.at(self.region_rows, region_of_country, self.country_rows)
+
+        self.world = self.region.sum(axis=0)
+        self.world_rows = self.region_rows.sum(axis=0)
+
+        # Parent of every location, needed to roll up the rows of a delta
+        self.country_of_leaf = country_of_leaf
+        self.region_of_country = region_of_country
+
+        self.leaf_index = {
+            (regions[region], countries[country], provinces[province] if province >= 0 else None): position
+            for position, (region, country, province) in enumerate(leaf_keys)
+        }
+        self.province_index = {key: position for key, position in self.leaf_index.items() if key[2] is not None}
+        self.country_index = {
+            (regions[region], countries[country]): position for position, (region, country) in enumerate(country_keys)
+        }
+        self.region_index = {regions[region]: position for position, region in enumerate(region_keys)}
+
+        # Populations: per country, summed over the countries of a WHO region and over the world. A country without
+        # a known population is NaN, like Country_Population returns None, and is left out of the sums
+        self.country_population = np.array([populations.get(countries[country]) for _, country in country_keys], dtype=np.float64)
+        self.region_population = np.zeros(len(region_keys), dtype=np.int64)
+        np.add.at(self.region_population, region_of_country, np.nan_to_num(self.country_population).astype(np.int64))
+
+        # A country listed under two WHO regions is only counted once for the world
+        world_countries = {countries[country] for _, country in country_keys}
+        self.world_population = int(sum(populations.get(country) or 0 for country in world_countries))
+
+    def extend_days(self, first_day, last_day):
+        """Grow the day axis of all arrays so it covers first_day to last_day."""
+        before = max(self.first_day - first_day, 0)
+        after = max(last_day - self.last_day, 0)
+        if not before and not after:
+            return
+
+        for name in ("province", "province_rows", "country", "country_rows", "region", "region_rows"):
+            array = getattr(self, name)
+            padding = [(0, 0)] * array.ndim
+            padding[1] = (before, after)
+            setattr(self, name, np.pad(array, padding))
+
+        self.world = np.pad(self.world, [(before, after), (0, 0)])
+        self.world_rows = np.pad(self.world_rows, (before, after))
+
+        self.first_day -= before
+        self.last_day += after
+        self.dates = np.datetime_as_string(snapshot.day_to_date(np.arange(self.first_day, self.last_day + 1)), unit="D")
+
+    def add_location(self, region, country, province):
+        """Append a province level location that is not in the cube yet, together with its country and region."""
+        if region not in self.region_index:
+            self.region_index[region] = len(self.region)
+            self.region = np.concatenate([self.region, np.zeros((1,) + self.region.shape[1:], dtype=np.int64)])
+            self.region_rows = np.concatenate([self.region_rows, np.zeros((1,) + self.region_rows.shape[1:], dtype=np.int32)])
+            self.region_population = np.append(self.region_population, 0)
+
+        if (region, country) not in self.country_index:
+            population = load_populations([country])[country]
+            self.country_index[(region, country)] = len(self.country)
+            self.country = np.concatenate([self.country, np.zeros((1,) + self.country.shape[1:], dtype=np.int64)])
+            self.country_rows = np.concatenate([self.country_rows, np.zeros((1,) + self.country_rows.shape[1:], dtype=np.int32)])
+            self.country_population = np.append(self.country_population, np.nan if population is None else population)
+            self.region_of_country = np.append(self.region_of_country, self.region_index[region])
+            self.region_population[self.region_index[region]] += population or 0
+
+            # A country listed under two WHO regions is only counted once for the world
+            if not any(key[1] == country for key in list(self.country_index)[:-1]):
+                self.world_population += population or 0
+
+        position = len(self.province)
+        self.leaf_index[(region, country, province)] = position
+        if province is not None:
+            self.province_index[(region, country, province)] = position
+        self.province = np.concatenate([self.province, np.zeros((1,) + self.province.shape[1:], dtype=np.int64)])
+        self.province_rows = np.concatenate([self.province_rows, np.zeros((1,) + self.province_rows.shape[1:], dtype=np.int32)])
+        self.country_of_leaf = np.append(self.country_of_leaf, self.country_index[(region, country)])
+
+        return position
+
+    def apply_rows(self, df, version):
+        """Write the rows of a delta into the cube, the rows replace the cells with the same location and day.
+
+        Only the touched cells and their country, region and world totals change, the cost depends on the size of
+        the delta. df has the columns of complete.csv, every location and day occurs once.
+        """
+        days = snapshot.date_to_day(df["Date"]).astype(np.int64)
+        if len(days):
+            self.extend_days(int(days.min()), int(days.max()))
+
+        provinces = [None if pd.isna(province) or province == "" else province for province in df["Province.State"]]
+        leaves = []
+        for key in zip(df["WHO.Region"], df["Country.Region"], provinces):
+            position = self.leaf_index.get(key)
+            leaves.append(self.add_location(*key) if position is None else position)
+        leaves = np.asarray(leaves, dtype=np.int64)
+
+        day = days - self.first_day
+        values = df[METRICS].to_numpy(dtype=np.int64)
+
+        difference = values - self.province[leaves, day]
+        new_cells = (self.province_rows[leaves, day] == 0).astype(np.int32)
+        self.province[leaves, day] = values
+        self.province_rows[leaves, day] = 1
+
+        countries = self.country_of_leaf[leaves]
+        regions = self.region_of_country[countries]
+        np.add.at(self.country, (countries, day), difference)
+        np.add.at(self.country_rows, (countries, day), new_cells)
+        np.add.at(self.region, (regions, day), difference)
+        np.add.at(self.region_rows, (regions, day), new_cells)
+        np.add.at(self.world, day, difference)
+        np.add.at(self.world_rows, day, new_cells)
+
+        self.version = version
+
+    def date_range(self):
+        return self.dates[0], self.dates[-1]
+
+    def day_window(self, startdate=None, enddate=None):
+        """Translate 'YYYY-MM-DD' bounds into a slice of the day axis, clipped to the available data."""
+        start = 0 if not startdate else int(np.searchsorted(self.dates, startdate, side="left"))
+        end = len(self.dates) if not enddate else int(np.searchsorted(self.dates, enddate, side="right"))
+        return slice(start, max(start, end))
+
+    def select(self, continent=None, country=None, province=None):
+        """Return the (values, rows, population) arrays of the requested location or None if it does not exist."""
+        if not continent:
+            return self.world, self.world_rows, self.world_population
+
+        if not country:
+            position = self.region_index.get(continent)
+            if position is None:
+                return None
+            return self.region[position], self.region_rows[position], int(self.region_population[position])
+
+        if not province:
+            position = self.country_index.get((continent, country))
+            if position is None:
+                return None
+            population = self.country_population[position]
+            return self.country[position], self.country_rows[position], None if np.isnan(population) else int(population)
+
+        position = self.province_index.get((continent, country, province))
+        if position is None:
+            return None
+        return self.province[position], self.province_rows[position], None
+
+    def has_location(self, continent=None, country=None, province=None):
+        return self.select(continent, country, province) is not None
+
+    def series(self, continent=None, country=None, province=None, startdate=None, enddate=None):
+        """Same frame as the Total_Cases_Per_Day_* functions in query_database, without touching the database."""
+        selection = self.select(continent, country, province)
+        window = self.day_window(startdate, enddate)
+
+        if selection is None:
+            values = np.zeros((0, len(METRICS)), dtype=np.int64)
+            dates = self.dates[:0]
+            population = None
+        else:
+            values, rows, population = selection
+            present = rows[window] > 0
+            values = values[window][present]
+            dates = self.dates[window][present]
+
+        df = pd.DataFrame(values, columns=TOTAL_COLUMNS)
+        df.insert(0, "Date", dates)
+
+        # Province level data has no population, the same as Total_Cases_Per_Day_Province. An unknown population is
+        # NaN, so cases per million and the reproduction number are NaN instead of a number
+        if not (continent and country and province):
+            df["Population"] = np.nan if population is None else population
+
+        return df
+
+
+def load_populations(countries):
+    """Population for every country, resolved once while the cube is built."""
+    with query_database.connection() as connection:
+        resolver = query_database.get_population_resolver(connection.cursor())
+
+    return {country: resolver.population(country) for country in countries}
+
+
+_cube = None
+
+
+@instrumentation.timed()
+def get_cube():
+    """Return the cube for the current complete.csv snapshot, it is only rebuilt when the snapshot changes."""
+    global _cube
+
+    manifest = snapshot.ensure_snapshot("complete")
+    if _cube is None or _cube.version != snapshot.manifest_version(manifest):
+        manifest, arrays = snapshot.open_snapshot("complete")
+        populations = load_populations(manifest["columns"]["Country.Region"]["categories"])
+        _cube = AggregationCube(manifest, arrays, populations)
+
+    return _cube
+
+
+def apply_delta(df, previous_version, version):
+    """Update the cube of this process with the rows of an appended delta instead of building it again.
+
+    Nothing happens when the cube was not built yet or is not at previous_version, get_cube rebuilds it then.
+    """
+    if _cube is not None and _cube.version == previous_version:
+        _cube.apply_rows(df, version)
@@ -0,0 +1,601 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_DIRECTORY = "Data/benchmark"
+SOURCE_DIRECTORY = "Data"
+SEED = 0
+
+# Scale factor of the row count -> (copies of every location, repetitions of the history). Both the number of
+# locations and the number of days grow, so per location and per day costs both show up in the results.
+SCALES = {
+    1: (1, 1),
+    10: (5, 2),
+    100: (25, 4),
+    1000: (125, 8),
+}
+
+COUNT_COLUMNS = ["Confirmed", "Deaths", "Recovered", "Active"]
+DAY_WISE_COUNT_COLUMNS = ["Confirmed", "Deaths", "Recovered", "Active", "New cases", "New deaths", "New recovered"]
+
+# Continent of the worldometer rows, only used by the continent comparison on the General Results tab
+CONTINENTS = {
+    "Africa": "Africa",
+    "Americas": "North America",
+    "Eastern Mediterranean": "Asia",
+    "Europe": "Europe",
+    "South-East Asia": "Asia",
+    "Western Pacific": "Australia/Oceania",
+}
+
+US_COUNTIES = 3000
+US_STATES = 50
+
+# Differences below these are noise and never reported as a regression
+MIN_SECONDS = 0.005
+MIN_BYTES = 1024 * 1024
+
+
+# Synthetic data
+
+def location_name(name, copy):
+    return name if copy == 0 else f"{name} {copy + 1}"
+
+
+def scaled_history(df, copy, period, days, last, factor):
+    """One copy of complete.csv, moved period * days days into the future.
+
+    The cumulative counts continue from where the previous period ended and are multiplied by the factor of the
+    copy, so every location still has a plausible growing curve.
+    """
+    df = df.copy()
+    df["Country.Region"] = df["Country.Region"].map(lambda name: location_name(name, copy))
+    df["Date"] = (df["Date"] + pd.Timedelta(days=period * days)).dt.strftime("%Y-%m-%d")
+
+    counts = df[COUNT_COLUMNS] if period == 0 else df[COUNT_COLUMNS].fillna(0) + period * last
+    df[COUNT_COLUMNS] = (counts * factor).round()
+
+    return df
+
+
+def country_wise_rows(df):
+    """country_wise as it looks after the last day: the totals per country and the change since the day before."""
+    dates = sorted(df["Date"].unique())
+    totals = df.groupby(["Date", "Country.Region", "WHO.Region"], as_index=False)[COUNT_COLUMNS].sum()
+    last = totals[totals["Date"] == dates[-1]].set_index("Country.Region")
+    previous = totals[totals["Date"] == dates[-2]].set_index("Country.Region").reindex(last.index).fillna(0)
+
+    country_wise = last[COUNT_COLUMNS + ["WHO.Region"]].copy()
+    for column, name in (("Confirmed", "New.cases"), ("Deaths", "New.deaths"), ("Recovered", "New.recovered")):
+        country_wise[name] = (last[column] - previous[column]).clip(lower=0)
+
+    return country_wise.reset_index()
+
+
+def worldometer_rows(country_wise, rng):
+    """worldometer_data with a random population for every country, named the way worldometer names them."""
+    import query_database
+
+    names = dict(query_database.COUNTRY_MAPPING)
+    population = rng.integers(500000, 200000000, len(country_wise)).astype(np.float64)
+
+    return pd.DataFrame({
+        "Country.Region": [names.get(country, country) for country in country_wise["Country.Region"]],
+        "Continent": country_wise["WHO.Region"].map(CONTINENTS).to_numpy(),
+        "Population": np.maximum(population, country_wise["Confirmed"].to_numpy() * 10),
+        "TotalCases": country_wise["Confirmed"].to_numpy(),
+        "TotalDeaths": country_wise["Deaths"].to_numpy(),
+        "TotalRecovered": country_wise["Recovered"].to_numpy(),
+        "ActiveCases": country_wise["Active"].to_numpy(),
+    })
+
+
+def county_rows(copies, periods, last_date, rng):
+    """usa_county_wise with US_COUNTIES counties per copy and one report per period."""
+    counties = US_COUNTIES * copies
+    county = np.tile(np.arange(counties), periods)
+    confirmed = rng.integers(0, 100000, len(county))
+
+    return pd.DataFrame({
+        "Admin2": [f"County {number}" for number in county],
+        "Province_State": [f"State {number % (US_STATES * copies)}" for number in county],
+        "Date": np.repeat([str(last_date - np.timedelta64(period, "D")) for period in range(periods)], counties),
+        "Confirmed": confirmed,
+        "Deaths": confirmed // rng.integers(20, 100, len(county)),
+        "Lat": 0.0,
+        "Long_": 0.0,
+    })
+
+
+def day_wise_rows(df, copies, periods):
+    """day_wise.csv repeated like complete.csv, the counts are multiplied by the number of copies."""
+    days = len(df)
+    last = df[["Confirmed", "Deaths", "Recovered", "Active"]].iloc[-1]
+
+    parts = []
+    for period in range(periods):
+        part = df.copy()
+        part["Date"] = (part["Date"] + pd.Timedelta(days=period * days)).dt.strftime("%Y-%m-%d")
+        part[["Confirmed", "Deaths", "Recovered", "Active"]] += period * last
+        part[DAY_WISE_COUNT_COLUMNS] *= copies
+        part["No. of countries"] *= copies
+        parts.append(part)
+
+    return pd.concat(parts, ignore_index=True)
+
+
+def generate(scale, directory, source_directory=SOURCE_DIRECTORY, seed=SEED):
+    """Write complete.csv, day_wise.csv and a database with the other tables, scale times the size of complete.csv.
+
+    The files are streamed to disk one copy at a time, so the memory used does not depend on the scale.
+    """
+    copies, periods = SCALES[scale]
+    rng = np.random.default_rng(seed)
+
+    data_directory = os.path.join(directory, "Data")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(data_directory)
+
+    df = pd.read_csv(os.path.join(source_directory, "complete.csv"), parse_dates=["Date"])
+    days = (df["Date"].max() - df["Date"].min()).days + 1
+    locations = ["WHO.Region", "Country.Region", "Province.State"]
+
+    # Cumulative counts of every location on the last day, later periods start from there
+    last_day = df[df["Date"] == df["Date"].max()].groupby(locations, dropna=False, as_index=False)[COUNT_COLUMNS].last()
+    last = df[locations].merge(last_day, on=locations, how="left")[COUNT_COLUMNS].fillna(0).to_numpy()
+
+    complete_path = os.path.join(data_directory, "complete.csv")
+    country_wise = []
+    rows = 0
+    for period in range(periods):
+        for copy in range(copies):
+            factor = 1.0 if copy == 0 else rng.uniform(0.5, 1.5)
+            part = scaled_history(df, copy, period, days, last, factor)
+            part.to_csv(complete_path, mode="a", header=rows == 0, index=False, na_rep="NA")
+            rows += len(part)
+
+            if period == periods - 1:
+                country_wise.append(country_wise_rows(part))
+
+    country_wise = pd.concat(country_wise, ignore_index=True)
+    last_date = np.datetime64(df["Date"].max().date()) + (periods - 1) * days
+
+    day_wise = pd.read_csv(os.path.join(source_directory, "day_wise.csv"), parse_dates=["Date"])
+    day_wise_rows(day_wise, copies, periods).to_csv(os.path.join(data_directory, "day_wise.csv"), index=False)
+
+    connection = sqlite3.connect(os.path.join(data_directory, "covid_database.db"))
+    country_wise.to_sql("country_wise", connection, index=False)
+    worldometer_rows(country_wise, rng).to_sql("worldometer_data", connection, index=False)
+    county_rows(copies, periods, last_date, rng).to_sql("usa_county_wise", connection, index=False, chunksize=100000)
+    connection.commit()
+    connection.close()
+
+    manifest = {"scale": scale, "copies": copies, "periods": periods, "seed": seed, "rows": rows, "source_sha256": source_sha256(source_directory)}
+    with open(os.path.join(directory, "manifest.json"), "w") as file:
+        json.dump(manifest, file)
+
+    return manifest
+
+
+def source_sha256(source_directory=SOURCE_DIRECTORY):
+    import snapshot
+
+    return snapshot.file_hash(os.path.join(source_directory, "complete.csv"))
+
+
+def ensure_generated(scale, directory, seed=SEED):
+    """Generate the data of a scale, unless the directory already has it for the same complete.csv and seed."""
+    try:
+        with open(os.path.join(directory, "manifest.json")) as file:
+            manifest = json.load(file)
+        if (manifest["scale"], manifest["seed"], manifest["source_sha256"]) == (scale, seed, source_sha256()):
+            return manifest
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    return generate(scale, directory, seed=seed)
+
+
+# Benchmark cases, they run inside the generated directory (see run_worker)
+
+def sample_location(connection):
+    """The country with the most provinces and its first province, the heaviest country and province queries."""
+    cursor = connection.cursor()
+    cursor.execute("""
+    SELECT [WHO.Region], [Country.Region], MIN([Province.State]), COUNT(DISTINCT [Province.State]) AS provinces
+    FROM location WHERE [Province.State] != ''
+    GROUP BY [WHO.Region], [Country.Region]
+    ORDER BY provinces DESC, [Country.Region]
+    LIMIT 1;
+    """)
+    return cursor.fetchone()[:3]
+
+
+def drop_complete_data():
+    import ingest
+    import query_database
+
+    connection = sqlite3.connect(query_database.DATABASE_PATH)
+    connection.execute("DROP VIEW IF EXISTS complete_data;")
+    connection.execute("DROP TABLE IF EXISTS complete_facts;")
+    connection.execute("DROP TABLE IF EXISTS location;")
+    connection.execute("DELETE FROM metadata WHERE key LIKE 'complete_%';")
+    connection.commit()
+    connection.close()
+    query_database.clear_population_resolvers()
+
+
+def clear_caches():
+    """Forget everything the modules keep in memory, like a fresh start of the dashboard."""
+    import aggregation
+    import map_payloads
+    import partFour
+    import query_database
+    import reproduction
+
+    aggregation._cube = None
+    map_payloads._payloads = None
+    partFour._df_final = None
+    partFour._top_us_counties = None
+    reproduction._stores.clear()
+    query_database.clear_population_resolvers()
+
+
+def load_data():
+    """The same steps as load_data in dashboard.py, which can not be imported without running the app."""
+    import datasets
+    import map_payloads
+    import snapshot
+
+    df_day = snapshot.load_day_wise()
+    df_day["Date"] = df_day["Date"].dt.strftime("%Y-%m-%d")
+
+    map_payloads.ensure_payloads()
+
+    return df_day, datasets.load("continent_totals"), datasets.load("locations")
+
+
+def remove_snapshots():
+    import snapshot
+
+    for name in snapshot.SOURCES:
+        shutil.rmtree(os.path.join(snapshot.SNAPSHOT_DIRECTORY, name), ignore_errors=True)
+
+
+def build_snapshots():
+    import snapshot
+
+    return [snapshot.build_snapshot(name) for name in snapshot.SOURCES]
+
+
+def simulation_inputs():
+    """Initial values and parameters of every country, the ensemble the SIRD benchmarks simulate."""
+    import partThree
+
+    parameters = partThree.estimate_parameters().dropna()
+    susceptible = parameters["population"] - parameters["active"] - parameters["recovered"] - parameters["deaths"]
+
+    return (
+        susceptible, parameters["active"], parameters["recovered"], parameters["deaths"],
+        parameters["alpha_hat"], parameters["beta_hat"], parameters["gamma_hat"], parameters["mu_hat"], parameters["population"],
+    )
+
+
+def may_select(stem, only):
+    """Whether a case whose name starts with stem can be selected by the name prefixes in only."""
+    return not only or any(prefix.startswith(stem) or stem.startswith(prefix) for prefix in only)
+
+
+def benchmark_cases(only=None):
+    """List of (name, run, reset). reset is called before every run and is not timed.
+
+    The setup shared by several cases is skipped when none of them can be selected by only.
+    """
+    import aggregation
+    import createDataFrame
+    import fitting
+    import ingest
+    import map_payloads
+    import partFour
+    import query_database
+    import reproduction
+    import simulation
+    import partThree
+
+    cases = [
+        ("snapshot", build_snapshots, remove_snapshots),
+        ("ingest_complete", ingest.ingest_complete, drop_complete_data),
+        ("update_county_rollups", lambda: ingest.update_county_rollups(force=True), None),
+        ("load_data", load_data, clear_caches),
+        ("aggregation_cube", aggregation.get_cube, lambda: setattr(aggregation, "_cube", None)),
+    ]
+
+    connection = query_database.get_connection()
+    startdate, enddate = query_database.date_ranges(connection.cursor())
+    continent, country, province = sample_location(connection)
+
+    cases += [
+        ("Total_Cases_Per_Day_Global", lambda: query_database.Total_Cases_Per_Day_Global(connection, startdate, enddate), None),
+        ("Total_Cases_Per_Day_Continental", lambda: query_database.Total_Cases_Per_Day_Continental(connection, continent, startdate, enddate), None),
+        ("Total_Cases_Per_Day_Country", lambda: query_database.Total_Cases_Per_Day_Country(connection, continent, country, startdate, enddate), None),
+        ("Total_Cases_Per_Day_Province", lambda: query_database.Total_Cases_Per_Day_Province(connection, continent, country, province, startdate, enddate), None),
+        ("createDataFrameOverTime_global", lambda: createDataFrame.createDataFrameOverTime(), None),
+        ("createDataFrameOverTime_continent", lambda: createDataFrame.createDataFrameOverTime(continent), None),
+        ("createDataFrameOverTime_country", lambda: createDataFrame.createDataFrameOverTime(continent, country), None),
+        ("createDataFrameOverTime_province", lambda: createDataFrame.createDataFrameOverTime(continent, country, province), None),
+        ("reproduction_store", lambda: reproduction.cube_store(aggregation.get_cube()), None),
+        ("estimate_parameters", partThree.estimate_parameters, None),
+    ]
+
+    if may_select("simulate_sird", only):
+        inputs = simulation_inputs()
+
+        def simulate(compiled):
+            # The estimates of some synthetic countries make the simulation overflow, that is not what is measured here
+            with np.errstate(all="ignore"):
+                return simulation.simulate_sird(*inputs, days=365, compiled=compiled)
+
+        cases.append(("simulate_sird", lambda: simulate(False), None))
+        if simulation.step_compiled is not None:
+            cases.append(("simulate_sird_compiled", lambda: simulate(True), None))
+
+    # Building the cube for the region names is only worth it when a case that loops over the regions can run
+    regions = []
+    if may_select("fit_sir_regions", only) or may_select("partFour_map_frames", only):
+        regions = sorted(aggregation.get_cube().region_index)
+
+    cases += [
+        ("fit_sir_regions", lambda: [fitting.fit_location(createDataFrame.createDataFrameOverTime(region)) for region in regions], None),
+        ("map_payloads", map_payloads.build_payloads, None),
+        ("partFour_final", partFour.get_final, lambda: setattr(partFour, "_df_final", None)),
+        ("partFour_top_us_counties", partFour.get_top_us_counties, lambda: setattr(partFour, "_top_us_counties", None)),
+        ("partFour_map_frames", lambda: [partFour.country_map_frame(region) for region in regions], None),
+    ]
+
+    return cases + dashboard_cases(only)
+
+
+def dashboard_cases(only=None):
+    """A full run of the dashboard script and one rerun per tab, with the widgets at their defaults."""
+    if not may_select("dashboard", only):
+        return []
+
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        return []
+
+    import streamlit as st
+
+    app = {}
+
+    def reset():
+        st.cache_data.clear()
+        clear_caches()
+
+    def first_run():
+        app["test"] = AppTest.from_file(os.path.join(SCRIPTS_DIRECTORY, "dashboard.py"), default_timeout=3600)
+        return app["test"].run()
+
+    def tab_run(tab):
+        return lambda: app["test"].radio(key="active_tab").set_value(tab).run()
+
+    cases = [("dashboard_first_run", first_run, reset)]
+    if not may_select("dashboard_tab:", only):
+        return cases
+
+    # The tab names are read from a first run, it also leaves the caches of the app warm for the tab reruns
+    first_run()
+    for tab in app["test"].radio(key="active_tab").options:
+        cases.append((f"dashboard_tab:{tab}", tab_run(tab), None))
+
+    return cases
+
+
+def result_rows(result):
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
+def measure(run, reset=None, repeat=3, trace_memory=True):
+    """Run a case repeat times and return the timings, plus the peak of traced allocations of one more run.
+
+    Time and memory are measured in separate runs, tracing the allocations slows Python code down.
+    """
+    seconds = []
+    for _ in range(repeat):
+        if reset:
+            reset()
+        gc.collect()
+        start = time.perf_counter()
+        result = run()
+        seconds.append(time.perf_counter() - start)
+
+    measurement = {
+        "seconds": statistics.median(seconds),
+        "min_seconds": min(seconds),
+        "runs": seconds,
+        "rows": result_rows(result),
+    }
+    del result
+
+    if trace_memory:
+        if reset:
+            reset()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            measurement["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return measurement
+
+
+def max_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    factor = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * factor
+
+
+def run_worker(output_path, repeat, trace_memory, only=None):
+    """Run every case in the current directory, which has to be a generated one, and write the results as json."""
+    import ingest
+
+    # The database has to be filled before the cases can be set up, they look up a location and date range in it
+    ingest.ingest_complete()
+    ingest.update_county_rollups()
+
+    cases = {}
+    for name, run, reset in benchmark_cases(only):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        print(f"  {name}", file=sys.stderr, flush=True)
+        cases[name] = measure(run, reset, repeat, trace_memory)
+
+    with open(output_path, "w") as file:
+        json.dump({"cases": cases, "max_rss_bytes": max_rss_bytes()}, file)
+
+
+# Comparing results
+
+def compare(results, baseline, tolerance):
+    """Every case that is in both results, with the ratio of its median time and peak memory to the baseline."""
+    rows = []
+    for scale, measured in results["scales"].items():
+        previous = baseline.get("scales", {}).get(scale)
+        if previous is None:
+            continue
+
+        for name, case in measured["cases"].items():
+            before = previous["cases"].get(name)
+            if before is None:
+                continue
+
+            row = {"scale": scale, "case": name, "seconds": case["seconds"], "baseline_seconds": before["seconds"]}
+            row["time_ratio"] = case["seconds"] / before["seconds"] if before["seconds"] else None
+            slower = case["seconds"] > before["seconds"] * (1 + tolerance) and case["seconds"] - before["seconds"] > MIN_SECONDS
+
+            bigger = False
+            if "peak_bytes" in case and "peak_bytes" in before:
+                row["peak_bytes"] = case["peak_bytes"]
+                row["baseline_peak_bytes"] = before["peak_bytes"]
+                row["memory_ratio"] = case["peak_bytes"] / before["peak_bytes"] if before["peak_bytes"] else None
+                bigger = case["peak_bytes"] > before["peak_bytes"] * (1 + tolerance) and case["peak_bytes"] - before["peak_bytes"] > MIN_BYTES
+
+            row["regression"] = slower or bigger
+            rows.append(row)
+
+    return rows
+
+
+def print_results(results):
+    for scale, measured in results["scales"].items():
+        print(f"\nscale {scale}x: {measured['rows']} rows")
+        for name, case in measured["cases"].items():
+            peak = f"{case['peak_bytes'] / 1024 ** 2:9.1f} MiB" if "peak_bytes" in case else ""
+            print(f"  {name:45s} {case['seconds']:10.4f} s {peak}")
+
+
+def print_comparison(rows):
+    print("\ncompared to the baseline:")
+    for row in rows:
+        time_ratio = f"{row['time_ratio']:6.2f}x time" if row["time_ratio"] is not None else ""
+        memory_ratio = f"{row['memory_ratio']:6.2f}x memory" if row.get("memory_ratio") is not None else ""
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(f"  {row['scale']:>5}x {row['case']:45s} {time_ratio} {memory_ratio}{flag}")
+
+
+def run_scale(scale, directory, repeat, trace_memory, only=None):
+    """Generate the data of a scale if needed and run the cases in a separate process inside its directory.
+
+    Every scale gets a fresh process, so nothing cached by an earlier scale is reused and the maximum resident
+    memory belongs to this scale only.
+    """
+    manifest = ensure_generated(scale, directory)
+
+    output_path = os.path.join(os.path.abspath(directory), "results.json")
+    command = [sys.executable, os.path.abspath(__file__), "--worker", output_path, "--repeat", str(repeat)]
+    if not trace_memory:
+        command.append("--no-memory")
+    if only:
+        command += ["--cases"] + list(only)
+    subprocess.run(command, cwd=directory, check=True)
+
+    with open(output_path) as file:
+        measured = json.load(file)
+
+    return dict(measured, rows=manifest["rows"], copies=manifest["copies"], periods=manifest["periods"])
+
+
+def run_benchmarks(scales, directory=BENCHMARK_DIRECTORY, repeat=3, trace_memory=True, only=None):
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "repeat": repeat,
+        "scales": {},
+    }
+
+    for scale in scales:
+        print(f"scale {scale}x", file=sys.stderr, flush=True)
+        results["scales"][str(scale)] = run_scale(scale, os.path.join(directory, f"x{scale}"), repeat, trace_memory, only)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the data pipeline and the dashboard on synthetic data that is larger than complete.csv.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10], choices=sorted(SCALES), help="Row count of complete.csv is multiplied by these")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of every case, the median is reported")
+    parser.add_argument("--cases", nargs="+", metavar="PREFIX", help="Only run the cases whose name starts with one of these")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the extra run that traces the peak memory of every case")
+    parser.add_argument("--directory", default=BENCHMARK_DIRECTORY, help="Where the generated data is kept between runs")
+    parser.add_argument("--output", help="Write the results to this json file")
+    parser.add_argument("--baseline", help="Compare against the results in this json file, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative increase in time or memory before it counts as a regression")
+    parser.add_argument("--worker", metavar="OUTPUT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.repeat, not args.no_memory, args.cases)
+        sys.exit(0)
+
+    results = run_benchmarks(args.scales, args.directory, args.repeat, not args.no_memory, args.cases)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            rows = compare(results, json.load(file), args.tolerance)
+        print_comparison(rows)
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
@@ -1,23 +1,25 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import query_database
-import sqlite3
-from datetime import datetime
+import numpy as np
+import aggregation
+import instrumentation
+import partitions
+import reproduction
 
+@instrumentation.timed()
 def createDataFrameOverTime(continent=None, country=None, province=None, startdate=None, enddate=None):
-    connection = sqlite3.connect("Data/covid_database.db")
+    # Every request is a slice of the aggregation cube, the database is not queried. In out-of-core mode the
+    # partitioned store answers the request instead, one partition at a time
+    cube = partitions.get_store() if partitions.enabled() else aggregation.get_cube()
 
-    cursor = connection.cursor()
+    data_startdate, data_enddate = cube.date_range()
 
-    
-    data_startdate, data_enddate = query_database.date_ranges(cursor)
-    startdate = startdate.strftime("%Y-%m-%d")
-    enddate = enddate.strftime("%Y-%m-%d")
-
-    if not startdate:
+    if startdate:
+        startdate = startdate.strftime("%Y-%m-%d")
+    else:
         startdate = data_startdate
     
-    if not enddate:
+    if enddate:
+        enddate = enddate.strftime("%Y-%m-%d")
+    else:
         enddate = data_enddate
 
     if startdate < data_startdate:
@@ -26,31 +28,16 @@ def createDataFrameOverTime(continent=None, country=None, province=None, startda
     if enddate > data_enddate:
         enddate = data_enddate        
 
-    if not continent:
-        return  query_database.Total_Cases_Per_Day_Global(connection, startdate, enddate)
-    
-    if continent and not country:
-        return query_database.Total_Cases_Per_Day_Continental(connection, continent, startdate, enddate)
-    
-    if continent and country and not province:
-        return query_database.Total_Cases_Per_Day_Country(connection, continent, country, startdate, enddate)
-    
-    if continent and country and province:
-        return query_database.Total_Cases_Per_Day_Province(connection, continent, country, province, startdate, enddate)
-    
-    return None
+    return cube.series(continent, country, province, startdate, enddate)
 
 def calculateReproductionNumberForDataFrame(df):
-    # Estimator with the value given in the assignment
-    gamma = 1 / 4.5
+    # The frame is a single location, reproduction.py has the same estimator for many locations at once
+    starts = np.zeros(len(df), dtype=bool)
+    starts[:1] = True
 
-    # Calculate mu for each day in the dataframe
-    df["mu"] = df["Total_Deaths"].diff() / df["Total_Active_Cases"]
-
-    # Calculate beta for each day in the dataframe
-    df["beta"] = (df["Total_Active_Cases"].diff() + df["mu"] * df["Total_Active_Cases"] + df["Total_Active_Cases"] * gamma) * df["Population"] / (df["Total_Active_Cases"] * (df["Population"] - df["Total_Confirmed_Cases"]))
-    
-    df["Reproduction Number"] = df["beta"] * gamma
+    df["mu"], df["beta"], df["Reproduction Number"] = reproduction.reproduction_number(
+        df["Total_Deaths"], df["Total_Active_Cases"], df["Total_Confirmed_Cases"], df["Population"], starts
+    )
 
     return df
 
@@ -1,44 +1,51 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import sqlite3
-from scipy.optimize import minimize
-import matplotlib.dates as mdates
 import plotly.express as px
 import createDataFrame
-from partFour import plot_visualization_map_WHO_Region
+import datasets
+import figures
+import fit_cache
+import fitting
+import ingest
+import instrumentation
+import map_payloads
+import query_database
+import simulation
+import snapshot
+from partFour import country_map_frame, plot_visualization_map_WHO_Region
+
+# Record the timings of this rerun when the debug panel in the sidebar is open (or COVID_TRACE is set)
+instrumentation.start_run(st.session_state.get("debug_timings", False) or instrumentation.ENABLED)
+
+# The versions of the snapshots are the cache keys of everything loaded from them, a new csv or delta is picked up
+# on the next rerun
+day_version = snapshot.snapshot_version("day_wise")
+complete_version = snapshot.snapshot_version("complete")
 
 # Load data
-@st.cache_data
-def load_data():
-    df_complete = pd.read_csv("Data/complete.csv", parse_dates=["Date"])
-    df_complete[["Confirmed", "Deaths", "Recovered", "Active"]] = df_complete[["Confirmed", "Deaths", "Recovered", "Active"]].fillna(0)
-    
-    # Keep only 1 row from rows that have the same WHO.Region, Country.Region, Province.State and Date as another
-    df_complete.drop_duplicates(["WHO.Region", "Country.Region", "Province.State", "Date"], inplace=True)
-
-    
+@instrumentation.cached(st.cache_data)
+def load_data(day_version, complete_version):
+    # Load day-wise data, the snapshot already has the NAs filled and is only rebuilt when day_wise.csv changes
+    df_day = snapshot.load_day_wise()
+    df_day["Date"] = df_day["Date"].dt.strftime("%Y-%m-%d")  # Convert Date to string
 
-    # Load day-wise data
-    df_day = pd.read_csv("Data/day_wise.csv")
-    df_day["Date"] = pd.to_datetime(df_day["Date"])
-    df_day["Date"] = df_day["Date"].astype(str)  # Convert Date to string
+    map_payloads.ensure_payloads()
 
-    # Load country-wise data
-    connection = sqlite3.connect("Data/covid_database.db")
-    df_country = pd.read_sql_query("SELECT * FROM country_wise", connection)
-    df_worldometer = pd.read_sql_query("SELECT * FROM worldometer_data", connection)
-    df_usa_counties = pd.read_sql_query("SELECT * FROM usa_county_wise", connection)
+    # Only the columns the tabs use are loaded, see datasets.VIEWS. usa_county_wise is not loaded at all,
+    # the Top US Counties tab reads its few rows from the county_totals rollup
+    df_locations = datasets.load("locations")
+    df_worldometer = datasets.load("continent_totals")
 
-    # Adds the complete.csv as a new table to the sql database without duplicates
-    df_complete.to_sql("complete_data", connection, if_exists="replace", index=False)
+    return df_day, df_worldometer, df_locations
 
-    connection.close()
+# The dashboard only opens the database read-only, loading complete.csv and the county totals is a separate step
+county_version = ingest.county_version()
+if ingest.needs_ingest() or county_version is None:
+    st.error("The database has not been loaded or is older than complete.csv. Run `python Scripts/ingest.py` from the root of the repository and reload this page.")
+    st.stop()
 
-    return df_day, df_country, df_worldometer, df_usa_counties, df_complete
-
-df_day, df_country, df_worldometer, df_usa_counties, df_complete = load_data()
+df_day, df_worldometer, df_locations = load_data(day_version, complete_version)
 
 # Title and description
 st.title("COVID-19 Dashboard")
@@ -49,75 +56,206 @@ with st.sidebar:
     st.header("Filters")
     start_date = st.date_input("Start Date", pd.to_datetime(df_day["Date"].min()))
     end_date = st.date_input("End Date", pd.to_datetime(df_day["Date"].max()))
-    selected_continent = st.sidebar.selectbox("Select Continent", [""] + list(df_complete["WHO.Region"].unique()), index=0)
-    filtered_countries = df_complete[df_complete["WHO.Region"] == selected_continent]["Country.Region"].unique()
+    selected_continent = st.sidebar.selectbox("Select Continent", [""] + list(df_locations["WHO.Region"].unique()), index=0)
+    filtered_countries = df_locations[df_locations["WHO.Region"] == selected_continent]["Country.Region"].unique()
 
     selected_country = st.sidebar.selectbox("Select Country", [""] + list(filtered_countries))
-    filtered_provinces = df_complete[df_complete["Country.Region"] == selected_country]["Province.State"].unique()
+    # complete_data stores a missing province as an empty string
+    filtered_provinces = df_locations[df_locations["Country.Region"] == selected_country]["Province.State"]
+    filtered_provinces = filtered_provinces[filtered_provinces != ""].unique()
 
     if len(filtered_provinces) > 0:
         # Province Selection
-        selected_province = st.sidebar.selectbox("Select Province", [""] + filtered_provinces)
+        selected_province = st.sidebar.selectbox("Select Province", [""] + list(filtered_provinces))
     elif selected_country:
         st.write(f"No provinces available for {selected_country}")
         selected_province = None
     else: 
         st.write(f"No provinces available")
         selected_province = None
+
+    # Plotly charts are drawn in the browser, the default matplotlib charts are rendered to images on the server
+    chart_backend = "plotly" if st.checkbox("Interactive charts") else "matplotlib"
+
+    # Filled in at the end of the script, when everything of this rerun has been timed
+    debug_timings = st.checkbox("Debug timings", key="debug_timings")
+    debug_panel = st.container()
+
+    with st.expander("Memory use"):
+        resident = datasets.resident_bytes()
+        resident["day_wise"] = {"rows": len(df_day), "bytes": int(df_day.memory_usage(deep=True).sum())}
+        st.write(pd.DataFrame.from_dict(resident, orient="index"))
     
 
 # Convert dates to datetime
 start_date = pd.to_datetime(start_date)
 end_date = pd.to_datetime(end_date)
 
-# Filter data based on date range
-filtered_df = df_day[(pd.to_datetime(df_day["Date"]) >= start_date) & (pd.to_datetime(df_day["Date"]) <= end_date)]
+# Everything a tab can depend on, every tab below declares which of these it uses
+filters = {
+    "start_date": start_date,
+    "end_date": end_date,
+    "selected_continent": selected_continent,
+    "selected_country": selected_country,
+    "selected_province": selected_province,
+}
+
+
+def show_chart(chart_id, filter_state, data_version, build):
+    """Draw a chart through the figure cache, build() is only called when the chart is not cached yet."""
+    chart = figures.cached_chart(chart_id, filter_state, data_version, build, chart_backend)
+    with instrumentation.span("draw_chart"):
+        if chart_backend == "plotly":
+            st.plotly_chart(chart, key=chart_id)
+        else:
+            st.image(chart)
+
+
+# Compute units: the output of every unit is cached on its arguments, the data versions are part of the
+# arguments so a new snapshot invalidates them. The frames a unit reads are passed in as well, their names start
+# with an underscore so Streamlit does not hash them, the version next to them is the key. A unit only runs when
+# the tab that uses it is shown.
+
+@instrumentation.cached(st.cache_data)
+def compute_day_window(_df_day, start_date, end_date, day_version):
+    day_dates = pd.to_datetime(_df_day["Date"])
+    date_filter = (day_dates >= start_date) & (day_dates <= end_date)
+
+    filtered_df = _df_day[date_filter].copy()
+    filtered_df["Day"] = day_dates[date_filter]
+    summary_stats = filtered_df[["New cases", "Deaths", "Recovered"]].describe().T
+
+    return filtered_df, summary_stats
+
+
+@instrumentation.cached(st.cache_data)
+def compute_continent_data(_df_worldometer, day_version, complete_version):
+    continent_data = _df_worldometer.groupby("Continent", observed=True)[["TotalCases", "TotalDeaths", "TotalRecovered", "Population"]].sum().reset_index()
+
+    million = 1000000
+    continent_data["Cases_per_million"] = continent_data["TotalCases"] * million / continent_data["Population"]
+    continent_data["Deaths_per_million"] = continent_data["TotalDeaths"] * million / continent_data["Population"]
+    continent_data["Recovered_per_million"] = continent_data["TotalRecovered"] * million / continent_data["Population"]
+
+    return continent_data
+
+
+# Initial values and parameters of the SIR model tab
+S0 = 17000000
+alpha = 0.01
+beta = 0.3
+gamma = 0.1
+mu = 0.01
+
+@instrumentation.cached(st.cache_data)
+def compute_sir_model(_df_day, day_version):
+    I0 = _df_day.loc[0, "Active"]
+    R0 = _df_day.loc[0, "Recovered"]
+    D0 = _df_day.loc[0, "Deaths"]
+    N = S0 + I0 + R0 + D0
+
+    # Simulate SIR model
+    with instrumentation.span("simulate_sird"):
+        S, I, R, D = simulation.simulate_sird(S0, I0, R0, D0, alpha, beta, gamma, mu, N, len(_df_day))[:, 0]
+
+    # Parameter Estimation
+    initial_guess = [0.3, 0.1]
+    bounds = [(0.001, 10), (0.001, 10)]  # Ensure beta and gamma are positive
+
+    # The fit is stored and shared between sessions, it is only computed again when the data or the model changes
+    model = fit_cache.model_key("sir", version=fitting.FIT_VERSION, S0=S0, alpha=alpha, beta=beta, gamma=gamma, mu=mu, initial_guess=initial_guess, bounds=bounds)
+    fit = fit_cache.get_fit_cache().get_or_fit(
+        "Global", _df_day["Date"].iloc[0], _df_day["Date"].iloc[-1], model, day_version,
+        lambda: fitting.fit_sir(_df_day["Active"], S, N, I0, initial_guess, bounds),
+    )
+
+    return S, I, R, D, fit
+
+
+@instrumentation.cached(st.cache_data)
+def compute_location(continent, country, province, start_date, end_date, complete_version):
+    df = createDataFrame.createDataFrameOverTime(continent, country, province, start_date, end_date)
+    df["Date"] = pd.to_datetime(df["Date"])
+    df["Mortality Rate (%)"] = df["Total_Deaths"] * 100 / df["Total_Confirmed_Cases"]
+
+    # Filter data for selected country
+    max_value = df["Total_Confirmed_Cases"].max()
+    df_data = df[df["Total_Confirmed_Cases"] == max_value]
+
+    # Province data has no population and the population of some countries is unknown, so there is no cases per
+    # million and no reproduction number for them
+    if "Population" in df and df["Population"].notna().any():
+        df_per_million = createDataFrame.dataFrameToCasesPerMillion(df.copy())
+        df_reproduction = createDataFrame.calculateReproductionNumberForDataFrame(df.copy())
+    else:
+        df_per_million = None
+        df_reproduction = None
+
+    return df, df_data, df_per_million, df_reproduction
+
+
+@instrumentation.cached(st.cache_data)
+def compute_top_us_counties(county_version):
+    with query_database.connection() as connection:
+        top_cases = query_database.Top_US_Counties(connection, "Confirmed", 5)
+        top_deaths = query_database.Top_US_Counties(connection, "Deaths", 5)
+
+    return top_cases, top_deaths
+
+
+@instrumentation.cached(st.cache_data)
+def compute_case_fatality_rate(_df_day, day_version):
+    # Calculate case fatality rate
+    return pd.to_datetime(_df_day["Date"]).to_numpy(), (_df_day["Deaths"] / _df_day["Confirmed"]).to_numpy()
+
+
+def location_chart(df_location):
+    dates = df_location["Date"].to_numpy()
+    return {
+        "xlabel": "Date",
+        "ylabel": "Cases",
+        "month_locator": True,
+        "lines": [
+            {"x": dates, "y": df_location["Total_Active_Cases"].to_numpy(), "label": "Active Cases", "color": "blue"},
+            {"x": dates, "y": df_location["Total_Recovered"].to_numpy(), "label": "Recovered", "color": "green"},
+            {"x": dates, "y": df_location["Total_Deaths"].to_numpy(), "label": "Deaths", "color": "red"},
+        ],
+    }
 
-# Organize dashboard into tabs
-tab1, tab2, tab3, tab4, tab5 = st.tabs(["General Results", "SIR Model", "Data by location", "Top US Counties", "Case Fatality Rate"])
 
 # General Results Tab
-with tab1:
+def render_general_results(start_date, end_date, selected_continent):
     st.header("General Results")
     st.write("### COVID-19 Time Series")
 
+    filtered_df, summary_stats = compute_day_window(df_day, start_date, end_date, day_version)
+
     st.write("#### Summary Statistics")
-    summary_stats = filtered_df[["New cases", "Deaths", "Recovered"]].describe().T
     st.write(summary_stats)
 
+    def day_chart(column, label, color, ylabel):
+        return {
+            "figsize": (10, 4),
+            "xlabel": "Date",
+            "ylabel": ylabel,
+            "lines": [{"x": filtered_df["Day"].to_numpy(), "y": filtered_df[column].to_numpy(), "label": label, "color": color}],
+        }
+
     # Part 1 Graphs: New Cases, Deaths, Recovered Cases
+    date_state = (start_date, end_date)
+
     st.write("#### New Cases Over Time")
-    fig1, ax1 = plt.subplots(figsize=(10, 4))
-    ax1.plot(pd.to_datetime(filtered_df["Date"]), filtered_df["New cases"], color="blue", label="New Cases")
-    ax1.set_xlabel("Date")
-    ax1.set_ylabel("New Cases")
-    ax1.legend()
-    st.pyplot(fig1)
+    show_chart("new_cases", date_state, day_version, lambda: day_chart("New cases", "New Cases", "blue", "New Cases"))
 
     st.write("#### Deaths Over Time")
-    fig2, ax2 = plt.subplots(figsize=(10, 4))
-    ax2.plot(pd.to_datetime(filtered_df["Date"]), filtered_df["Deaths"], color="red", label="Deaths")
-    ax2.set_xlabel("Date")
-    ax2.set_ylabel("Deaths")
-    ax2.legend()
-    st.pyplot(fig2)
+    show_chart("deaths", date_state, day_version, lambda: day_chart("Deaths", "Deaths", "red", "Deaths"))
 
     st.write("#### Recovered Cases Over Time")
-    fig3, ax3 = plt.subplots(figsize=(10, 4))
-    ax3.plot(pd.to_datetime(filtered_df["Date"]), filtered_df["Recovered"], color="green", label="Recovered")
-    ax3.set_xlabel("Date")
-    ax3.set_ylabel("Recovered Cases")
-    ax3.legend()
-    st.pyplot(fig3)
+    show_chart("recovered", date_state, day_version, lambda: day_chart("Recovered", "Recovered", "green", "Recovered Cases"))
 
     # Continent-wise comparison
     st.write("#### COVID-19 Evolution Across Continents")
-    continent_data = df_worldometer.groupby("Continent")[["TotalCases", "TotalDeaths", "TotalRecovered", "Population"]].sum().reset_index()
-
-    million = 1000000
-    continent_data["Cases_per_million"] = continent_data["TotalCases"] * million / continent_data["Population"]
-    continent_data["Deaths_per_million"] = continent_data["TotalDeaths"] * million / continent_data["Population"]
-    continent_data["Recovered_per_million"] = continent_data["TotalRecovered"] * million / continent_data["Population"]
+    continent_data = compute_continent_data(df_worldometer, day_version, complete_version)
 
     show_cases_per_million = st.checkbox("Display cases per million")
 
@@ -128,8 +266,6 @@ with tab1:
                     y=["Cases_per_million", "Recovered_per_million", "Deaths_per_million"], 
                     title="Total Cases, Deaths, and Recovered per Population by Continent", 
                     barmode="group")
-
-        st.plotly_chart(fig4)
     else:
         # Normal values, not scaled data
         fig4 = px.bar(continent_data, x="Continent", y=["TotalCases", "TotalRecovered", "TotalDeaths"], 
@@ -139,93 +275,65 @@ with tab1:
 
     if selected_continent:
         st.write(f"#### Active cases across {selected_continent}")
-        fig5 = plot_visualization_map_WHO_Region(selected_continent)
+        # The map shows one value per country, read from the precomputed [country x day] payload
+        map_date = None
+        if st.checkbox("Choose the date of the map"):
+            map_dates = [str(date) for date in map_payloads.get_payloads().dates]
+            map_date = st.select_slider("Map date", options=map_dates, value=min(max(str(end_date.date()), map_dates[0]), map_dates[-1]))
+        fig5 = plot_visualization_map_WHO_Region(selected_continent, country_map_frame(selected_continent, map_date))
         st.plotly_chart(fig5)
     else:
         st.write(f"#### In order to display cases across a region, please select one")
 
+
 # SIR Model Tab
-with tab2:
+def render_sir_model():
     st.header("SIR Model Simulation")
     st.write("### SIR Model with Deaths")
 
-    # Initial values
-    S0 = 17000000
-    I0 = df_day.loc[0, "Active"]
-    R0 = df_day.loc[0, "Recovered"]
-    D0 = df_day.loc[0, "Deaths"]
-    N = S0 + I0 + R0 + D0
-
-    # Parameters
-    alpha = 0.01
-    beta = 0.3
-    gamma = 0.1
-    mu = 0.01
-
-    # Simulate SIR model
-    S, I, R, D = [S0], [I0], [R0], [D0]
-    for t in range(1, len(df_day)):
-        delta_S = alpha * R[-1] - beta * S[-1] * I[-1] / N
-        delta_I = beta * S[-1] * I[-1] / N - mu * I[-1] - gamma * I[-1]
-        delta_R = gamma * I[-1] - alpha * R[-1]
-        delta_D = mu * I[-1]
-        
-        S.append(S[-1] + delta_S)
-        I.append(I[-1] + delta_I)
-        R.append(R[-1] + delta_R)
-        D.append(D[-1] + delta_D)
+    S, I, R, D, fit = compute_sir_model(df_day, day_version)
 
     # Plot SIR model
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(pd.to_datetime(df_day["Date"]), S, label="Susceptible")
-    ax.plot(pd.to_datetime(df_day["Date"]), I, label="Infected")
-    ax.plot(pd.to_datetime(df_day["Date"]), R, label="Recovered")
-    ax.plot(pd.to_datetime(df_day["Date"]), D, label="Deceased")
-    ax.set_xlabel("Date")
-    ax.set_ylabel("Number of Individuals")
-    ax.set_title("SIR Model with Deaths")
-    ax.legend()
-    st.pyplot(fig)
+    sir_state = (S0, alpha, beta, gamma, mu)
+    dates = pd.to_datetime(df_day["Date"]).to_numpy()
+    show_chart("sir_model", sir_state, day_version, lambda: {
+        "xlabel": "Date",
+        "ylabel": "Number of Individuals",
+        "title": "SIR Model with Deaths",
+        "lines": [
+            {"x": dates, "y": S, "label": "Susceptible"},
+            {"x": dates, "y": I, "label": "Infected"},
+            {"x": dates, "y": R, "label": "Recovered"},
+            {"x": dates, "y": D, "label": "Deceased"},
+        ],
+    })
 
     # SIR Model Accuracy
     st.write("#### SIR Model vs Actual Data")
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(pd.to_datetime(df_day["Date"]), I, label="SIR Model (Infected)")
-    ax.plot(pd.to_datetime(df_day["Date"]), df_day["Active"], label="Actual Active Cases")
-    ax.set_xlabel("Date")
-    ax.set_ylabel("Count")
-    ax.set_title("SIR Model vs Actual Data")
-    ax.legend()
-    st.pyplot(fig)
+    show_chart("sir_accuracy", sir_state, day_version, lambda: {
+        "xlabel": "Date",
+        "ylabel": "Count",
+        "title": "SIR Model vs Actual Data",
+        "lines": [
+            {"x": dates, "y": I, "label": "SIR Model (Infected)"},
+            {"x": dates, "y": df_day["Active"].to_numpy(), "label": "Actual Active Cases"},
+        ],
+    })
 
     # Parameter Estimation
     st.write("#### Parameter Estimation")
-    def error_function(params):
-        beta, gamma = params
-        if beta <= 0 or gamma <= 0:  # Ensure positive values
-            return np.inf  # Return a large value for invalid parameters
-
-        I_pred = [I0]
-        for t in range(1, len(df_day)):
-            delta_I = beta * S[t-1] * I_pred[t-1] / N - gamma * I_pred[t-1]
-            I_pred.append(I_pred[t-1] + delta_I)
-        return np.sum((np.array(I_pred) - df_day["Active"])**2)
-
-    initial_guess = [0.3, 0.1]
-    bounds = [(0.001, 10), (0.001, 10)]  # Ensure beta and gamma are positive
-    result = minimize(error_function, initial_guess, bounds=bounds)
-
-    if result.success:
-        beta_est, gamma_est = result.x
-        R0_est = beta_est / gamma_est
+    if fit["success"]:
+        beta_est, gamma_est = fit["beta"], fit["gamma"]
+        R0_est = fit["R0"]
         st.write(f"Estimated beta: {beta_est:.2f}")
         st.write(f"Estimated gamma: {gamma_est:.2f}")
         st.write(f"Estimated R0: {R0_est:.2f}")
     else:
-        st.error("Optimization failed. Check the data and parameters.")
+        st.error(f"Optimization failed: {fit['message']}. Check the data and parameters.")
+
 
 # Country-Specific Data Tab
-with tab3:
+def render_location(selected_continent, selected_country, selected_province, start_date, end_date):
     st.header("Country-Specific Statistics")
 
     if selected_province:
@@ -237,21 +345,18 @@ with tab3:
     else:
         st.write("### Global COVID-19 Data")
 
-    df = createDataFrame.createDataFrameOverTime(selected_continent, selected_country, selected_province, start_date, end_date)
-    df["Date"] = pd.to_datetime(df["Date"])
-    df["Mortality Rate (%)"] = df["Total_Deaths"] * 100 / df["Total_Confirmed_Cases"]
-
-    # Filter data for selected country
-    max_value = df["Total_Confirmed_Cases"].max()
-    df_data = df[df["Total_Confirmed_Cases"] == max_value]
-    # df_data["Date"]
+    location_state = (selected_continent, selected_country, selected_province, start_date, end_date)
+    df, df_data, df_per_million, df_reproduction = compute_location(*location_state, complete_version)
 
     st.write(df_data)
 
-    if not selected_province:
-        show_per_million = st.checkbox("Show cases per million")
-    else:
+    if selected_province:
         show_per_million = False # No data available if province is selected so option should not be available
+    elif df_per_million is None:
+        st.info(f"No population is available for {selected_country or selected_continent}, so cases per million can not be shown")
+        show_per_million = False
+    else:
+        show_per_million = st.checkbox("Show cases per million")
 
     if show_per_million:
         if selected_country:
@@ -261,17 +366,8 @@ with tab3:
         else:
             st.write("#### Global COVID-19 spread over time in cases per million")
 
-        df_population = createDataFrame.dataFrameToCasesPerMillion(df)
-        fig1, ax1 = plt.subplots(figsize=((10,6)))
-        ax1.plot(df_population["Date"], df_population["Total_Active_Cases"], label="Active Cases", color="blue")
-        ax1.plot(df_population["Date"], df_population["Total_Recovered"], label="Recovered", color="green")
-        ax1.plot(df_population["Date"], df_population["Total_Deaths"], label="Deaths", color="red")
-
-        ax1.set_xlabel("Date")
-        ax1.xaxis.set_major_locator(mdates.MonthLocator(interval=1))
-        ax1.set_ylabel("Cases")
-        ax1.legend()
-        st.pyplot(fig1) # Plot selected country, continent or global for cases per million
+        # Plot selected country, continent or global for cases per million
+        show_chart("location_cases_per_million", location_state, complete_version, lambda: location_chart(df_per_million))
     else:
         if selected_province:
             st.write(f"#### Covid-19 over time for {selected_province}")
@@ -282,20 +378,13 @@ with tab3:
         else:
             st.write("#### Global COVID-19 spread over time")
     
-        fig2, ax2 = plt.subplots(figsize=(10,6))
-        ax2.plot(df["Date"], df["Total_Active_Cases"], label="Active Cases", color="blue")
-        ax2.plot(df["Date"], df["Total_Recovered"], label="Recovered", color="green")
-        ax2.plot(df["Date"], df["Total_Deaths"], label="Deaths", color="red")
-
-        ax2.set_xlabel("Date")
-        ax2.xaxis.set_major_locator(mdates.MonthLocator(interval=1))
-        ax2.set_ylabel("Cases")
-        ax2.legend()
+        # Plot the total number of cases for the selected province
+        show_chart("location_cases", location_state, complete_version, lambda: location_chart(df))
 
-        st.pyplot(fig2) # Plot the total number of cases for the selected province
-        
+    if df_reproduction is None:
+        st.write(f"#### No population is available for {selected_province or selected_country or selected_continent}, so the reproduction number can not be estimated")
+        return
 
-    df_reproduction = createDataFrame.calculateReproductionNumberForDataFrame(df)
     if selected_province:
         st.write(f"#### Evolvement of COVID-19 reproduction number for {selected_province}")
     elif selected_country:
@@ -305,24 +394,18 @@ with tab3:
     else:
         st.write("### Global evolvement of COVID-19 reproduction number")
 
-    df_population = createDataFrame.dataFrameToCasesPerMillion(df)
-    fig3, ax3 = plt.subplots(figsize=((10,6)))
-    ax3.plot(df_reproduction["Date"], df_reproduction["Reproduction Number"], label="Active Cases", color="blue")
+    show_chart("reproduction_number", location_state, complete_version, lambda: {
+        "xlabel": "Date",
+        "ylabel": r"$R_0$" if chart_backend == "matplotlib" else "R0",
+        "month_locator": True,
+        "lines": [{"x": df_reproduction["Date"].to_numpy(), "y": df_reproduction["Reproduction Number"].to_numpy(), "label": "Active Cases", "color": "blue"}],
+    })
 
-    ax3.set_xlabel("Date")
-    ax3.xaxis.set_major_locator(mdates.MonthLocator(interval=1))
-    ax3.set_ylabel(r"$R_0$")
-    ax3.legend()
-    st.pyplot(fig3) # Plot selected country, continent or global for cases per million
 
 # Top US Counties Tab
-with tab4:
+def render_top_us_counties():
     st.header("Top 5 US Counties with Most Cases and Deaths")
-    top_cases = df_usa_counties.groupby(["Admin2", "Province_State"], as_index=False)["Confirmed"].sum()
-    top_cases = top_cases.nlargest(5, "Confirmed")
-
-    top_deaths = df_usa_counties.groupby(["Admin2", "Province_State"], as_index=False)["Deaths"].sum()
-    top_deaths = top_deaths.nlargest(5, "Deaths")
+    top_cases, top_deaths = compute_top_us_counties(county_version)
 
     st.write("### Top 5 Counties by Confirmed Cases")
     st.write(top_cases)
@@ -330,19 +413,43 @@ with tab4:
     st.write("### Top 5 Counties by Deaths")
     st.write(top_deaths)
 
+
 # Case Fatality Rate Tab
-with tab5:
+def render_case_fatality_rate():
     st.header("Case Fatality Rate Analysis")
     st.write("### Case Fatality Rate Over Time")
 
-    # Calculate case fatality rate
-    df_day["Case Fatality Rate"] = df_day["Deaths"] / df_day["Confirmed"]
+    dates, case_fatality_rate = compute_case_fatality_rate(df_day, day_version)
 
     # Plot case fatality rate
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(pd.to_datetime(df_day["Date"]), df_day["Case Fatality Rate"], label="Case Fatality Rate")
-    ax.set_xlabel("Date")
-    ax.set_ylabel("Case Fatality Rate")
-    ax.set_title("Case Fatality Rate Over Time")
-    ax.legend()
-    st.pyplot(fig)
+    show_chart("case_fatality_rate", (), day_version, lambda: {
+        "xlabel": "Date",
+        "ylabel": "Case Fatality Rate",
+        "title": "Case Fatality Rate Over Time",
+        "lines": [{"x": dates, "y": case_fatality_rate, "label": "Case Fatality Rate"}],
+    })
+
+
+# Every tab with its render function and the filters it depends on
+TABS = {
+    "General Results": (render_general_results, ["start_date", "end_date", "selected_continent"]),
+    "SIR Model": (render_sir_model, []),
+    "Data by location": (render_location, ["selected_continent", "selected_country", "selected_province", "start_date", "end_date"]),
+    "Top US Counties": (render_top_us_counties, []),
+    "Case Fatality Rate": (render_case_fatality_rate, []),
+}
+
+# Organize dashboard into tabs, only the selected tab is computed and drawn
+active_tab = st.radio("Tab", list(TABS), horizontal=True, key="active_tab", label_visibility="collapsed")
+render, inputs = TABS[active_tab]
+with instrumentation.span(f"tab: {active_tab}"):
+    render(**{name: filters[name] for name in inputs})
+
+records = instrumentation.finish_run()
+if debug_timings:
+    with debug_panel:
+        totals = instrumentation.run_totals(records)
+        st.write(f"{totals['seconds']:.3f} s, {totals['statements']} SQL statements")
+        st.dataframe(pd.DataFrame(instrumentation.summary(records)).round(4), hide_index=True)
+        if instrumentation.TRACE_PATH:
+            st.caption(f"Written to {instrumentation.TRACE_PATH}")
@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from urllib.parse import parse_qsl, urlsplit
+import numpy as np
+import pandas as pd
+import aggregation
+import createDataFrame
+import ingest
+import partThree
+import partitions
+import query_database
+
+# pyarrow is optional, without it the service answers in json and npy only
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# Local HTTP API with the series the dashboard computes, for programs that should not import the scripts or open
+# the database themselves. Every response is computed once per data version in a worker thread: identical requests
+# that arrive while it is computed wait for the same result, later ones are answered from memory, and clients that
+# send the ETag back get a 304 without a body. Run it from the root of the repository: `python Scripts/data_service.py`
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 4
+# How often the snapshot and the database are checked for changes
+REFRESH_SECONDS = 1.0
+MAX_CACHED_RESPONSES = 1024
+# Smaller bodies are not worth compressing
+GZIP_MIN_BYTES = 1024
+MAX_HEADER_BYTES = 16384
+
+CONTENT_TYPES = {"json": "application/json", "npy": "application/octet-stream", "arrow": "application/vnd.apache.arrow.stream"}
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d") if value else None
+
+
+def series(continent=None, country=None, province=None, start=None, end=None):
+    """createDataFrameOverTime of a WHO region, country or province, the global totals without continent."""
+    store = partitions.get_store() if partitions.enabled() else aggregation.get_cube()
+    if not store.has_location(continent, country, province):
+        raise LookupError(f"No data for {province or country or continent}")
+
+    return createDataFrame.createDataFrameOverTime(continent, country, province, parse_date(start), parse_date(end))
+
+
+def reproduction_series(continent=None, country=None):
+    """R(t) with mu and beta per day of a country, or of the whole WHO region without country."""
+    if not continent:
+        raise ValueError("continent is required")
+
+    store = partitions.get_reproduction_store("country" if country else "region")
+    key = (continent, country) if country else continent
+    if key not in store:
+        raise LookupError(f"No data for {country or continent}")
+
+    return store.series(key)
+
+
+def parameters(continent=None, country=None, source="estimate"):
+    """SIRD parameters of a country. source=estimate: α̂, β̂, γ and μ̂ of partThree.estimate_parameters, one row.
+    source=fits: the fits of fit_runner.py on the current data, one row per fitted date window, newest first."""
+    if source == "estimate":
+        if not country:
+            raise ValueError("country is required")
+
+        df = partThree.estimate_parameters([country])
+        if np.isnan(df.loc[0, "active"]):
+            raise LookupError(f"No data for {country}")
+        return df
+
+    if source != "fits":
+        raise ValueError(f"Unknown source {source}, use estimate or fits")
+    if not (continent and country):
+        raise ValueError("continent and country are required")
+
+    query = """
+    SELECT start_date, end_date, model, alpha, beta, gamma, mu, R0, loss, rmse, r2, success, message, iterations, evaluations, fitted_at
+    FROM fit_results
+    WHERE level = 'country' AND [WHO.Region] = ? AND [Country.Region] = ? AND data_version = ?
+    ORDER BY fitted_at DESC, start_date, end_date;
+    """
+    try:
+        with query_database.connection() as connection:
+            df = pd.read_sql(query, connection, params=(continent, country, aggregation.get_cube().version))
+    except pd.errors.DatabaseError:  # fit_results does not exist (yet)
+        df = None
+
+    if df is None or df.empty:
+        raise LookupError(f"No fits for {country} on the current data, run python Scripts/fit_runner.py first")
+
+    return df
+
+
+def top_counties(metric="Confirmed", k="5"):
+    """Top_US_Counties, the k counties with the most confirmed cases or deaths."""
+    try:
+        k = int(k)
+    except ValueError:
+        k = 0
+    if k <= 0:
+        raise ValueError("k must be a positive integer")
+
+    with query_database.connection() as connection:
+        return query_database.Top_US_Counties(connection, metric, k)
+
+
+# The functions run in the worker threads with the query parameters as keyword arguments. A response is valid as
+# long as the versions it depends on did not change: "data" is the complete.csv snapshot, "database" any commit.
+ENDPOINTS = {
+    "/series": {"function": series, "parameters": ["continent", "country", "province", "start", "end"], "depends": ["data"]},
+    "/reproduction": {"function": reproduction_series, "parameters": ["continent", "country"], "depends": ["data"]},
+    "/parameters": {"function": parameters, "parameters": ["continent", "country", "source"], "depends": ["data", "database"]},
+    "/top_counties": {"function": top_counties, "parameters": ["metric", "k"], "depends": ["database"]},
+}
+
+
+def encode(df, fmt):
+    """Body of a frame: json with orient="split", a structured npy array or an Arrow IPC stream."""
+    if fmt == "json":
+        df = df.copy()
+        for column in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[column]):
+                df[column] = df[column].dt.strftime("%Y-%m-%d")
+        return df.to_json(orient="split", index=False).encode()
+
+    if fmt == "npy":
+        arrays = []
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if pd.api.types.is_datetime64_any_dtype(values):
+                values = values.astype("datetime64[D]")
+            elif values.dtype == object:
+                values = values.astype(str)
+            arrays.append(values)
+
+        buffer = BytesIO()
+        np.save(buffer, np.rec.fromarrays(arrays, names=list(df.columns)), allow_pickle=False)
+        return buffer.getvalue()
+
+    sink = pyarrow.BufferOutputStream()
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def build_response(function, query, fmt):
+    """Runs in a worker thread. Returns (body, gzipped body or None)."""
+    body = encode(function(**query), fmt)
+    return body, gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None
+
+
+def error(status, message):
+    return status, {"Content-Type": "text/plain; charset=utf-8"}, message.encode()
+
+
+class DataService:
+    """Answers the requests of the HTTP server from one shared cube, see ENDPOINTS."""
+
+    def __init__(self, workers=WORKERS, max_cached=MAX_CACHED_RESPONSES):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_cached = max_cached
+
+        # key -> (body, gzipped body), the least recently used first
+        self.responses = OrderedDict()
+        # key -> future of a response that is being computed
+        self.pending = {}
+
+        # PRAGMA data_version of this connection changes whenever another connection commits
+        self.database = sqlite3.connect(f"file:{query_database.DATABASE_PATH}?mode=ro", uri=True, check_same_thread=False)
+        self.versions = None
+        self.versions_checked = 0.0
+        self.versions_pending = None
+
+        self.stats = {"requests": 0, "not_modified": 0, "hits": 0, "coalesced": 0, "computed": 0}
+
+    def read_versions(self):
+        """Runs in a worker thread, get_cube rebuilds the cube here when the snapshot changed."""
+        if partitions.enabled():
+            data = str(partitions.get_store().last_day)
+        else:
+            data = aggregation.get_cube().version
+
+        return {"data": data, "database": str(self.database.execute("PRAGMA data_version;").fetchone()[0])}
+
+    def versions_read(self, future):
+        self.versions_pending = None
+        if not future.cancelled() and future.exception() is None:
+            self.versions, self.versions_checked = future.result(), time.monotonic()
+
+    async def current_versions(self):
+        """The versions, read again at most every REFRESH_SECONDS and only by one request at a time."""
+        if self.versions is None or time.monotonic() - self.versions_checked > REFRESH_SECONDS:
+            if self.versions_pending is None:
+                self.versions_pending = asyncio.get_running_loop().run_in_executor(self.executor, self.read_versions)
+                self.versions_pending.add_done_callback(self.versions_read)
+            # A request that is cancelled must not cancel the check the others wait for
+            await asyncio.shield(self.versions_pending)
+
+        return self.versions
+
+    def computed(self, key, future):
+        del self.pending[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self.stats["computed"] += 1
+        self.responses[key] = future.result()
+        while len(self.responses) > self.max_cached:
+            self.responses.popitem(last=False)
+
+    async def response_body(self, key, endpoint, query, fmt):
+        entry = self.responses.get(key)
+        if entry is not None:
+            self.responses.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, build_response, endpoint["function"], query, fmt)
+            self.pending[key] = future
+            future.add_done_callback(lambda done: self.computed(key, done))
+        else:
+            self.stats["coalesced"] += 1
+
+        return await asyncio.shield(future)
+
+    async def respond(self, target, headers):
+        """(status, headers, body) of a GET request."""
+        self.stats["requests"] += 1
+        url = urlsplit(target)
+
+        if url.path == "/status":
+            versions = await self.current_versions()
+            body = json.dumps(dict(self.stats, cached=len(self.responses), pending=len(self.pending), versions=versions)).encode()
+            return 200, {"Content-Type": CONTENT_TYPES["json"], "Cache-Control": "no-store"}, body
+
+        endpoint = ENDPOINTS.get(url.path)
+        if endpoint is None:
+            return error(404, f"Unknown path {url.path}, use one of {', '.join(ENDPOINTS)} or /status")
+
+        query = dict(parse_qsl(url.query))
+        fmt = query.pop("format", "json")
+        if fmt not in CONTENT_TYPES or (fmt == "arrow" and pyarrow is None):
+            formats = [name for name in CONTENT_TYPES if name != "arrow" or pyarrow is not None]
+            return error(400, f"Unknown format {fmt}, use one of {', '.join(formats)}")
+
+        unknown = sorted(set(query) - set(endpoint["parameters"]))
+        if unknown:
+            return error(400, f"Unknown parameters {', '.join(unknown)}, {url.path} takes {', '.join(endpoint['parameters'])}")
+
+        # The ETag is known before anything is computed, so a client with the current version gets its 304 right away
+        versions = await self.current_versions()
+        key = (url.path, tuple(sorted(query.items())), fmt, tuple(versions[name] for name in endpoint["depends"]))
+        etag = hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+        use_gzip = "gzip" in headers.get("accept-encoding", "")
+        response_headers = {"Content-Type": CONTENT_TYPES[fmt], "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+        # The gzipped body is a different representation with an ETag of its own
+        tags = {tag.strip().removeprefix("W/") for tag in headers.get("if-none-match", "").split(",")}
+        if "*" in tags or f'"{etag}"' in tags or f'"{etag}-gzip"' in tags:
+            self.stats["not_modified"] += 1
+            response_headers["ETag"] = f'"{etag}-gzip"' if use_gzip and f'"{etag}-gzip"' in tags else f'"{etag}"'
+            return 304, response_headers, b""
+
+        try:
+            body, gzipped = await self.response_body(key, endpoint, query, fmt)
+        except ValueError as exception:
+            return error(400, str(exception))
+        except LookupError as exception:
+            return error(404, str(exception).strip("'\""))
+        except Exception as exception:
+            return error(500, f"{type(exception).__name__}: {exception}")
+
+        if use_gzip and gzipped is not None:
+            response_headers["Content-Encoding"] = "gzip"
+            response_headers["ETag"] = f'"{etag}-gzip"'
+            return 200, response_headers, gzipped
+
+        response_headers["ETag"] = f'"{etag}"'
+        return 200, response_headers, body
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.database.close()
+
+
+def http_response(status, headers, body, keep_alive, head=False):
+    lines = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (b"" if head else body)
+
+
+async def handle_connection(service, reader, writer):
+    """Serve the requests of one connection, it stays open between requests unless the client asks to close it."""
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                break
+
+            lines = head.decode("latin-1").split("\r\n")
+            request = lines[0].split(" ")
+            headers = {}
+            for line in lines[1:]:
+                name, separator, value = line.partition(":")
+                if separator:
+                    headers[name.strip().lower()] = value.strip()
+
+            connection_header = headers.get("connection", "").lower()
+            keep_alive = connection_header != "close" if request[-1] == "HTTP/1.1" else connection_header == "keep-alive"
+
+            if len(request) != 3:
+                status, response_headers, body = error(400, "Malformed request line")
+                keep_alive = False
+            elif request[0] not in ("GET", "HEAD"):
+                # A body of the request is not read, so the connection can not be used for another request
+                status, response_headers, body = error(405, "Only GET and HEAD are supported")
+                response_headers["Allow"] = "GET, HEAD"
+                keep_alive = False
+            else:
+                status, response_headers, body = await service.respond(request[1], headers)
+
+            writer.write(http_response(status, response_headers, body, keep_alive, head=request[0] == "HEAD"))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host=HOST, port=PORT, workers=WORKERS):
+    service = DataService(workers)
+    # Build the cube before the first request comes in
+    await service.current_versions()
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(service, reader, writer), host, port, limit=MAX_HEADER_BYTES, backlog=1024
+    )
+    print(f"Serving {', '.join(ENDPOINTS)} on http://{host}:{port}")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the time series, R(t), SIR fits and top US counties over a local HTTP API.")
+    parser.add_argument("--host", default=HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Threads that compute responses")
+    args = parser.parse_args()
+
+    # Same as the dashboard, the tables are brought up to date before anything is served
+    if ingest.needs_ingest():
+        ingest.ingest_complete()
+    if ingest.county_rollups_behind():
+        ingest.update_county_rollups()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,86 @@
+import threading
+import numpy as np
+import pandas as pd
+import instrumentation
+import query_database
+
+# Every view names the table, the columns it needs with the type they are stored as in memory, and the columns it
+# can be filtered on. Only those columns are read from SQLite and the filters are part of the query.
+#   category: pandas categorical, int32: int32 (nullable Int32 when the column has NULLs), float32 / float64
+VIEWS = {
+    "continent_totals": {
+        "table": "worldometer_data",
+        "columns": {
+            "Continent": "category",
+            "Population": "float64",
+            "TotalCases": "int32",
+            "TotalDeaths": "int32",
+            "TotalRecovered": "int32",
+        },
+        "filters": ["Continent"],
+    },
+    "locations": {
+        "table": "location",
+        "columns": {
+            "WHO.Region": "category",
+            "Country.Region": "category",
+            "Province.State": "category",
+        },
+        "filters": ["WHO.Region", "Country.Region"],
+    },
+}
+
+_resident = {}
+_resident_lock = threading.Lock()
+
+
+def view_query(name, **filters):
+    """SELECT statement and parameters of a view, only with the declared columns and filters."""
+    view = VIEWS[name]
+
+    unknown = set(filters) - set(view["filters"])
+    if unknown:
+        raise ValueError(f"View {name} can not be filtered on {', '.join(sorted(unknown))}")
+
+    columns = ", ".join(f"[{column}]" for column in view["columns"])
+    query = f"SELECT {columns} FROM {view['table']}"
+
+    if filters:
+        query += " WHERE " + " AND ".join(f"[{column}] = ?" for column in filters)
+
+    return query + ";", tuple(filters.values())
+
+
+def downcast(series, kind):
+    if kind == "category":
+        return series.astype("category")
+    if kind == "int32":
+        # Counts are sometimes stored as REAL, NULLs need the nullable integer type
+        return series.astype("Int32" if series.isna().any() else np.int32)
+    return series.astype(kind)
+
+
+@instrumentation.timed("datasets.load")
+def load(name, connection=None, **filters):
+    """Read a view into a narrow DataFrame, e.g. load("locations", **{"WHO.Region": "Europe"})."""
+    query, params = view_query(name, **filters)
+
+    if connection is None:
+        with query_database.connection() as connection:
+            df = pd.read_sql_query(query, connection, params=params)
+    else:
+        df = pd.read_sql_query(query, connection, params=params)
+
+    for column, kind in VIEWS[name]["columns"].items():
+        df[column] = downcast(df[column], kind)
+
+    with _resident_lock:
+        _resident[name] = {"rows": len(df), "bytes": int(df.memory_usage(deep=True).sum())}
+
+    return df
+
+
+def resident_bytes():
+    """Rows and bytes in memory of the last frame loaded for every view."""
+    with _resident_lock:
+        return {name: dict(values) for name, values in _resident.items()}
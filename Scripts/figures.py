@@ -0,0 +1,157 @@
+import io
+import threading
+from collections import OrderedDict
+import numpy as np
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+import plotly.graph_objects as go
+import instrumentation
+
+# Series longer than this are downsampled before they are drawn
+MAX_POINTS = 1000
+MAX_CACHED_CHARTS = 256
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets downsampling, returns the indices of the points to keep.
+
+    The first and last point are always kept, from every bucket in between the point that forms the largest
+    triangle with the previously kept point and the average of the next bucket is chosen.
+    """
+    length = len(y)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    edges = np.linspace(1, length - 1, threshold - 1).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = length - 1
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else length
+        average_x = x[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+
+        areas = np.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        keep[bucket + 1] = previous
+
+    return keep
+
+
+def as_numbers(x):
+    """Dates as milliseconds since 1970, which is also what plotly expects on a date axis."""
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype("datetime64[ms]").astype(np.int64).astype(np.float64)
+    return x.astype(np.float64)
+
+
+def downsample(line, max_points):
+    x = np.asarray(line["x"])
+    y = np.asarray(line["y"], dtype=np.float64)
+
+    keep = lttb(as_numbers(x), np.nan_to_num(y), max_points)
+    return dict(line, x=x[keep], y=y[keep])
+
+
+def render_matplotlib(chart):
+    """Render the chart to PNG bytes, a Figure is used instead of pyplot so nothing stays registered globally."""
+    fig = Figure(figsize=chart.get("figsize", (10, 6)))
+    ax = fig.subplots()
+
+    for line in chart["lines"]:
+        ax.plot(line["x"], line["y"], label=line.get("label"), color=line.get("color"), linestyle=line.get("linestyle", "-"))
+
+    if chart.get("hline") is not None:
+        ax.axhline(y=chart["hline"], color="r", linestyle="--")
+
+    ax.set_xlabel(chart.get("xlabel", ""))
+    ax.set_ylabel(chart.get("ylabel", ""))
+    if chart.get("title"):
+        ax.set_title(chart["title"])
+    if chart.get("month_locator"):
+        ax.xaxis.set_major_locator(mdates.MonthLocator(interval=1))
+    ax.legend()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def render_plotly(chart):
+    """Client side chart, the values are sent as compact typed arrays instead of lists of numbers."""
+    fig = go.Figure()
+
+    for line in chart["lines"]:
+        x = np.asarray(line["x"])
+        is_date = np.issubdtype(x.dtype, np.datetime64)
+        dash = {"--": "dash", ":": "dot", "-.": "dashdot"}.get(line.get("linestyle"), "solid")
+
+        fig.add_trace(go.Scattergl(
+            x=as_numbers(x) if is_date else x,
+            y=np.asarray(line["y"], dtype=np.float32),
+            mode="lines",
+            name=line.get("label"),
+            line={"color": line.get("color"), "dash": dash},
+        ))
+
+    if chart.get("hline") is not None:
+        fig.add_hline(y=chart["hline"], line_color="red", line_dash="dash")
+
+    date_axis = any(np.issubdtype(np.asarray(line["x"]).dtype, np.datetime64) for line in chart["lines"])
+    fig.update_layout(
+        title=chart.get("title"),
+        xaxis={"title": chart.get("xlabel", ""), "type": "date" if date_axis else "-"},
+        yaxis={"title": chart.get("ylabel", "")},
+    )
+    return fig
+
+
+RENDERERS = {
+    "matplotlib": render_matplotlib,
+    "plotly": render_plotly,
+}
+
+_charts = OrderedDict()
+_charts_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0}
+
+
+@instrumentation.timed("chart")
+def cached_chart(chart_id, filter_state, data_version, build, backend="matplotlib", max_points=MAX_POINTS):
+    """Return the rendered chart for (chart id, filter state, data version), build() is only called on a miss.
+
+    build returns a dict with the lines ({"x", "y", "label", "color", "linestyle"}) and the labels of the chart.
+    The result is PNG bytes for matplotlib and a plotly Figure for plotly.
+    """
+    key = (chart_id, tuple(filter_state), data_version, backend, max_points)
+
+    with _charts_lock:
+        if key in _charts:
+            _charts.move_to_end(key)
+            stats["hits"] += 1
+            instrumentation.count("chart_cache_hits")
+            return _charts[key]
+
+    stats["misses"] += 1
+    instrumentation.count("chart_cache_misses")
+    chart = build()
+    chart["lines"] = [downsample(line, max_points) for line in chart["lines"]]
+    with instrumentation.span(f"render_{backend}"):
+        rendered = RENDERERS[backend](chart)
+
+    with _charts_lock:
+        _charts[key] = rendered
+        while len(_charts) > MAX_CACHED_CHARTS:
+            _charts.popitem(last=False)
+
+    return rendered
@@ -0,0 +1,119 @@
+import json
+import sqlite3
+import threading
+import time
+import instrumentation
+
+# Kept apart from covid_database.db, which the dashboard only opens read-only
+FIT_CACHE_PATH = "Data/fit_cache.db"
+MAX_ENTRIES = 10000
+
+
+def model_key(name, **options):
+    """Model variant as a stable string, every option that changes the fit has to be part of it."""
+    return name + json.dumps(options, sort_keys=True, default=str)
+
+
+class FitCache:
+    """Fit results stored in SQLite, keyed by (location, start, end, model variant, data version).
+
+    The file is shared by all dashboard sessions and processes. When more than max_entries results are stored
+    the least recently used ones are removed.
+    """
+
+    def __init__(self, path=FIT_CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL;")
+            connection.execute("PRAGMA synchronous = NORMAL;")  # Losing the last few cached fits after a crash is fine
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS fit_cache (
+                location TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                model TEXT NOT NULL,
+                data_version TEXT NOT NULL,
+                result TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (location, start_date, end_date, model, data_version)
+            );
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_fit_cache_last_used ON fit_cache (last_used);")
+            self.local.connection = connection
+
+        return connection
+
+    def get(self, location, start_date, end_date, model, data_version):
+        key = (location, str(start_date), str(end_date), model, data_version)
+        connection = self.connection()
+
+        result = connection.execute("""
+        SELECT result FROM fit_cache
+        WHERE location = ? AND start_date = ? AND end_date = ? AND model = ? AND data_version = ?;
+        """, key).fetchone()
+
+        if result is None:
+            self.misses += 1
+            instrumentation.count("fit_cache_misses")
+            return None
+
+        self.hits += 1
+        instrumentation.count("fit_cache_hits")
+        connection.execute("""
+        UPDATE fit_cache SET last_used = ?
+        WHERE location = ? AND start_date = ? AND end_date = ? AND model = ? AND data_version = ?;
+        """, (time.time(), *key))
+
+        return json.loads(result[0])
+
+    def put(self, location, start_date, end_date, model, data_version, result):
+        connection = self.connection()
+
+        connection.execute("BEGIN IMMEDIATE;")
+        try:
+            connection.execute("""
+            INSERT OR REPLACE INTO fit_cache (location, start_date, end_date, model, data_version, result, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """, (location, str(start_date), str(end_date), model, data_version, json.dumps(result), time.time()))
+
+            # Evict the least recently used results
+            connection.execute("""
+            DELETE FROM fit_cache WHERE rowid IN (
+                SELECT rowid FROM fit_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            );
+            """, (self.max_entries,))
+            connection.execute("COMMIT;")
+        except Exception:
+            connection.execute("ROLLBACK;")
+            raise
+
+    @instrumentation.timed("fit_cache")
+    def get_or_fit(self, location, start_date, end_date, model, data_version, fit):
+        """Return the stored result, or call fit() and store what it returns."""
+        result = self.get(location, start_date, end_date, model, data_version)
+
+        if result is None:
+            result = fit()
+            self.put(location, start_date, end_date, model, data_version, result)
+
+        return result
+
+
+_fit_cache = None
+
+
+def get_fit_cache():
+    global _fit_cache
+
+    if _fit_cache is None:
+        _fit_cache = FitCache()
+
+    return _fit_cache
@@ -0,0 +1,190 @@
+import argparse
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import numpy as np
+import aggregation
+import fitting
+import query_database
+
+# beta and gamma are fitted with the SIR recurrence, alpha and mu of the SIRD model are estimated from the same window
+MODEL = "sird"
+
+# A location is fitted on the first FIT_DAYS days with active cases. S stays close to N in the recurrence, so over
+# a longer span it is a pure exponential that overflows from most starting points and can not bend like the data
+FIT_DAYS = 30
+STARTS = 4
+
+RESULT_COLUMNS = ["alpha", "beta", "gamma", "mu", "R0", "loss", "rmse", "r2", "success", "message", "iterations", "evaluations"]
+
+
+def create_fit_results_table(cursor):
+    # Province.State is an empty string for country level fits, so it can be part of the primary key
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fit_results (
+        level TEXT NOT NULL,
+        [WHO.Region] TEXT NOT NULL,
+        [Country.Region] TEXT NOT NULL,
+        [Province.State] TEXT NOT NULL DEFAULT '',
+        start_date TEXT NOT NULL,
+        end_date TEXT NOT NULL,
+        model TEXT NOT NULL,
+        data_version TEXT NOT NULL,
+        alpha REAL,
+        beta REAL,
+        gamma REAL,
+        mu REAL,
+        R0 REAL,
+        loss REAL,
+        rmse REAL,
+        r2 REAL,
+        success INTEGER,
+        message TEXT,
+        iterations INTEGER,
+        evaluations INTEGER,
+        fitted_at TEXT,
+        PRIMARY KEY (level, [WHO.Region], [Country.Region], [Province.State], start_date, end_date, model)
+    );
+    """)
+
+    # Tables of an older version only have the SIR parameters
+    cursor.execute("PRAGMA table_info(fit_results);")
+    existing = {row[1] for row in cursor.fetchall()}
+    for column in ("alpha", "mu"):
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE fit_results ADD COLUMN {column} REAL;")
+
+
+def location_slices(cube, levels, startdate=None, enddate=None):
+    """Yield (key, [day x metric] values, population) for every location, only the days inside the window.
+
+    The population is None when it is not known.
+    """
+    window = cube.day_window(startdate, enddate)
+
+    def population_of(country_position):
+        population = cube.country_population[country_position]
+        return None if np.isnan(population) else int(population)
+
+    if "country" in levels:
+        for (continent, country), position in cube.country_index.items():
+            present = cube.country_rows[position, window] > 0
+            yield ("country", continent, country, ""), cube.country[position, window][present], population_of(position)
+
+    if "province" in levels:
+        # complete.csv has no population per province, a province is fitted with the population of its country
+        for (continent, country, province), position in cube.province_index.items():
+            present = cube.province_rows[position, window] > 0
+            population = population_of(cube.country_of_leaf[position])
+            yield ("province", continent, country, province), cube.province[position, window][present], population
+
+
+def model_name(days):
+    """The model column of fit_results, fits with another version of fitting.py or another window are not reused."""
+    return f"{MODEL}-v{fitting.FIT_VERSION}" + (f"-{days}d" if days else "")
+
+
+def fit_shard(shard, days, fit_options):
+    """Runs in a worker process, fits every location of the shard. Only the arrays of these locations are sent to the worker."""
+    results = []
+    for key, values, population in shard:
+        if not population:
+            results.append((key, {"success": False, "message": "No population available for this location"}))
+            continue
+
+        # The recurrence can not grow from zero infected, so the fit starts at the first day with active cases
+        observed = values[:, 3]
+        first_day = int(np.argmax(observed > 0)) if len(observed) else 0
+        if len(observed) - first_day < 2 or observed[first_day] <= 0:
+            results.append((key, {"success": False, "message": "Not enough active cases to fit"}))
+            continue
+
+        values = values[first_day:first_day + days] if days else values[first_day:]
+        fit = fitting.fit_sir(values[:, 3], population - values[:, 0], population, **fit_options)
+        fit["alpha"], fit["mu"] = fitting.estimate_alpha_mu(values[:, 3], values[:, 2], values[:, 1], fit["gamma"])
+        results.append((key, fit))
+
+    return results
+
+
+def finished_locations(cursor, startdate, enddate, model, data_version):
+    cursor.execute("""
+    SELECT level, [WHO.Region], [Country.Region], [Province.State]
+    FROM fit_results
+    WHERE start_date = ? AND end_date = ? AND model = ? AND data_version = ?;
+    """, (startdate, enddate, model, data_version))
+    return set(cursor.fetchall())
+
+
+def store_results(cursor, results, startdate, enddate, model, data_version):
+    columns = ", ".join(RESULT_COLUMNS)
+    placeholders = ", ".join("?" for _ in RESULT_COLUMNS)
+    fitted_at = datetime.now().isoformat(timespec="seconds")
+
+    rows = []
+    for key, fit in results:
+        values = [fit.get(column) for column in RESULT_COLUMNS]
+        rows.append((*key, startdate, enddate, model, data_version, *values, fitted_at))
+
+    cursor.executemany(f"""
+    INSERT OR REPLACE INTO fit_results (level, [WHO.Region], [Country.Region], [Province.State], start_date, end_date, model, data_version, {columns}, fitted_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, {placeholders}, ?);
+    """, rows)
+
+
+def run_fits(levels=("country", "province"), startdate=None, enddate=None, workers=None, shard_size=8, resume=True,
+             database_path=query_database.DATABASE_PATH, days=FIT_DAYS, **fit_options):
+    """Fit every location of complete_data in parallel and stream the results into fit_results.
+
+    Every location is fitted on the first days (None for all) of the window from its first day with active cases.
+    With resume, locations that already have a result for the same window, model and data version are skipped,
+    so an interrupted run continues where it stopped. Returns the number of fitted locations.
+    """
+    fit_options.setdefault("starts", STARTS)
+    model = model_name(days)
+    cube = aggregation.get_cube()
+    data_startdate, data_enddate = cube.date_range()
+    startdate = max(startdate or data_startdate, data_startdate)
+    enddate = min(enddate or data_enddate, data_enddate)
+
+    connection = sqlite3.connect(database_path)
+    cursor = connection.cursor()
+    create_fit_results_table(cursor)
+    connection.commit()
+
+    done = finished_locations(cursor, startdate, enddate, model, cube.version) if resume else set()
+    pending = [location for location in location_slices(cube, levels, startdate, enddate) if location[0] not in done]
+    shards = [pending[position:position + shard_size] for position in range(0, len(pending), shard_size)]
+
+    fitted = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = [executor.submit(fit_shard, shard, days, fit_options) for shard in shards]
+
+            # Every finished shard is committed right away, an interrupted run loses at most the shards in flight
+            for future in as_completed(futures):
+                results = future.result()
+                store_results(cursor, results, startdate, enddate, model, cube.version)
+                connection.commit()
+                fitted += len(results)
+    finally:
+        connection.close()
+
+    return fitted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the SIRD model for every country and province in complete_data.")
+    parser.add_argument("--levels", nargs="+", default=["country", "province"], choices=["country", "province"])
+    parser.add_argument("--start", help="First day of the fit window (YYYY-MM-DD)")
+    parser.add_argument("--end", help="Last day of the fit window (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, help="Number of worker processes, defaults to the number of cores")
+    parser.add_argument("--shard-size", type=int, default=8, help="Locations sent to a worker at once")
+    parser.add_argument("--days", type=int, default=FIT_DAYS, help="Days fitted from the first day with active cases, 0 for the whole window")
+    parser.add_argument("--starts", type=int, default=STARTS, help="Number of multi-start initial guesses per fit")
+    parser.add_argument("--restart", action="store_true", help="Fit all locations again instead of resuming")
+    args = parser.parse_args()
+
+    fitted = run_fits(args.levels, args.start, args.end, args.workers, args.shard_size, not args.restart, days=args.days or None, starts=args.starts)
+    print(f"fit_results: {fitted} locations fitted")
@@ -0,0 +1,179 @@
+import numpy as np
+from scipy.optimize import minimize
+import instrumentation
+
+# Bounds and initial guess used by the SIR Model tab
+DEFAULT_BOUNDS = ((0.001, 10), (0.001, 10))
+DEFAULT_GUESS = (0.3, 0.1)
+
+# Part of the key of stored fits, version 2 judges success by the quality of the fit instead of the optimizer
+FIT_VERSION = 2
+
+
+def predict_infected(beta, gamma, I0, susceptible_share):
+    """Infected according to I[t] = I[t-1] + beta * S[t-1] * I[t-1] / N - gamma * I[t-1].
+
+    susceptible_share is S / N for every day. The recurrence is a running product of the daily growth factors,
+    so the whole trajectory is computed with a single cumprod. Returns the trajectory and the growth factors.
+    """
+    factors = 1 + beta * susceptible_share[:-1] - gamma
+
+    infected = np.empty(len(susceptible_share), dtype=np.float64)
+    infected[0] = I0
+    infected[1:] = I0 * np.cumprod(factors)
+
+    return infected, factors
+
+
+def infected_sensitivities(infected, factors, susceptible_share):
+    """Exact derivatives of every I[t] with respect to beta and gamma (forward mode).
+
+    Differentiating the recurrence gives dI[t] = factor[t-1] * dI[t-1] + I[t-1] * dfactor[t-1].
+    """
+    d_beta = np.zeros_like(infected)
+    d_gamma = np.zeros_like(infected)
+
+    if np.all(factors != 0):
+        # Closed form of the recurrence: dI[t] = I[t] * sum over k < t of dfactor[k] / factor[k]
+        d_beta[1:] = infected[1:] * np.cumsum(susceptible_share[:-1] / factors)
+        d_gamma[1:] = infected[1:] * np.cumsum(-1 / factors)
+        return d_beta, d_gamma
+
+    for t in range(1, len(infected)):
+        d_beta[t] = factors[t - 1] * d_beta[t - 1] + infected[t - 1] * susceptible_share[t - 1]
+        d_gamma[t] = factors[t - 1] * d_gamma[t - 1] - infected[t - 1]
+
+    return d_beta, d_gamma
+
+
+def loss_and_gradient(params, observed, I0, susceptible_share, scale=1.0):
+    """Sum of squared errors between the predicted and the observed infected, together with its exact gradient.
+
+    Both are divided by scale, which keeps the optimizer away from its stopping tolerances for large counts.
+    """
+    beta, gamma = params
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        infected, factors = predict_infected(beta, gamma, I0, susceptible_share)
+        residuals = infected - observed
+        loss = np.sum(residuals ** 2)
+
+        if not np.isfinite(loss):
+            return np.inf, np.zeros(2)
+
+        d_beta, d_gamma = infected_sensitivities(infected, factors, susceptible_share)
+        gradient = 2 * np.array([np.dot(residuals, d_beta), np.dot(residuals, d_gamma)])
+
+    return loss / scale, gradient / scale
+
+
+def start_points(initial_guess, bounds, starts, seed):
+    """The initial guess followed by random points that are log-uniformly spread over the bounds."""
+    points = [np.asarray(initial_guess, dtype=np.float64)]
+
+    rng = np.random.default_rng(seed)
+    low = np.log([max(bound[0], 1e-6) for bound in bounds])
+    high = np.log([bound[1] for bound in bounds])
+    for _ in range(starts - 1):
+        points.append(np.exp(rng.uniform(low, high)))
+
+    return points
+
+
+@instrumentation.timed()
+def fit_failure(loss, r2, moved, I0):
+    """Why a fit does not describe the data, None for a usable fit."""
+    if I0 <= 0:
+        return "No infected at the start of the window"
+    if not np.isfinite(loss):
+        return "The model overflows for every starting point"
+    if not moved:
+        return "The parameters did not move from the initial guess"
+    if not r2 > 0:
+        return "The fit explains the data worse than its mean (r2 <= 0)"
+    return None
+
+
+def fit_sir(observed, susceptible, N, I0=None, initial_guess=DEFAULT_GUESS, bounds=DEFAULT_BOUNDS, warm_start=None, starts=1, seed=0):
+    """Fit beta and gamma of the SIR recurrence to the observed infected.
+
+    susceptible is the S trajectory used in the recurrence and N the population. warm_start can be the result
+    of a previous fit, its estimate is used as the first initial guess. With starts > 1 the fit is repeated from
+    random starting points and the best result is kept. Returns the estimates together with fit diagnostics.
+    success means the optimizer converged to a fit that explains the data (finite loss, r2 > 0, parameters that
+    moved off their starting point), converged only reports the optimizer.
+    """
+    observed = np.asarray(observed, dtype=np.float64)
+    susceptible_share = np.asarray(susceptible, dtype=np.float64) / N
+    I0 = observed[0] if I0 is None else float(I0)
+
+    if warm_start is not None and warm_start.get("success"):
+        initial_guess = (warm_start["beta"], warm_start["gamma"])
+
+    scale = max(np.sum(observed ** 2), 1.0)
+
+    best, best_start = None, None
+    evaluations = 0
+    for start in start_points(initial_guess, bounds, starts, seed):
+        result = minimize(loss_and_gradient, start, args=(observed, I0, susceptible_share, scale), jac=True, method="L-BFGS-B", bounds=bounds)
+        evaluations += result.nfev
+
+        if best is None or (result.success, -result.fun) > (best.success, -best.fun):
+            best, best_start = result, start
+
+    beta, gamma = best.x
+    with np.errstate(over="ignore", invalid="ignore"):
+        infected, _ = predict_infected(beta, gamma, I0, susceptible_share)
+        residuals = infected - observed
+        total_sum_of_squares = np.sum((observed - observed.mean()) ** 2)
+        r2 = float(1 - np.sum(residuals ** 2) / total_sum_of_squares) if total_sum_of_squares > 0 else np.nan
+
+    # L-BFGS-B also reports convergence when the loss is too large to improve or every gradient is zero
+    failure = fit_failure(best.fun, r2, not np.allclose(best.x, best_start), I0)
+
+    return {
+        "beta": float(beta),
+        "gamma": float(gamma),
+        "R0": float(beta / gamma),
+        "loss": float(best.fun * scale),
+        "rmse": float(np.sqrt(np.mean(residuals ** 2))),
+        "r2": r2,
+        "success": bool(best.success) and failure is None,
+        "converged": bool(best.success),
+        "message": str(best.message) if failure is None else f"{failure}, {best.message}",
+        "iterations": int(best.nit),
+        "evaluations": int(evaluations),
+        "starts": int(starts),
+    }
+
+
+def estimate_alpha_mu(active, recovered, deaths, gamma):
+    """Reinfection rate alpha and death rate mu, with the closed forms of partThree.estimate_parameters.
+
+    mu = new deaths / active and alpha = (gamma * active - new recovered) / recovered, with the values of the day
+    before. The days of the window are pooled, so both are ratios of sums. NaN without active or recovered cases.
+    """
+    active = np.asarray(active, dtype=np.float64)
+    recovered = np.asarray(recovered, dtype=np.float64)
+    deaths = np.asarray(deaths, dtype=np.float64)
+
+    previous_active = active[:-1].sum()
+    previous_recovered = recovered[:-1].sum()
+    new_recovered = recovered[-1] - recovered[0] if len(recovered) else 0.0
+    new_deaths = deaths[-1] - deaths[0] if len(deaths) else 0.0
+
+    mu = new_deaths / previous_active if previous_active > 0 else np.nan
+    alpha = (gamma * previous_active - new_recovered) / previous_recovered if previous_recovered > 0 else np.nan
+
+    return float(alpha), float(mu)
+
+
+def fit_location(df, **kwargs):
+    """Fit a frame of createDataFrameOverTime / AggregationCube.series.
+
+    The observed infected are the active cases and the susceptible are the population minus all confirmed cases.
+    """
+    population = float(df["Population"].iloc[0])
+    susceptible = population - df["Total_Confirmed_Cases"].to_numpy(dtype=np.float64)
+
+    return fit_sir(df["Total_Active_Cases"], susceptible, population, **kwargs)
@@ -0,0 +1,494 @@
+import argparse
+import sqlite3
+from datetime import datetime
+import pandas as pd
+import aggregation
+import instrumentation
+import map_payloads
+import query_database
+import snapshot
+
+# Column order of complete.csv, the complete_data view has the same columns
+COMPLETE_COLUMNS = ["Province.State", "Country.Region", "Lat", "Long", "Date", "Confirmed", "Deaths", "Recovered", "Active", "WHO.Region"]
+VALUE_COLUMNS = ["Lat", "Long", "Confirmed", "Deaths", "Recovered", "Active"]
+LOCATION_COLUMNS = ["WHO.Region", "Country.Region", "Province.State"]
+COUNT_COLUMNS = ["Confirmed", "Deaths", "Recovered", "Active"]
+# Columns of complete_facts, the location is the location_id of the location table
+FACT_COLUMNS = ["Day", "location_id"] + COUNT_COLUMNS
+
+# Rows of a delta file that are read at once
+DELTA_CHUNK_SIZE = 50000
+
+
+def quote(column):
+    return f"[{column}]"
+
+
+def create_schema(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """)
+
+    # complete_data used to be a table. Tables written by an older version with DataFrame.to_sql have no primary
+    # key and are rebuilt, the rows of the other layouts are moved to the tables below
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'complete_data';")
+    result = cursor.fetchone()
+    if result and "PRIMARY KEY" not in result[0]:
+        cursor.execute("DROP TABLE complete_data;")
+    elif result:
+        cursor.execute("ALTER TABLE complete_data RENAME TO complete_data_old;")
+
+    # Every (WHO region, country, province) is stored once and referred to by its location_id. Province.State is
+    # an empty string instead of NULL so it can be part of the unique key. Alias is the name of the country in the
+    # worldometer dataset when it differs, Population is the population of the country.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS location (
+        location_id INTEGER PRIMARY KEY,
+        [WHO.Region] TEXT NOT NULL,
+        [Country.Region] TEXT NOT NULL,
+        [Province.State] TEXT NOT NULL DEFAULT '',
+        [Alias] TEXT,
+        [Lat] REAL,
+        [Long] REAL,
+        [Population] INTEGER,
+        UNIQUE ([WHO.Region], [Country.Region], [Province.State])
+    );
+    """)
+
+    # Day is the date as the number of days since 1970-01-01. The primary key starts with it, so the rows are
+    # stored clustered by day and a date window is one contiguous range of the table.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS complete_facts (
+        [Day] INTEGER NOT NULL,
+        location_id INTEGER NOT NULL REFERENCES location (location_id),
+        [Confirmed] INTEGER NOT NULL DEFAULT 0,
+        [Deaths] INTEGER NOT NULL DEFAULT 0,
+        [Recovered] INTEGER NOT NULL DEFAULT 0,
+        [Active] INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY ([Day], location_id)
+    ) WITHOUT ROWID;
+    """)
+
+    # Covering index for the queries per location in query_database, a window of days of one location is a range
+    # of it and the table itself is never touched
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_complete_facts_location_day ON complete_facts (location_id, [Day], [Confirmed], [Deaths], [Recovered], [Active]);")
+
+    # complete_data with the columns of complete.csv, for queries that were written against the old table
+    cursor.execute("""
+    CREATE VIEW IF NOT EXISTS complete_data AS
+    SELECT l.[Province.State], l.[Country.Region], l.[Lat], l.[Long], DATE(f.[Day] * 86400, 'unixepoch') AS [Date],
+           f.[Confirmed], f.[Deaths], f.[Recovered], f.[Active], l.[WHO.Region], f.[Day]
+    FROM complete_facts f
+    JOIN location l ON l.location_id = f.location_id;
+    """)
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'complete_data_old';")
+    if cursor.fetchone():
+        migrate_complete_data(cursor)
+
+
+def migrate_complete_data(cursor):
+    """Move the rows of a complete_data table of an older version into location and complete_facts."""
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'complete_data_old';")
+    # 2440587.5 is the julian day of 1970-01-01, the oldest tables only have the date as text
+    day = "o.[Day]" if "[Day]" in cursor.fetchone()[0] else "CAST(julianday(o.[Date]) - 2440587.5 AS INTEGER)"
+
+    cursor.execute("""
+    INSERT OR IGNORE INTO location ([WHO.Region], [Country.Region], [Province.State], [Lat], [Long])
+    SELECT [WHO.Region], [Country.Region], COALESCE([Province.State], ''), MAX([Lat]), MAX([Long])
+    FROM complete_data_old
+    GROUP BY [WHO.Region], [Country.Region], COALESCE([Province.State], '');
+    """)
+    counts = ", ".join(f"COALESCE(o.{quote(column)}, 0)" for column in COUNT_COLUMNS)
+    cursor.execute(f"""
+    INSERT OR REPLACE INTO complete_facts ({", ".join(quote(column) for column in FACT_COLUMNS)})
+    SELECT {day}, l.location_id, {counts}
+    FROM complete_data_old o
+    JOIN location l ON l.[WHO.Region] = o.[WHO.Region] AND l.[Country.Region] = o.[Country.Region]
+                   AND l.[Province.State] = COALESCE(o.[Province.State], '');
+    """)
+    cursor.execute("DROP TABLE complete_data_old;")
+    update_location_populations(cursor)
+
+    cursor.execute("SELECT MIN([Day]), MAX([Day]) FROM complete_facts;")
+    first_day, last_day = cursor.fetchone()
+    if first_day is not None:
+        update_date_bounds(cursor, first_day, last_day)
+
+
+def update_location_populations(cursor):
+    """Store the worldometer name and the population of every country in the location table."""
+    try:
+        resolver = query_database.PopulationResolver(cursor)
+    except sqlite3.OperationalError:  # worldometer_data does not exist (yet)
+        return
+
+    cursor.execute("SELECT DISTINCT [Country.Region] FROM location;")
+    rows = []
+    for (country,) in cursor.fetchall():
+        alias = resolver.to_worldometer(country)
+        rows.append((alias if alias != country else None, resolver.population(country), country))
+
+    # Only rows whose values differ are written, usually none of them
+    cursor.executemany("""
+    UPDATE location SET [Alias] = ?1, [Population] = ?2
+    WHERE [Country.Region] = ?3 AND ([Alias] IS NOT ?1 OR [Population] IS NOT ?2);
+    """, rows)
+
+
+def update_date_bounds(cursor, first_day, last_day):
+    """Widen the first and last day of complete_data stored in the metadata table, date_ranges reads them from there."""
+    stored_first = get_metadata(cursor, "complete_first_day")
+    stored_last = get_metadata(cursor, "complete_last_day")
+
+    first_day = int(first_day) if stored_first is None else min(int(first_day), int(stored_first))
+    last_day = int(last_day) if stored_last is None else max(int(last_day), int(stored_last))
+
+    set_metadata(cursor, "complete_first_day", first_day)
+    set_metadata(cursor, "complete_last_day", last_day)
+
+
+def get_metadata(cursor, key):
+    cursor.execute("SELECT value FROM metadata WHERE key = ?;", (key,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+
+def set_metadata(cursor, key, value):
+    cursor.execute("""
+    INSERT INTO metadata (key, value) VALUES (?, ?)
+    ON CONFLICT (key) DO UPDATE SET value = excluded.value;
+    """, (key, str(value)))
+
+
+def upsert_locations(cursor, df):
+    """Add new locations of the frame and update the coordinates of known ones. Returns the location_id of every row."""
+    locations = df.drop_duplicates(LOCATION_COLUMNS, keep="last")
+    cursor.executemany("""
+    INSERT INTO location ([WHO.Region], [Country.Region], [Province.State], [Lat], [Long])
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT ([WHO.Region], [Country.Region], [Province.State])
+    DO UPDATE SET [Lat] = excluded.[Lat], [Long] = excluded.[Long]
+    WHERE location.[Lat] IS NOT excluded.[Lat] OR location.[Long] IS NOT excluded.[Long];
+    """, list(zip(*(locations[column].tolist() for column in LOCATION_COLUMNS + ["Lat", "Long"]))))
+
+    cursor.execute("SELECT location_id, [WHO.Region], [Country.Region], [Province.State] FROM location;")
+    ids = pd.DataFrame(cursor.fetchall(), columns=["location_id"] + LOCATION_COLUMNS)
+
+    return df[LOCATION_COLUMNS].merge(ids, on=LOCATION_COLUMNS, how="left")["location_id"].to_numpy()
+
+
+def complete_rows(cursor, df):
+    """Turn the complete.csv frame into plain python tuples in the column order of complete_facts.
+
+    The locations of the frame are added to the location table first.
+    """
+    df = df.copy()
+    df["Province.State"] = df["Province.State"].fillna("")
+    df["location_id"] = upsert_locations(cursor, df)
+    df["Day"] = snapshot.date_to_day(df["Date"])
+
+    # tolist() converts the numpy scalars to python values which sqlite3 can bind
+    return list(zip(*(df[column].tolist() for column in FACT_COLUMNS)))
+
+
+def upsert_complete_rows(cursor, rows):
+    """Insert new days and update changed ones, rows that did not change are left untouched."""
+    columns = ", ".join(quote(column) for column in FACT_COLUMNS)
+    placeholders = ", ".join("?" for _ in FACT_COLUMNS)
+    updates = ", ".join(f"{quote(column)} = excluded.{quote(column)}" for column in COUNT_COLUMNS)
+    changed = " OR ".join(f"complete_facts.{quote(column)} IS NOT excluded.{quote(column)}" for column in COUNT_COLUMNS)
+
+    query = f"""
+    INSERT INTO complete_facts ({columns})
+    VALUES ({placeholders})
+    ON CONFLICT ([Day], location_id)
+    DO UPDATE SET {updates}
+    WHERE {changed};
+    """
+    cursor.executemany(query, rows)
+
+
+@instrumentation.timed()
+def ingest_complete(database_path=query_database.DATABASE_PATH, force=False):
+    """Load the complete.csv snapshot into complete_data. Returns the number of inserted or updated rows."""
+    manifest = snapshot.ensure_snapshot("complete")
+
+    connection = sqlite3.connect(database_path)
+    connection.execute("PRAGMA journal_mode = WAL;")  # Readers are not blocked while the ingest runs
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE;")
+        create_schema(cursor)
+
+        if not force and get_metadata(cursor, "complete_sha256") == manifest["sha256"]:
+            connection.commit()  # create_schema may have moved an older table to the current layout
+            return 0
+
+        df = snapshot.load_complete(categorical=False)
+        rows = complete_rows(cursor, df)
+        changes_before = connection.total_changes
+        upsert_complete_rows(cursor, rows)
+        changed_rows = connection.total_changes - changes_before
+        update_location_populations(cursor)
+
+        if len(df):
+            update_date_bounds(cursor, *snapshot.date_to_day([df["Date"].min(), df["Date"].max()]))
+
+        set_metadata(cursor, "complete_sha256", manifest["sha256"])
+        set_metadata(cursor, "complete_ingested_at", datetime.now().isoformat(timespec="seconds"))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    # The cached populations per WHO region are based on the countries in complete_data
+    query_database.clear_population_resolvers()
+
+    return changed_rows
+
+
+def create_county_rollup_schema(cursor):
+    # Totals over all days of usa_county_wise, per county and per state
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS county_totals (
+        Admin2 TEXT NOT NULL,
+        Province_State TEXT NOT NULL,
+        Confirmed INTEGER NOT NULL DEFAULT 0,
+        Deaths INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (Province_State, Admin2)
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS state_totals (
+        Province_State TEXT PRIMARY KEY,
+        Confirmed INTEGER NOT NULL DEFAULT 0,
+        Deaths INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+
+    # The top K counties and states are the first K entries of these indexes, so a top K query reads only K rows
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_county_totals_confirmed ON county_totals (Confirmed DESC, Province_State, Admin2);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_county_totals_deaths ON county_totals (Deaths DESC, Province_State, Admin2);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_state_totals_confirmed ON state_totals (Confirmed DESC, Province_State);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_state_totals_deaths ON state_totals (Deaths DESC, Province_State);")
+
+
+def add_county_rows(cursor, after_rowid):
+    """Add the usa_county_wise rows after after_rowid to the county and state totals."""
+    for table, key in (("county_totals", "Admin2, Province_State"), ("state_totals", "Province_State")):
+        # WHERE true is needed for SQLite to parse the ON CONFLICT clause after a SELECT
+        cursor.execute(f"""
+        INSERT INTO {table} ({key}, Confirmed, Deaths)
+        SELECT {key}, SUM(COALESCE(Confirmed, 0)), SUM(COALESCE(Deaths, 0))
+        FROM (SELECT COALESCE(Admin2, '') AS Admin2, COALESCE(Province_State, '') AS Province_State, Confirmed, Deaths
+              FROM usa_county_wise WHERE rowid > ?)
+        WHERE true
+        GROUP BY {key}
+        ON CONFLICT ({key}) DO UPDATE SET
+            Confirmed = Confirmed + excluded.Confirmed,
+            Deaths = Deaths + excluded.Deaths;
+        """, (after_rowid,))
+
+
+@instrumentation.timed()
+def update_county_rollups(database_path=query_database.DATABASE_PATH, force=False):
+    """Bring county_totals and state_totals up to date with usa_county_wise. Returns the number of rows added.
+
+    usa_county_wise is only appended to, so normally only the rows after the last processed rowid are added to the
+    totals. When rows were removed or the table was replaced the totals are computed again from scratch.
+    """
+    connection = sqlite3.connect(database_path)
+    connection.execute("PRAGMA journal_mode = WAL;")
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE;")
+        create_schema(cursor)
+        create_county_rollup_schema(cursor)
+
+        cursor.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM usa_county_wise;")
+        row_count, last_rowid = cursor.fetchone()
+        done_rows = int(get_metadata(cursor, "county_rows") or 0)
+        done_rowid = int(get_metadata(cursor, "county_rowid") or 0)
+
+        cursor.execute("SELECT COUNT(*) FROM usa_county_wise WHERE rowid > ?;", (done_rowid,))
+        new_rows = cursor.fetchone()[0]
+
+        if force or last_rowid < done_rowid or row_count != done_rows + new_rows:
+            cursor.execute("DELETE FROM county_totals;")
+            cursor.execute("DELETE FROM state_totals;")
+            done_rowid = 0
+            new_rows = row_count
+
+        if new_rows:
+            add_county_rows(cursor, done_rowid)
+            set_metadata(cursor, "county_rows", row_count)
+            set_metadata(cursor, "county_rowid", last_rowid)
+
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    return new_rows
+
+
+def county_rollups_behind(database_path=query_database.DATABASE_PATH):
+    """Check with a read-only connection whether usa_county_wise has rows that are not in the totals yet."""
+    try:
+        with query_database.connection(database_path) as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM usa_county_wise;")
+            row_count, last_rowid = cursor.fetchone()
+            return (str(row_count), str(last_rowid)) != (get_metadata(cursor, "county_rows"), get_metadata(cursor, "county_rowid"))
+    except sqlite3.OperationalError:  # the metadata table does not exist yet
+        return True
+
+
+def county_version(database_path=query_database.DATABASE_PATH):
+    """Identifier of the rows in the county rollups, usable as a cache key. It changes with every rollup update.
+    None when the rollups were not built yet."""
+    try:
+        with query_database.connection(database_path) as connection:
+            cursor = connection.cursor()
+            rows, rowid = get_metadata(cursor, "county_rows"), get_metadata(cursor, "county_rowid")
+            return None if rows is None else f"{rows}:{rowid}"
+    except sqlite3.OperationalError:  # the metadata table does not exist yet
+        return None
+
+
+def read_delta(path, chunksize=DELTA_CHUNK_SIZE):
+    """Read a delta file (.csv or .jsonl in the complete.csv schema) in chunks of rows."""
+    if path.endswith((".jsonl", ".json")):
+        return pd.read_json(path, lines=True, chunksize=chunksize, dtype=False)
+    return pd.read_csv(path, chunksize=chunksize)
+
+
+def validate_delta(chunk, path):
+    """Check a chunk of a delta file and bring it into the form of the complete.csv snapshot."""
+    missing = [column for column in COMPLETE_COLUMNS if column not in chunk]
+    if missing:
+        raise ValueError(f"{path}: missing columns {', '.join(missing)}")
+
+    chunk = chunk[COMPLETE_COLUMNS].copy()
+    chunk["Province.State"] = chunk["Province.State"].where(chunk["Province.State"] != "")  # missing, like in complete.csv
+    chunk["Date"] = pd.to_datetime(chunk["Date"], errors="coerce")
+    for column in VALUE_COLUMNS:
+        chunk[column] = pd.to_numeric(chunk[column], errors="coerce")
+    chunk[snapshot.COUNT_COLUMNS] = chunk[snapshot.COUNT_COLUMNS].fillna(0)
+
+    invalid = chunk["Date"].isna() | chunk["Country.Region"].isna() | chunk["WHO.Region"].isna()
+    if invalid.any():
+        raise ValueError(f"{path}: {int(invalid.sum())} rows without a valid Date, Country.Region or WHO.Region")
+
+    return chunk
+
+
+def append_deltas(paths, database_path=query_database.DATABASE_PATH, chunksize=DELTA_CHUNK_SIZE):
+    """Add daily delta files to complete_data, the snapshot, the aggregation cube and the map payloads.
+
+    Every file is streamed in chunks and committed as a whole. Rows with the key of an existing row replace it.
+    Files that were appended before (same content) are skipped. The work only depends on the size of the deltas,
+    complete.csv is not read again. Returns the number of inserted or updated rows.
+    """
+    changed_rows = 0
+
+    for path in paths:
+        sha256 = snapshot.file_hash(path)
+
+        connection = sqlite3.connect(database_path)
+        connection.execute("PRAGMA journal_mode = WAL;")
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE;")
+            create_schema(cursor)
+
+            if get_metadata(cursor, f"delta_{sha256}"):
+                connection.rollback()
+                continue
+
+            chunks = []
+            file_changed_rows = 0
+            for chunk in read_delta(path, chunksize):
+                chunk = validate_delta(chunk, path)
+                rows = complete_rows(cursor, chunk)
+                # Only the fact rows are counted, not the locations, populations and metadata written next to them
+                changes_before = connection.total_changes
+                upsert_complete_rows(cursor, rows)
+                file_changed_rows += connection.total_changes - changes_before
+                if len(chunk):
+                    update_date_bounds(cursor, *snapshot.date_to_day([chunk["Date"].min(), chunk["Date"].max()]))
+                chunks.append(chunk)
+
+            # The last row of a key wins, within the file just like against the existing rows
+            delta = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=COMPLETE_COLUMNS)
+            delta = delta.drop_duplicates(snapshot.KEY_COLUMNS, keep="last")
+            update_location_populations(cursor)
+
+            previous_version = snapshot.snapshot_version("complete")
+            manifest = snapshot.append_delta("complete", delta, sha256)
+
+            set_metadata(cursor, f"delta_{sha256}", datetime.now().isoformat(timespec="seconds"))
+            connection.commit()
+            changed_rows += file_changed_rows
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+        aggregation.apply_delta(delta, previous_version, snapshot.manifest_version(manifest))
+
+    query_database.clear_population_resolvers()
+    map_payloads.ensure_payloads()
+
+    return changed_rows
+
+
+def needs_ingest(database_path=query_database.DATABASE_PATH):
+    """Check with a read-only connection whether complete_data is behind the complete.csv snapshot."""
+    manifest = snapshot.ensure_snapshot("complete")
+
+    try:
+        with query_database.connection(database_path) as connection:
+            cursor = connection.cursor()
+
+            # complete_data is a table in databases of an older version, its rows still have to be moved
+            cursor.execute("SELECT type FROM sqlite_master WHERE name = 'complete_data';")
+            result = cursor.fetchone()
+            if result is None or result[0] != "view":
+                return True
+
+            return get_metadata(cursor, "complete_sha256") != manifest["sha256"]
+    except sqlite3.OperationalError:  # the database or the metadata table does not exist yet
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load complete.csv into the database, or append daily delta files.")
+    parser.add_argument("--append", nargs="+", metavar="FILE", help="Delta files (.csv or .jsonl) in the complete.csv schema")
+    parser.add_argument("--chunk-size", type=int, default=DELTA_CHUNK_SIZE, help="Rows of a delta file that are read at once")
+    args = parser.parse_args()
+
+    if args.append:
+        changed_rows = append_deltas(args.append, chunksize=args.chunk_size)
+        print(f"complete_data: {changed_rows} rows inserted or updated from {len(args.append)} delta files")
+    else:
+        changed_rows = ingest_complete()
+        print(f"complete_data: {changed_rows} rows inserted or updated")
+
+        added_rows = update_county_rollups()
+        print(f"county_totals: {added_rows} usa_county_wise rows added")
+
+        map_payloads.ensure_payloads()
+        print(f"map payloads: {map_payloads.MAP_DIRECTORY}")
@@ -0,0 +1,272 @@
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+import query_database
+
+# Timings of the query, estimation, simulation and plotting steps. Set COVID_TRACE to a .jsonl or a .db file to
+# record every run of the dashboard into it, or switch the timings on for one session in the sidebar. When it is
+# off a decorated function only costs one extra function call and a check of a global.
+TRACE_PATH = os.environ.get("COVID_TRACE")
+ENABLED = bool(TRACE_PATH)
+
+class _State(threading.local):
+    # Every thread starts with these, a missing attribute would make the disabled check slow
+    def __init__(self):
+        self.enabled = ENABLED
+        self.run = None
+        self.stack = []
+        self.records = []
+
+
+_local = _State()
+# True once any thread switched the timings on, until then the decorators only check this global
+_active = ENABLED
+_export_lock = threading.Lock()
+
+
+def is_enabled():
+    return _active and _local.enabled
+
+
+def start_run(enabled=None, label=None):
+    """Start collecting the records of one run (one rerun of the dashboard) in the current thread."""
+    global _active
+
+    _local.enabled = ENABLED if enabled is None else enabled
+    _active = _active or _local.enabled
+    new_run(label)
+
+
+def new_run(label=None):
+    _local.stack = []
+    _local.records = []
+    _local.run = {
+        "run": uuid.uuid4().hex[:12],
+        "label": label,
+        "started_at": datetime.now().isoformat(timespec="milliseconds"),
+        "start": time.perf_counter(),
+    }
+
+
+def finish_run():
+    """Stop collecting, returns the records of the run and writes them to TRACE_PATH when it is set."""
+    records, run = _local.records, _local.run or {}
+    _local.run = None
+    _local.records = []
+
+    if records and TRACE_PATH:
+        export(records, TRACE_PATH, run)
+
+    return records
+
+
+def result_rows(result):
+    """Number of rows of a DataFrame, array or list, None for anything else."""
+    shape = getattr(result, "shape", None)
+    if shape:
+        return int(shape[0])
+    if isinstance(result, list):
+        return len(result)
+    return None
+
+
+class Span:
+    """Times a block, counts the SQL statements the thread executed in it and collects counters."""
+
+    def __init__(self, name, cache=False):
+        self.name = name
+        self.cache = cache
+        self.rows = None
+        self.counters = {}
+
+    def __enter__(self):
+        # A span outside of start_run / finish_run is collected in a run of its own, which ends with the span
+        self.own_run = _local.run is None
+        if self.own_run:
+            new_run()
+
+        self.depth = len(_local.stack)
+        self.ran_inside = False
+        _local.stack.append(self)
+
+        self.statements = query_database.thread_statements()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        statements = query_database.thread_statements() - self.statements
+        _local.stack.pop()
+
+        record = {
+            "run": _local.run["run"],
+            "name": self.name,
+            "depth": self.depth,
+            "start": self.start - _local.run["start"],
+            "seconds": seconds,
+            "rows": self.rows,
+            "statements": statements,
+            "counters": self.counters,
+        }
+
+        # A cached call is a hit when the function behind the cache did not run
+        if self.cache:
+            record["cache"] = "miss" if self.ran_inside else "hit"
+        elif _local.stack and _local.stack[-1].name == self.name:
+            _local.stack[-1].ran_inside = True
+            record["inside_cache"] = _local.stack[-1].cache
+
+        _local.records.append(record)
+
+        # Otherwise the records of the services and scripts that never call finish_run would grow without bound
+        if self.own_run:
+            finish_run()
+        return False
+
+
+class _NoSpan:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name, cache=False):
+    """Context manager around a block: `with instrumentation.span("simulate_sird"):`"""
+    return Span(name, cache) if is_enabled() else _no_span
+
+
+def timed(name=None, cache=False):
+    """Decorator that records every call of the function as a span, with the rows of its result."""
+    def decorator(function):
+        label = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not (_active and _local.enabled):
+                return function(*args, **kwargs)
+
+            with Span(label, cache) as current:
+                result = function(*args, **kwargs)
+                current.rows = result_rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def cached(cache, name=None):
+    """Put a cache decorator (e.g. st.cache_data) between two spans, so every call is recorded as a hit or a miss."""
+    def decorator(function):
+        label = name or function.__name__
+        return timed(label, cache=True)(cache(timed(label)(function)))
+
+    return decorator
+
+
+def count(name, value=1):
+    """Add to a counter of the innermost open span, e.g. count("chart_cache_hits")."""
+    if _active and _local.enabled and _local.stack:
+        counters = _local.stack[-1].counters
+        counters[name] = counters.get(name, 0) + value
+
+
+def summary(records):
+    """One row per span name with the number of calls, the total and maximum time and the summed counts."""
+    rows = {}
+    counters = set()
+    for record in records:
+        # The call behind a cache is already part of the cached call around it
+        if record.get("inside_cache"):
+            continue
+
+        row = rows.setdefault(record["name"], {
+            "name": record["name"], "calls": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0, "statements": 0,
+            "cache_hits": 0, "cache_misses": 0,
+        })
+        row["calls"] += 1
+        row["seconds"] += record["seconds"]
+        row["max_seconds"] = max(row["max_seconds"], record["seconds"])
+        row["rows"] += record["rows"] or 0
+        row["statements"] += record["statements"]
+
+        if record.get("cache") == "hit":
+            row["cache_hits"] += 1
+        elif record.get("cache") == "miss":
+            row["cache_misses"] += 1
+        for counter, value in record["counters"].items():
+            row[counter] = row.get(counter, 0) + value
+            counters.add(counter)
+
+    for row in rows.values():
+        for counter in sorted(counters):
+            row.setdefault(counter, 0)
+
+    return sorted(rows.values(), key=lambda row: row["seconds"], reverse=True)
+
+
+def run_totals(records):
+    """Wall time and SQL statements of the outermost spans, nested spans are already part of them."""
+    outer = [record for record in records if record["depth"] == 0]
+    return {
+        "spans": len(records),
+        "seconds": sum(record["seconds"] for record in outer),
+        "statements": sum(record["statements"] for record in outer),
+    }
+
+
+def export(records, path=None, run=None):
+    """Append records to a trace file, SQLite when the name ends in .db or .sqlite and JSON lines otherwise."""
+    path = path or TRACE_PATH
+    run = run or {}
+
+    with _export_lock:
+        if path.endswith((".db", ".sqlite")):
+            export_sqlite(records, path, run)
+        else:
+            with open(path, "a") as file:
+                for record in records:
+                    file.write(json.dumps(dict(record, started_at=run.get("started_at"), label=run.get("label"))) + "\n")
+
+
+def export_sqlite(records, path, run):
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        connection.execute("""
+        CREATE TABLE IF NOT EXISTS trace (
+            run TEXT NOT NULL,
+            started_at TEXT,
+            label TEXT,
+            name TEXT NOT NULL,
+            depth INTEGER NOT NULL,
+            start REAL NOT NULL,
+            seconds REAL NOT NULL,
+            rows INTEGER,
+            statements INTEGER NOT NULL,
+            cache TEXT,
+            counters TEXT
+        );
+        """)
+        connection.executemany(
+            "INSERT INTO trace VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            [
+                (record["run"], run.get("started_at"), run.get("label"), record["name"], record["depth"], record["start"],
+                 record["seconds"], record["rows"], record["statements"], record.get("cache"), json.dumps(record["counters"]))
+                for record in records
+            ],
+        )
+        connection.commit()
+    finally:
+        connection.close()
@@ -0,0 +1,250 @@
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import aggregation
+import snapshot
+
+# Active cases per country and day for the choropleth maps, stored next to the csv snapshots
+MAP_DIRECTORY = os.path.join(snapshot.SNAPSHOT_DIRECTORY, "map")
+
+# ISO 3166-1 alpha-3 code of every country in complete.csv. With ISO codes plotly does not have to match the
+# names against its list of country names. Countries that are not in here are drawn by name.
+ISO_CODES = {
+    'Afghanistan': 'AFG', 'Albania': 'ALB', 'Algeria': 'DZA', 'Andorra': 'AND', 'Angola': 'AGO',
+    'Antigua and Barbuda': 'ATG', 'Argentina': 'ARG', 'Armenia': 'ARM', 'Australia': 'AUS', 'Austria': 'AUT',
+    'Azerbaijan': 'AZE', 'Bahamas': 'BHS', 'Bahrain': 'BHR', 'Bangladesh': 'BGD', 'Barbados': 'BRB',
+    'Belarus': 'BLR', 'Belgium': 'BEL', 'Belize': 'BLZ', 'Benin': 'BEN', 'Bhutan': 'BTN',
+    'Bolivia': 'BOL', 'Bosnia and Herzegovina': 'BIH', 'Botswana': 'BWA', 'Brazil': 'BRA', 'Brunei': 'BRN',
+    'Bulgaria': 'BGR', 'Burkina Faso': 'BFA', 'Burma': 'MMR', 'Burundi': 'BDI', 'Cabo Verde': 'CPV',
+    'Cambodia': 'KHM', 'Cameroon': 'CMR', 'Canada': 'CAN', 'Central African Republic': 'CAF', 'Chad': 'TCD',
+    'Chile': 'CHL', 'China': 'CHN', 'Colombia': 'COL', 'Comoros': 'COM', 'Congo (Brazzaville)': 'COG',
+    'Congo (Kinshasa)': 'COD', 'Costa Rica': 'CRI', "Cote d'Ivoire": 'CIV', 'Croatia': 'HRV', 'Cuba': 'CUB',
+    'Cyprus': 'CYP', 'Czechia': 'CZE', 'Denmark': 'DNK', 'Djibouti': 'DJI', 'Dominica': 'DMA',
+    'Dominican Republic': 'DOM', 'Ecuador': 'ECU', 'Egypt': 'EGY', 'El Salvador': 'SLV', 'Equatorial Guinea': 'GNQ',
+    'Eritrea': 'ERI', 'Estonia': 'EST', 'Eswatini': 'SWZ', 'Ethiopia': 'ETH', 'Fiji': 'FJI',
+    'Finland': 'FIN', 'France': 'FRA', 'Gabon': 'GAB', 'Gambia': 'GMB', 'Georgia': 'GEO',
+    'Germany': 'DEU', 'Ghana': 'GHA', 'Greece': 'GRC', 'Greenland': 'GRL', 'Grenada': 'GRD',
+    'Guatemala': 'GTM', 'Guinea': 'GIN', 'Guinea-Bissau': 'GNB', 'Guyana': 'GUY', 'Haiti': 'HTI',
+    'Holy See': 'VAT', 'Honduras': 'HND', 'Hungary': 'HUN', 'Iceland': 'ISL', 'India': 'IND',
+    'Indonesia': 'IDN', 'Iran': 'IRN', 'Iraq': 'IRQ', 'Ireland': 'IRL', 'Israel': 'ISR',
+    'Italy': 'ITA', 'Jamaica': 'JAM', 'Japan': 'JPN', 'Jordan': 'JOR', 'Kazakhstan': 'KAZ',
+    'Kenya': 'KEN', 'Kosovo': 'XKX', 'Kuwait': 'KWT', 'Kyrgyzstan': 'KGZ', 'Laos': 'LAO',
+    'Latvia': 'LVA', 'Lebanon': 'LBN', 'Lesotho': 'LSO', 'Liberia': 'LBR', 'Libya': 'LBY',
+    'Liechtenstein': 'LIE', 'Lithuania': 'LTU', 'Luxembourg': 'LUX', 'Madagascar': 'MDG', 'Malawi': 'MWI',
+    'Malaysia': 'MYS', 'Maldives': 'MDV', 'Mali': 'MLI', 'Malta': 'MLT', 'Mauritania': 'MRT',
+    'Mauritius': 'MUS', 'Mexico': 'MEX', 'Moldova': 'MDA', 'Monaco': 'MCO', 'Mongolia': 'MNG',
+    'Montenegro': 'MNE', 'Morocco': 'MAR', 'Mozambique': 'MOZ', 'Namibia': 'NAM', 'Nepal': 'NPL',
+    'Netherlands': 'NLD', 'New Zealand': 'NZL', 'Nicaragua': 'NIC', 'Niger': 'NER', 'Nigeria': 'NGA',
+    'North Macedonia': 'MKD', 'Norway': 'NOR', 'Oman': 'OMN', 'Pakistan': 'PAK', 'Panama': 'PAN',
+    'Papua New Guinea': 'PNG', 'Paraguay': 'PRY', 'Peru': 'PER', 'Philippines': 'PHL', 'Poland': 'POL',
+    'Portugal': 'PRT', 'Qatar': 'QAT', 'Romania': 'ROU', 'Russia': 'RUS', 'Rwanda': 'RWA',
+    'Saint Kitts and Nevis': 'KNA', 'Saint Lucia': 'LCA', 'Saint Vincent and the Grenadines': 'VCT',
+    'San Marino': 'SMR', 'Sao Tome and Principe': 'STP', 'Saudi Arabia': 'SAU', 'Senegal': 'SEN', 'Serbia': 'SRB',
+    'Seychelles': 'SYC', 'Sierra Leone': 'SLE', 'Singapore': 'SGP', 'Slovakia': 'SVK', 'Slovenia': 'SVN',
+    'Somalia': 'SOM', 'South Africa': 'ZAF', 'South Korea': 'KOR', 'South Sudan': 'SSD', 'Spain': 'ESP',
+    'Sri Lanka': 'LKA', 'Sudan': 'SDN', 'Suriname': 'SUR', 'Sweden': 'SWE', 'Switzerland': 'CHE',
+    'Syria': 'SYR', 'Taiwan*': 'TWN', 'Tajikistan': 'TJK', 'Tanzania': 'TZA', 'Thailand': 'THA',
+    'Timor-Leste': 'TLS', 'Togo': 'TGO', 'Trinidad and Tobago': 'TTO', 'Tunisia': 'TUN', 'Turkey': 'TUR',
+    'US': 'USA', 'Uganda': 'UGA', 'Ukraine': 'UKR', 'United Arab Emirates': 'ARE', 'United Kingdom': 'GBR',
+    'Uruguay': 'URY', 'Uzbekistan': 'UZB', 'Venezuela': 'VEN', 'Vietnam': 'VNM', 'West Bank and Gaza': 'PSE',
+    'Western Sahara': 'ESH', 'Yemen': 'YEM', 'Zambia': 'ZMB', 'Zimbabwe': 'ZWE',
+}
+
+# Days before the first report of a country, outside the range of the counts: Active can be negative after corrections
+MISSING = int(np.iinfo(np.int32).min)
+
+
+def forward_fill(active, present, previous):
+    """Fill the days without a report along the day axis, previous is the value of every row before the first day."""
+    last_present = np.maximum.accumulate(np.where(present, np.arange(present.shape[1]), -1), axis=1)
+    filled = np.take_along_axis(active, np.maximum(last_present, 0), axis=1)
+    return np.where(last_present >= 0, filled, previous[:, None]).astype(np.int32)
+
+
+def build_payloads(cube=None, directory=MAP_DIRECTORY, previous=None, first_day=None):
+    """Write the [country x day] active cases of the cube, with the countries of every WHO region next to each other.
+
+    A day without a report keeps the value of the last reported day, so every day shows the latest known value.
+    previous is the manifest of older payloads and first_day the first day that changed since. When they have the
+    same countries and first date, the days before first_day are copied and only the days after it are filled again.
+    """
+    cube = cube or aggregation.get_cube()
+    os.makedirs(directory, exist_ok=True)
+
+    keys = sorted(cube.country_index)
+    positions = [cube.country_index[key] for key in keys]
+    countries = [country for _, country in keys]
+
+    regions = {}
+    for position, (region, _) in enumerate(keys):
+        start, end = regions.get(region, [position, position])
+        regions[region] = [start, end + 1]
+
+    start = 0
+    if (previous is not None and first_day is not None and previous["countries"] == countries
+            and previous["regions"] == regions and previous["first_date"] == str(cube.dates[0])):
+        start = min(max(first_day - cube.first_day, 0), previous["dates"])
+
+    filled = np.empty((len(keys), len(cube.dates)), dtype=np.int32)
+    before = np.full(len(keys), MISSING, dtype=np.int32)
+    if start:
+        filled[:, :start] = np.load(os.path.join(directory, previous["array"]), mmap_mode="r")[:, :start]
+        before = filled[:, start - 1]
+
+    active = cube.country[positions, start:, aggregation.METRICS.index("Active")]
+    present = cube.country_rows[positions, start:] > 0
+    filled[:, start:] = forward_fill(active, present, before)
+    array = write_array(directory, filled, cube.version)
+
+    manifest = {
+        "version": cube.version,
+        "missing": MISSING,
+        "array": array,
+        "first_date": str(cube.dates[0]),
+        "dates": len(cube.dates),
+        "countries": countries,
+        "iso_codes": [ISO_CODES.get(country) for _, country in keys],
+        "regions": regions,
+    }
+    # The manifest is published last, a reader sees either the old manifest and array or the new ones
+    snapshot.write_manifest(directory, manifest)
+    remove_old_arrays(directory, array)
+
+    return manifest
+
+
+def write_array(directory, values, version):
+    """Write the array under a name of its own version, readers still map the array of the previous version."""
+    descriptor, temporary_path = tempfile.mkstemp(prefix=".active-", suffix=".tmp", dir=directory)
+    with os.fdopen(descriptor, "wb") as file:
+        np.save(file, values)
+    os.chmod(temporary_path, snapshot.SHARED_FILE_MODE)
+
+    array = f"active-{version}.npy"
+    os.replace(temporary_path, os.path.join(directory, array))
+    return array
+
+
+def remove_old_arrays(directory, current):
+    """Keep the current array and the snapshot.KEEP_VERSIONS newest other ones, a removed array stays readable for
+    the processes that still map it."""
+    arrays = []
+    for entry in os.scandir(directory):
+        if entry.name != current and entry.name.startswith("active") and entry.name.endswith(".npy"):
+            try:
+                arrays.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+
+    for _, path in sorted(arrays, reverse=True)[snapshot.KEEP_VERSIONS:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class MapPayloads:
+    """Memory mapped [country x day] active cases, a WHO region is a contiguous block of rows."""
+
+    def __init__(self, directory=MAP_DIRECTORY):
+        with open(os.path.join(directory, "manifest.json")) as file:
+            manifest = json.load(file)
+
+        self.version = manifest["version"]
+        self.countries = np.array(manifest["countries"], dtype=object)
+        self.iso_codes = np.array(manifest["iso_codes"], dtype=object)
+        self.regions = {region: slice(*bounds) for region, bounds in manifest["regions"].items()}
+        self.dates = np.arange(np.datetime64(manifest["first_date"]), np.datetime64(manifest["first_date"]) + manifest["dates"])
+        self.active = np.load(os.path.join(directory, manifest["array"]), mmap_mode="r")
+
+    def day(self, date=None):
+        """Position of the date on the day axis, the last day when date is None."""
+        if date is None:
+            return len(self.dates) - 1
+        position = int(np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date).date())))
+        return min(max(position, 0), len(self.dates) - 1)
+
+    def frame(self, region, date=None):
+        """One row per country of the region with the active cases on the date, countries without reports are left out."""
+        rows = self.regions.get(region, slice(0, 0))
+        active = np.asarray(self.active[rows, self.day(date)])
+        reported = active != MISSING
+
+        return pd.DataFrame({
+            "Country.Region": self.countries[rows][reported],
+            "ISO": self.iso_codes[rows][reported],
+            "Active": active[reported],
+        })
+
+
+def first_changed_day(version):
+    """First day changed by the deltas appended since the complete.csv snapshot was at version, None if not known."""
+    manifest = snapshot.ensure_snapshot("complete")
+    history = snapshot.delta_history(manifest)
+    versions = [manifest["sha256"][:16]] + [delta.get("version") for delta in history]
+    if version not in versions:
+        return None
+
+    later = history[versions.index(version):]
+    if any("first_day" not in delta and delta["rows"] for delta in later):
+        return None
+    return min((delta["first_day"] for delta in later if "first_day" in delta), default=None)
+
+
+def ensure_payloads(directory=MAP_DIRECTORY):
+    """Build the payloads when they are missing or older than the complete.csv snapshot.
+
+    Payloads that are older by a few deltas are only filled again from the first day the deltas changed.
+    """
+    cube = aggregation.get_cube()
+
+    try:
+        with open(os.path.join(directory, "manifest.json")) as file:
+            manifest = json.load(file)
+        current = os.path.exists(os.path.join(directory, manifest["array"])) and manifest["missing"] == MISSING
+    except (FileNotFoundError, ValueError, KeyError):  # a manifest of an older version has no array name or marker
+        manifest, current = None, False
+
+    if not current:
+        build_payloads(cube, directory)
+    elif manifest["version"] != cube.version:
+        build_payloads(cube, directory, manifest, first_changed_day(manifest["version"]))
+
+
+_payloads = None
+
+
+def get_payloads():
+    global _payloads
+
+    ensure_payloads()
+    if _payloads is None or _payloads.version != aggregation.get_cube().version:
+        _payloads = MapPayloads()
+
+    return _payloads
+
+
+def choropleth(df_map, title):
+    """Choropleth of a frame with one row per country (Country.Region, Active and optionally ISO)."""
+    if "ISO" not in df_map:
+        df_map = df_map.assign(ISO=None)
+    by_code = df_map[df_map["ISO"].notna()]
+    by_name = df_map[df_map["ISO"].isna()]
+
+    fig = go.Figure()
+    for df, locations, mode in ((by_code, "ISO", "ISO-3"), (by_name, "Country.Region", "country names")):
+        if len(df):
+            fig.add_trace(go.Choropleth(
+                locations=df[locations].tolist(),
+                locationmode=mode,
+                z=df["Active"].to_numpy(),
+                text=df["Country.Region"].tolist(),
+                hovertemplate="<b>%{text}</b><br>Active=%{z}<extra></extra>",
+                coloraxis="coloraxis",
+            ))
+
+    fig.update_layout(title=title, coloraxis={"colorscale": "Reds", "colorbar": {"title": "Active"}})
+    return fig
@@ -2,51 +2,107 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.integrate import solve_ivp
-import sqlite3
-import plotly.express as px
+import ingest
+import instrumentation
+import map_payloads
+import partitions
+import query_database
+import reproduction
+import snapshot
 
-# Connect to the database
-db_file_path = "Data/covid_database.db"
-connection = sqlite3.connect(db_file_path)
+# Nothing is loaded when this module is imported, every dataset is built on first use by the get_* functions
+# below and kept for later calls. The dashboard only uses plot_visualization_map_WHO_Region, which reads the
+# map payloads that ingest.py precomputes (see map_payloads.py).
+db_file_path = query_database.DATABASE_PATH
 
-# Load necessary tables using SQL queries for efficiency
-df_csv = pd.read_csv("Data/complete.csv")
-df_country_wise = pd.read_sql_query("SELECT `Country.Region`, Confirmed, Deaths, Recovered, Active FROM country_wise", connection)
-df_worldometer = pd.read_sql_query("SELECT `Country.Region`, Population FROM worldometer_data", connection)
-df_usa_counties = pd.read_sql_query("SELECT Admin2, Province_State, Confirmed, Deaths FROM usa_county_wise", connection)
+_df_final = None
+_top_us_counties = None
 
-# Merge data
-df_merged = pd.merge(df_csv, df_country_wise, on='Country.Region', how='left', suffixes=('_csv', '_db'))
-df_final = pd.merge(df_merged, df_worldometer, on="Country.Region", how="left")
 
-# Handle missing values
-df_final.fillna(0, inplace=True)
+def build_final(df_csv=None, connection=None):
+    """complete.csv merged with country_wise and the worldometer population, with the R0 estimates per day."""
+    connection = connection or query_database.get_connection(db_file_path)
 
-# Convert Date column to datetime format
-df_final["Date"] = pd.to_datetime(df_final["Date"])
+    # Load necessary tables using SQL queries for efficiency
+    if df_csv is None:
+        df_csv = snapshot.load_complete(categorical=False)
+    df_country_wise = pd.read_sql_query("SELECT `Country.Region`, Confirmed, Deaths, Recovered, Active FROM country_wise", connection)
+    df_worldometer = pd.read_sql_query("SELECT `Country.Region`, Population FROM worldometer_data", connection)
 
-# Estimate parameters dynamically with γ fixed at 1/4.5
-df_final["New_deaths"] = df_final["Deaths_csv"].diff().fillna(0)
-df_final["New_recovered"] = df_final["Recovered_csv"].diff().fillna(0)
-df_final["New_cases"] = df_final["Confirmed_csv"].diff().fillna(0)
+    # Merge data
+    df_merged = pd.merge(df_csv, df_country_wise, on='Country.Region', how='left', suffixes=('_csv', '_db'))
+    df_final = pd.merge(df_merged, df_worldometer, on="Country.Region", how="left")
 
-df_final["mu"] = df_final["New_deaths"] / df_final["Confirmed_csv"]
-df_final["gamma"] = 1 / 4.5  # Fixed based on assignment
+    # Handle missing values
+    df_final.fillna(0, inplace=True)
 
-df_final["beta"] = df_final["New_cases"].clip(lower=0) / (df_final["Confirmed_csv"] * df_final["Population"]) * df_final["Population"]
+    # Convert Date column to datetime format
+    df_final["Date"] = pd.to_datetime(df_final["Date"])
 
-df_final["mu"] = df_final["mu"].ffill()
-df_final["beta"] = df_final["beta"].ffill()
+    # Sort once by location and date, the differences, forward fills and rolling means below are computed per location
+    df_final, location_starts = reproduction.sort_by_location(df_final, ["WHO.Region", "Country.Region", "Province.State"], "Date")
 
-df_final["gamma"] = 1 / 4.5  # Given in assignment (fixed)
+    # Estimate parameters dynamically with γ fixed at 1/4.5
+    df_final["New_deaths"] = np.nan_to_num(reproduction.grouped_diff(df_final["Deaths_csv"], location_starts))
+    df_final["New_recovered"] = np.nan_to_num(reproduction.grouped_diff(df_final["Recovered_csv"], location_starts))
+    df_final["New_cases"] = np.nan_to_num(reproduction.grouped_diff(df_final["Confirmed_csv"], location_starts))
 
-df_final["R0"] = (df_final["beta"] / df_final["gamma"]).clip(lower=0)
+    df_final["mu"] = df_final["New_deaths"] / df_final["Confirmed_csv"]
+    df_final["gamma"] = 1 / 4.5  # Fixed based on assignment
 
-# Function to get R0 for a given country
+    df_final["beta"] = df_final["New_cases"].clip(lower=0) / (df_final["Confirmed_csv"] * df_final["Population"]) * df_final["Population"]
+
+    df_final["mu"] = reproduction.grouped_ffill(df_final["mu"], location_starts)
+    df_final["beta"] = reproduction.grouped_ffill(df_final["beta"], location_starts)
+
+    df_final["R0"] = (df_final["beta"] / df_final["gamma"]).clip(lower=0)
+    df_final["R0"] = reproduction.grouped_rolling_mean(df_final["R0"], location_starts, window=7)
+
+    return df_final
+
+
+def get_final():
+    global _df_final
+
+    if _df_final is None:
+        _df_final = build_final()
+
+    return _df_final
+
+
+def get_top_us_counties():
+    """Top 5 US counties with highest cases and deaths, the totals per county are kept up to date by ingest.py."""
+    global _top_us_counties
+
+    if _top_us_counties is None:
+        if ingest.county_rollups_behind():
+            ingest.update_county_rollups()
+
+        connection = query_database.get_connection(db_file_path)
+        _top_us_counties = (
+            query_database.Top_US_Counties(connection, "Confirmed", 5),
+            query_database.Top_US_Counties(connection, "Deaths", 5),
+        )
+
+    return _top_us_counties
+
+
+@instrumentation.timed()
+def country_map_frame(continent, date=None):
+    """Active cases per country of the WHO region on the date (default the last day), one row per country."""
+    return map_payloads.get_payloads().frame(continent, date)
+
+
+# Function to get R0 for a given country, R(t) of all countries is computed at once by partitions.get_reproduction_store
 def get_R0_trajectory(country):
-    country_data = df_final[df_final["Country.Region"] == country]
+    store = partitions.get_reproduction_store("country")
+    keys = [key for key in store.keys if key[1] == country]
+    if not keys:
+        raise LookupError(f"No data for {country}")
+
+    country_data = pd.concat([store.series(key) for key in keys])
     plt.figure(figsize=(12, 6))
-    plt.plot(country_data["Date"], country_data["R0"], label=f"R0 for {country}", color="purple")
+    plt.plot(country_data["Date"], country_data["Reproduction Number (7 day mean)"], label=f"R0 for {country}", color="purple")
     plt.xlabel("Date")
     plt.ylabel("R0 Value")
     plt.title(f"Estimated R0 Over Time for {country}")
@@ -57,23 +113,12 @@ def get_R0_trajectory(country):
     plt.show()
 
 # Fixing Europe Map visualization
-def plot_visualization_map_WHO_Region(continent):
-    df_continent = df_final[df_final["WHO.Region"] == continent]
-    fig = px.choropleth(df_continent, 
-                        locations="Country.Region", 
-                        locationmode="country names",
-                        color="Active_csv",
-                        hover_name="Country.Region",
-                        title=f"Active COVID-19 Cases for {continent}",
-                        color_continuous_scale="Reds")
-    return fig
-
-# Identify top 5 US counties with highest deaths and cases
-df_top_cases = df_usa_counties.groupby("Admin2").agg({"Confirmed": "sum"}).reset_index()
-df_top_cases = df_top_cases.nlargest(5, "Confirmed")
-
-df_top_deaths = df_usa_counties.groupby("Admin2").agg({"Deaths": "sum"}).reset_index()
-df_top_deaths = df_top_deaths.nlargest(5, "Deaths")
+def plot_visualization_map_WHO_Region(continent, df_map=None):
+    """Choropleth of the active cases, df_map is a frame with one row per country (Country.Region, Active and optionally ISO)."""
+    if df_map is None:
+        df_map = country_map_frame(continent)
+
+    return map_payloads.choropleth(df_map, f"Active COVID-19 Cases for {continent}")
 
 # Plot top 5 counties
 def plot_top_us_counties():
@@ -93,6 +138,7 @@ def plot_top_us_counties():
 # Define missing functions
 
 def plot_time_series():
+    df_final = get_final()
     df_time_series = df_final.groupby("Date")[["Confirmed_csv", "Deaths_csv", "Recovered_csv", "Active_csv"]].sum()
     plt.figure(figsize=(12, 6))
     plt.plot(df_time_series.index, df_time_series["Confirmed_csv"], label="Confirmed Cases", linestyle="-")
@@ -109,7 +155,7 @@ def plot_time_series():
 
 def plot_continent_death_rates():
     df_continent_deaths = pd.read_sql_query(
-        "SELECT Continent, SUM(TotalDeaths) as Total_Deaths FROM worldometer_data GROUP BY Continent", connection
+        "SELECT Continent, SUM(TotalDeaths) as Total_Deaths FROM worldometer_data GROUP BY Continent", query_database.get_connection(db_file_path)
     )
     plt.figure(figsize=(10, 6))
     plt.bar(df_continent_deaths["Continent"], df_continent_deaths["Total_Deaths"], color="red")
@@ -120,9 +166,8 @@ def plot_continent_death_rates():
     plt.grid(axis="y")
     plt.show()
 
-df_final["R0"] = df_final["R0"].rolling(window=7, min_periods=1).mean()
-
 def plot_reproduction_number():
+    df_final = get_final()
     plt.figure(figsize=(12, 6))
     plt.plot(df_final["Date"], df_final["R0"], label="R0 (Basic Reproduction Number)", color="purple")
     plt.xlabel("Date")
@@ -154,8 +199,7 @@ def plot_sird_model():
     plot_reproduction_number()
     plot_sird_model()
     plt.figure(figsize=(12, 6))
-    top_cases = df_usa_counties.nlargest(5, "Confirmed")
-    top_deaths = df_usa_counties.nlargest(5, "Deaths")
+    top_cases, top_deaths = get_top_us_counties()
     counties = top_cases["Admin2"]
 
     plt.bar(counties, top_cases["Confirmed"], color="blue", label="Cases")
@@ -1,7 +1,8 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np 
-from scipy.optimize import minimize
+from fitting import fit_sir
+from simulation import simulate_sird
 
 
 df = pd.read_csv("Data\day_wise.csv")
@@ -49,21 +50,7 @@ beta = 0.3
 gamma = 0.1
 mu = 0.01
 
-S = [S0]
-I = [I0]
-R = [R0]
-D = [D0]
-
-for t in range(1, len(df)):
-    delta_S = alpha * R[-1] - beta * S[-1] * I[-1] / N
-    delta_I = beta * S[-1] * I[-1] / N - mu * I[-1] - gamma * I[-1]
-    delta_R = gamma * I[-1] - alpha * R[-1]
-    delta_D = mu * I[-1]
-    
-    S.append(S[-1] + delta_S)
-    I.append(I[-1] + delta_I)
-    R.append(R[-1] + delta_R)
-    D.append(D[-1] + delta_D)
+S, I, R, D = simulate_sird(S0, I0, R0, D0, alpha, beta, gamma, mu, N, len(df))[:, 0]
 
 plt.figure(figsize=(10, 6))
 plt.plot(df["Date"], S, label="Susceptible")
@@ -78,18 +65,10 @@ plt.tight_layout()
 plt.show()
 
 
-def error_function(params):
-    beta, gamma = params
-    I_pred = [I0]
-    for t in range(1, len(df)):
-        delta_I = beta * S[t-1] * I_pred[t-1] / N - gamma * I_pred[t-1]
-        I_pred.append(I_pred[t-1] + delta_I)
-    return np.sum((np.array(I_pred) - df["Active"])**2)
-
 initial_guess = [0.3, 0.1]
-result = minimize(error_function, initial_guess, bounds=[(0, 10), (0, 10)])
-beta_est, gamma_est = result.x
-R0_est = beta_est / gamma_est
+fit = fit_sir(df["Active"], S, N, I0, initial_guess, bounds=[(0, 10), (0, 10)])
+beta_est, gamma_est = fit["beta"], fit["gamma"]
+R0_est = fit["R0"]
 
 print(f"Estimated beta: {beta_est}")
 print(f"Estimated gamma: {gamma_est}")
@@ -1,96 +1,146 @@
 import sqlite3
 from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
-from Scripts.query_database import fetch_country_data
+import instrumentation
+import query_database
+import simulation
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
-def obtain_mu_hat(country):
-    """Estimate the death rate μ_hat."""
-    data = fetch_country_data(country)
-    
-    if not data:
+GAMMA_HAT = 1 / 4.5  # Given in the assignment
+
+COUNTRY_COLUMNS = ["Active", "New.cases", "Recovered", "New.recovered", "Deaths", "New.deaths"]
+WORLDOMETER_COLUMNS = ["Population", "ActiveCases", "TotalDeaths", "TotalRecovered"]
+
+
+@instrumentation.timed()
+def fetch_countries_data(countries=None, connection=None):
+    """Fetch the country_wise and worldometer_data values of several countries with a single query.
+
+    Names are mapped between both datasets in memory, the same way fetch_country_data does it for one country.
+    """
+    connection = connection or query_database.get_connection()
+    cursor = connection.cursor()
+
+    if countries is None:
+        cursor.execute("SELECT [Country.Region] FROM country_wise;")
+        countries = [row[0] for row in cursor.fetchall()]
+
+    resolver = query_database.get_population_resolver(cursor)
+    names = []
+    for country in countries:
+        country_wise_name = resolver.to_country_wise(country)
+        names.extend([country, country_wise_name, resolver.to_worldometer(country_wise_name)])
+
+    columns = ", ".join([f"cw.[{column}]" for column in COUNTRY_COLUMNS] + [f"wd.[{column}]" for column in WORLDOMETER_COLUMNS])
+    values = ", ".join("(?, ?, ?)" for _ in countries)
+    query = f"""
+    WITH names(requested, country_wise_name, worldometer_name) AS (VALUES {values})
+    SELECT names.requested, {columns}
+    FROM names
+    JOIN country_wise cw ON cw.[Country.Region] = names.country_wise_name
+    JOIN worldometer_data wd ON wd.[Country.Region] = names.worldometer_name;
+    """
+    df = pd.DataFrame(cursor.execute(query, names).fetchall() if countries else [], columns=["country"] + COUNTRY_COLUMNS + WORLDOMETER_COLUMNS)
+
+    # Keep one row per requested country, in the requested order, countries without data get NaN values
+    df = df.drop_duplicates("country").set_index("country").reindex(pd.Index(countries, name="country"))
+    return df.apply(pd.to_numeric, errors="coerce").reset_index()
+
+
+@instrumentation.timed()
+def estimate_parameters(countries=None, connection=None):
+    """Estimate α̂, β̂, μ̂ and γ for all requested countries at once (all countries if none are given)."""
+    df = fetch_countries_data(countries, connection)
+
+    active = df["Active"].to_numpy(dtype=float)
+    new_cases = df["New.cases"].to_numpy(dtype=float)
+    recovered = df["Recovered"].to_numpy(dtype=float)
+    new_recovered = df["New.recovered"].to_numpy(dtype=float)
+    deaths = df["Deaths"].to_numpy(dtype=float)
+    new_deaths = df["New.deaths"].to_numpy(dtype=float)
+    population = df["Population"].to_numpy(dtype=float)
+
+    # Values of the day before the last day in the dataset
+    active_cases = active - new_cases
+    recovered_cases = recovered - new_recovered
+    death_cases = deaths - new_deaths
+    susceptible_cases = population - (active_cases + recovered_cases + death_cases)
+    delta_susceptible = -(new_cases + new_recovered + new_deaths)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu_hat = np.where(active_cases > 0, new_deaths / active_cases, 0.0)
+        alpha_hat = np.where(recovered_cases > 0, -(new_recovered - GAMMA_HAT * active_cases) / recovered_cases, 0.0)
+        beta_hat = np.where(
+            susceptible_cases * active_cases > 0,
+            (alpha_hat * recovered_cases - delta_susceptible) * (population / (susceptible_cases * active_cases)),
+            0.0,
+        )
+
+    # Countries without data stay missing instead of getting a rate of 0
+    missing = np.isnan(active)
+    mu_hat[missing] = np.nan
+    alpha_hat[missing] = np.nan
+    beta_hat[missing] = np.nan
+
+    return pd.DataFrame({
+        "country": df["country"],
+        "alpha_hat": alpha_hat,
+        "beta_hat": beta_hat,
+        "gamma_hat": np.where(missing, np.nan, GAMMA_HAT),
+        "mu_hat": mu_hat,
+        "population": population,
+        "active": active,
+        "recovered": recovered,
+        "deaths": deaths,
+    })
+
+
+def estimate_parameter(country, column):
+    parameters = estimate_parameters([country])
+    value = parameters.loc[0, column]
+
+    if np.isnan(value):
         return None  # Handle missing data
 
-    active, new_cases, _, _, _, new_deaths, _, _, _, _ = data
-    active_cases = int(active) - int(new_cases)
-    
-    mu_hat = int(new_deaths) / active_cases if active_cases > 0 else 0
-    return mu_hat
+    return float(value)
 
 
-def obtain_alpha_hat(country):
-    """Estimate the reinfection rate α_hat."""
-    gamma_hat = 1 / 4.5  # Given in the assignment
-    data = fetch_country_data(country)
-
-    if not data:
-        return None  
+def obtain_mu_hat(country):
+    """Estimate the death rate μ_hat."""
+    return estimate_parameter(country, "mu_hat")
 
-    active, new_cases, recovered, new_recovered, _, _, _, _, _, _ = data
-    active_cases = int(active) - int(new_cases)
-    recovered_cases = int(recovered) - int(new_recovered)
 
-    alpha_hat = -(int(new_recovered) - gamma_hat * active_cases) / recovered_cases if recovered_cases > 0 else 0
-    return alpha_hat
+def obtain_alpha_hat(country):
+    """Estimate the reinfection rate α_hat."""
+    return estimate_parameter(country, "alpha_hat")
 
 
 def obtain_beta_hat(country):
     """Estimate the transmission rate β_hat."""
-    gamma_hat = 1 / 4.5  
-    data = fetch_country_data(country)
-
-    if not data:
-        return None  
-
-    active, new_cases, recovered, new_recovered, deaths, new_deaths, population, _, _, _ = data
-    active_cases = int(active) - int(new_cases)
-    recovered_cases = int(recovered) - int(new_recovered)
-    death_cases = int(deaths) - int(new_deaths)
-    susceptible_cases = population - (active_cases + recovered_cases + death_cases)
-    
-    alpha_hat = obtain_alpha_hat(country)
-    delta_susceptible = -(new_cases + new_recovered + new_deaths)
-
-    beta_hat = ((alpha_hat * recovered_cases - delta_susceptible) * (population / (susceptible_cases * active_cases))) if (susceptible_cases * active_cases) > 0 else 0
-    return beta_hat
-
-
+    return estimate_parameter(country, "beta_hat")
 
 
 def produce_reproduction_number_trajectory(country, days):
     """Calculate and plot R0 trajectory for a given country over time."""
-    alpha_hat = obtain_alpha_hat(country)
-    beta_hat = obtain_beta_hat(country)
-    gamma_hat = 1 / 4.5
-    mu_hat = obtain_mu_hat(country)
-
-    data = fetch_country_data(country)
-    if not data:
+    parameters = estimate_parameters([country]).iloc[0]
+    if np.isnan(parameters["active"]):
         print("No data available for", country)
         return
 
-    active, new_cases, recovered, new_recovered, deaths, new_deaths, population, _, _, _ = data
+    alpha_hat = parameters["alpha_hat"]
+    beta_hat = parameters["beta_hat"]
+    gamma_hat = parameters["gamma_hat"]
+    mu_hat = parameters["mu_hat"]
+
+    active, recovered, deaths, population = parameters[["active", "recovered", "deaths", "population"]]
     susceptible_cases = population - (active + recovered + deaths)
-    
-    susceptible = [susceptible_cases]
-    active_cases = [active]
-    recovered_cases = [recovered]
-    deaths_cases = [deaths]
-    R0_values = []
-
-    for _ in range(days):
-        delta_S = alpha_hat * recovered_cases[-1] - beta_hat * susceptible[-1] * active_cases[-1] / population
-        delta_I = beta_hat * susceptible[-1] * active_cases[-1] / population - mu_hat * active_cases[-1] - gamma_hat * active_cases[-1]
-        delta_R = gamma_hat * active_cases[-1] - alpha_hat * recovered_cases[-1]
-        delta_D = mu_hat * active_cases[-1]
-
-        susceptible.append(susceptible[-1] + delta_S)
-        active_cases.append(active_cases[-1] + delta_I)
-        recovered_cases.append(recovered_cases[-1] + delta_R)
-        deaths_cases.append(deaths_cases[-1] + delta_D)
-
-        R0_values.append(beta_hat / gamma_hat)
+
+    susceptible, active_cases, recovered_cases, deaths_cases = simulation.simulate_sird(
+        susceptible_cases, active, recovered, deaths, alpha_hat, beta_hat, gamma_hat, mu_hat, population, days + 1
+    )[:, 0]
+    R0_values = [beta_hat / gamma_hat] * days
 
     plt.figure(figsize=(12, 6))
     plt.plot(range(days), R0_values, label="R₀ over time", color="blue")
@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+import aggregation
+import query_database
+import reproduction
+import snapshot
+
+# Out-of-core mode for histories that do not fit in memory. The rows are split into partitions of one WHO region and
+# one month, and every partition is reduced to its per location, per day totals. Queries read one partition at a
+# time and merge the partial totals, so memory is bounded by the size of a partition instead of the whole history.
+# Set COVID_PARTITIONS to the partition directory to let createDataFrameOverTime use it.
+PARTITION_DIRECTORY = os.environ.get("COVID_PARTITIONS")
+CHUNK_SIZE = 1000000
+
+METRICS = aggregation.METRICS
+
+
+def write_chunk(directory, chunk, number):
+    """Split a chunk of rows by (WHO region, month) and append every piece as a file to its partition."""
+    months = chunk["Date"].dt.strftime("%Y-%m")
+
+    for (region, month), rows in chunk.groupby([chunk["WHO.Region"], months], sort=False):
+        path = os.path.join(directory, region, month)
+        os.makedirs(path, exist_ok=True)
+        np.savez(
+            os.path.join(path, f"chunk-{number:06d}.npz"),
+            country=rows["Country.Region"].to_numpy(dtype=str),
+            province=rows["Province.State"].fillna("").to_numpy(dtype=str),
+            day=snapshot.date_to_day(rows["Date"]),
+            values=rows[METRICS].to_numpy(dtype=np.int64),
+        )
+
+
+def country_day_totals(countries, days, values):
+    """Sum rows per (country, day), sorted by country and day. Returns the countries, days and values."""
+    df = pd.DataFrame(values, columns=METRICS)
+    df["country"] = countries
+    df["day"] = days
+    df = df.groupby(["country", "day"], sort=True)[METRICS].sum().reset_index()
+
+    return df["country"].to_numpy(dtype=str), df["day"].to_numpy(dtype=np.int32), df[METRICS].to_numpy(dtype=np.int64)
+
+
+def summarize_partition(path):
+    """Reduce the chunk files of a partition to one row per (country, province, day), sorted by location and day.
+
+    Rows with the same key are deduplicated here, the last one read wins. The totals per (country, day) and per day
+    are stored as well, they are the partial aggregates of country and region queries.
+    """
+    files = sorted(name for name in os.listdir(path) if name.startswith("chunk-"))
+    parts = [np.load(os.path.join(path, name)) for name in files]
+
+    df = pd.DataFrame({
+        "country": np.concatenate([part["country"] for part in parts]),
+        "province": np.concatenate([part["province"] for part in parts]),
+        "day": np.concatenate([part["day"] for part in parts]),
+    })
+    values = np.concatenate([part["values"] for part in parts])
+
+    keep = ~df.duplicated(["country", "province", "day"], keep="last").to_numpy()
+    df, values = df[keep], values[keep]
+    order = np.lexsort([df["day"].to_numpy(), df["province"].to_numpy(), df["country"].to_numpy()])
+    df, values = df.iloc[order], values[order]
+
+    # Totals of the whole WHO region per day, the partial aggregate for region and global queries
+    days = df["day"].to_numpy()
+    region_days, day_of_row = np.unique(days, return_inverse=True)
+    region_values = np.zeros((len(region_days), len(METRICS)), dtype=np.int64)
+    np.add.at(region_values, day_of_row, values)
+
+    country_countries, country_days, country_values = country_day_totals(df["country"].to_numpy(), days, values)
+
+    np.savez(
+        os.path.join(path, "summary.npz"),
+        country=df["country"].to_numpy(dtype=str),
+        province=df["province"].to_numpy(dtype=str),
+        day=days.astype(np.int32),
+        values=values,
+        region_days=region_days.astype(np.int32),
+        region_values=region_values,
+        country_countries=country_countries,
+        country_days=country_days,
+        country_values=country_values,
+    )
+    for name in files:
+        os.remove(os.path.join(path, name))
+
+    return int(days.min()), int(days.max()), len(days), sorted(set(country_countries))
+
+
+def partition_populations(countries_per_region):
+    """Population of every country of the partitions, with the sums per WHO region and over the world.
+
+    The populations are resolved once and stored with the partitions, countries that are only in the partitions and
+    not in complete_data count towards the sums as well. An unknown population is None.
+    """
+    with query_database.connection() as connection:
+        resolver = query_database.get_population_resolver(connection.cursor())
+
+    countries = set().union(*countries_per_region.values())
+    populations = {country: resolver.population(country) for country in sorted(countries)}
+
+    return {
+        "countries": populations,
+        "regions": {region: sum(populations[country] or 0 for country in region_countries) for region, region_countries in countries_per_region.items()},
+        "global": sum(population or 0 for population in populations.values()),
+    }
+
+
+def build_partitions(source, directory=None, chunksize=CHUNK_SIZE):
+    """Stream a csv in the complete.csv schema into (WHO region, month) partitions. Returns the manifest."""
+    directory = directory or PARTITION_DIRECTORY or "Data/partitions"
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    for number, chunk in enumerate(pd.read_csv(source, chunksize=chunksize, parse_dates=["Date"])):
+        chunk[snapshot.COUNT_COLUMNS] = chunk[snapshot.COUNT_COLUMNS].fillna(0)
+        write_chunk(directory, chunk, number)
+
+    partitions = []
+    countries_per_region = {}
+    for region in sorted(os.listdir(directory)):
+        for month in sorted(os.listdir(os.path.join(directory, region))):
+            first_day, last_day, rows, countries = summarize_partition(os.path.join(directory, region, month))
+            partitions.append({"region": region, "month": month, "first_day": first_day, "last_day": last_day, "rows": rows})
+            countries_per_region.setdefault(region, set()).update(countries)
+
+    manifest = {"source": source, "partitions": partitions, "populations": partition_populations(countries_per_region)}
+    with open(os.path.join(directory, "manifest.json"), "w") as file:
+        json.dump(manifest, file)
+
+    return manifest
+
+
+class PartitionedStore:
+    """Answers the same requests as AggregationCube from the partition summaries, one partition at a time."""
+
+    def __init__(self, directory=None):
+        self.directory = directory or PARTITION_DIRECTORY
+        with open(os.path.join(self.directory, "manifest.json")) as file:
+            manifest = json.load(file)
+        self.partitions = manifest["partitions"]
+        self.reproduction_stores = {}
+        self.lock = threading.Lock()
+
+        # Partitions of an older version have no populations, they are resolved once for all countries here
+        self.populations = manifest.get("populations")
+        if self.populations is None:
+            countries_per_region = {}
+            for partition, summary in self.select():
+                countries_per_region.setdefault(partition["region"], set()).update(summary["country"])
+            self.populations = partition_populations(countries_per_region)
+
+        self.first_day = min(partition["first_day"] for partition in self.partitions)
+        self.last_day = max(partition["last_day"] for partition in self.partitions)
+
+    def date_range(self):
+        dates = snapshot.day_to_date([self.first_day, self.last_day])
+        return tuple(np.datetime_as_string(dates, unit="D"))
+
+    def select(self, continent=None, first_day=None, last_day=None):
+        """Partitions of the WHO region (all regions when continent is None) that overlap the days."""
+        for partition in self.partitions:
+            if continent and partition["region"] != continent:
+                continue
+            if first_day is not None and partition["last_day"] < first_day:
+                continue
+            if last_day is not None and partition["first_day"] > last_day:
+                continue
+            yield partition, np.load(os.path.join(self.directory, partition["region"], partition["month"], "summary.npz"))
+
+    def has_location(self, continent=None, country=None, province=None):
+        """Whether any partition has rows of the location, like AggregationCube.has_location."""
+        if not continent:
+            return True
+
+        for _, summary in self.select(continent):
+            if not country:
+                return True
+            selected = summary["country"] == country
+            if province:
+                selected &= summary["province"] == province
+            if selected.any():
+                return True
+
+        return False
+
+    def totals(self, continent=None, country=None, province=None, first_day=None, last_day=None):
+        """Sum of the metrics per day, merged over the partitions. Returns (days, values) of the days with rows."""
+        # Clipped to the available days like AggregationCube.day_window, a window with start > end is empty
+        first_day = self.first_day if first_day is None else max(first_day, self.first_day)
+        last_day = self.last_day if last_day is None else min(last_day, self.last_day)
+        last_day = max(last_day, first_day - 1)
+
+        values = np.zeros((last_day - first_day + 1, len(METRICS)), dtype=np.int64)
+        rows = np.zeros(last_day - first_day + 1, dtype=np.int64)
+
+        for _, summary in self.select(continent, first_day, last_day):
+            if country:
+                selected = summary["country"] == country
+                if province:
+                    selected &= summary["province"] == province
+                days, partial = summary["day"][selected], summary["values"][selected]
+            else:
+                days, partial = summary["region_days"], summary["region_values"]
+
+            inside = (days >= first_day) & (days <= last_day)
+            np.add.at(values, days[inside] - first_day, partial[inside])
+            np.add.at(rows, days[inside] - first_day, 1)
+
+        present = rows > 0
+        return np.arange(first_day, last_day + 1)[present], values[present]
+
+    def series(self, continent=None, country=None, province=None, startdate=None, enddate=None):
+        """Same frame as AggregationCube.series."""
+        first_day = int(snapshot.date_to_day([startdate])[0]) if startdate else None
+        last_day = int(snapshot.date_to_day([enddate])[0]) if enddate else None
+
+        # Like the cube, a country is only looked up together with its WHO region
+        if not continent:
+            country = province = None
+        elif not country:
+            province = None
+        days, values = self.totals(continent, country, province, first_day, last_day)
+
+        df = pd.DataFrame(values, columns=aggregation.TOTAL_COLUMNS)
+        df.insert(0, "Date", np.datetime_as_string(snapshot.day_to_date(days), unit="D"))
+
+        if not (continent and country and province):
+            known = not continent or any(partition["region"] == continent for partition in self.partitions)
+            population = self.population(continent, country) if known else None
+            df["Population"] = np.nan if population is None else population
+
+        return df
+
+    def population(self, continent=None, country=None):
+        if country:
+            return self.populations["countries"].get(country)
+        if continent:
+            return self.populations["regions"].get(continent, 0)
+        return self.populations["global"]
+
+    def reproduction_store(self, level="country", window=reproduction.WINDOW):
+        """R(t) of every country or WHO region, computed one WHO region at a time."""
+        if level not in ("country", "region"):
+            raise ValueError(f"Unknown level {level}, use country or region")
+
+        keys, dates, columns = [], [], {"mu": [], "beta": [], "Reproduction Number": [], f"Reproduction Number ({window} day mean)": []}
+        offsets = [0]
+
+        for region in sorted({partition["region"] for partition in self.partitions}):
+            # Every partition is reduced to its totals per (location, day) first, only those small partials of the
+            # months of this region are merged
+            locations, days, values = [], [], []
+            for _, summary in self.select(region):
+                if level == "region":
+                    partial = np.full(len(summary["region_days"]), region), summary["region_days"], summary["region_values"]
+                elif "country_values" in summary:
+                    partial = summary["country_countries"], summary["country_days"], summary["country_values"]
+                else:  # summaries of an older version only have the province rows
+                    partial = country_day_totals(summary["country"], summary["day"], summary["values"])
+                locations.append(partial[0])
+                days.append(partial[1])
+                values.append(partial[2])
+
+            df = pd.DataFrame(np.concatenate(values), columns=METRICS)
+            df["location"] = np.concatenate(locations)
+            df["day"] = np.concatenate(days)
+            df = df.groupby(["location", "day"], sort=True)[METRICS].sum().reset_index()
+
+            starts = reproduction.segment_starts([df["location"].to_numpy()])
+            if level == "region":
+                population = np.full(len(df), self.population(region), dtype=np.float64)
+            else:
+                population = df["location"].map(lambda country: self.population(region, country)).to_numpy(dtype=np.float64)
+            mu, beta, number = reproduction.reproduction_number(df["Deaths"], df["Active"], df["Confirmed"], population, starts)
+
+            for name, result in zip(columns, (mu, beta, number, reproduction.grouped_rolling_mean(number, starts, window))):
+                columns[name].append(result)
+            dates.append(snapshot.day_to_date(df["day"].to_numpy()).astype("datetime64[D]"))
+
+            for location, rows in df.groupby("location", sort=True).size().items():
+                keys.append(region if level == "region" else (region, location))
+                offsets.append(offsets[-1] + rows)
+
+        return reproduction.ReproductionStore(
+            keys, np.asarray(offsets, dtype=np.int64), np.concatenate(dates), {name: np.concatenate(parts) for name, parts in columns.items()}
+        )
+
+    def get_reproduction_store(self, level="country"):
+        """reproduction_store, computed once per level. The partitions do not change while the store is open."""
+        with self.lock:
+            if level not in self.reproduction_stores:
+                self.reproduction_stores[level] = self.reproduction_store(level)
+            return self.reproduction_stores[level]
+
+
+_store = None
+
+
+def enabled():
+    return bool(PARTITION_DIRECTORY) and os.path.exists(os.path.join(PARTITION_DIRECTORY, "manifest.json"))
+
+
+def get_store():
+    global _store
+
+    if _store is None:
+        _store = PartitionedStore()
+
+    return _store
+
+
+def get_reproduction_store(level="country"):
+    """R(t) of every country or WHO region, from the partitions when they are enabled and from the cube otherwise."""
+    return get_store().get_reproduction_store(level) if enabled() else reproduction.get_store(level)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a csv in the complete.csv schema into (WHO region, month) partitions.")
+    parser.add_argument("source", help="csv file with the columns of complete.csv")
+    parser.add_argument("--directory", default=PARTITION_DIRECTORY or "Data/partitions", help="Where the partitions are written")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows read from the csv at once")
+    args = parser.parse_args()
+
+    manifest = build_partitions(args.source, args.directory, args.chunk_size)
+    print(f"{len(manifest['partitions'])} partitions written to {args.directory}")
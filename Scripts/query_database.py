@@ -1,17 +1,137 @@
+import functools
+import os
 import sqlite3
+import threading
+from datetime import date
+from contextlib import contextmanager
 import pandas as pd
 
-def mapping_datasets(cursor):
-    query = """
-    CREATE TABLE IF NOT EXISTS data_mapping (
-        country_wise_name VARCHAR(255),
-        worldometer_name VARCHAR(255)
-    );
+DATABASE_PATH = "Data/covid_database.db"
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+class ConnectionManager:
+    """Hands out one reusable read-only connection per thread, so sessions can never modify or lock the tables.
+
+    sqlite3 keeps the prepared statements of a connection cached, so reusing the connection also reuses the
+    compiled queries. Opened connections and executed statements are counted, see stats().
     """
-    cursor.execute(query)
 
-    
-    country_mapping = [
+    def __init__(self, database_path=DATABASE_PATH, mmap_size=256 * 1024 * 1024, cache_size_kib=64 * 1024, cached_statements=256):
+        self.database_path = database_path
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.cached_statements = cached_statements
+
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.connections = []
+        self.connections_opened = 0
+        self.statements_executed = 0
+        self.statement_log = None  # a list while sql_profiler.capture() is active
+
+    def count_statement(self, statement):
+        with self.lock:
+            self.statements_executed += 1
+        # Per thread as well, so instrumentation.py can tell which statements belong to a session
+        self.local.statements = getattr(self.local, "statements", 0) + 1
+
+        if self.statement_log is not None:
+            self.statement_log.append(statement)
+
+    def open(self):
+        connection = sqlite3.connect(
+            f"file:{self.database_path}?mode=ro", uri=True, check_same_thread=False, cached_statements=self.cached_statements
+        )
+
+        # The database is never written here, ingest.py switches it to WAL mode so these readers can run during an ingest
+        connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)};")
+        connection.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)};")
+        connection.execute("PRAGMA query_only = ON;")
+        connection.set_trace_callback(self.count_statement)
+
+        with self.lock:
+            self.connections.append(connection)
+            self.connections_opened += 1
+
+        return connection
+
+    def get(self):
+        """Return the connection of the current thread, it is opened on first use."""
+        # Connections must not be shared with a forked child process
+        if self.pid != os.getpid():
+            self.reset()
+
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.open()
+            self.local.connection = connection
+
+        return connection
+
+    @contextmanager
+    def connection(self):
+        yield self.get()
+
+    def close_all(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+            self.local = threading.local()
+
+    def stats(self):
+        return {
+            "database": self.database_path,
+            "open_connections": len(self.connections),
+            "connections_opened": self.connections_opened,
+            "statements_executed": self.statements_executed,
+        }
+
+
+_connection_managers = {}
+_connection_managers_lock = threading.Lock()
+
+def get_connection_manager(database_path=DATABASE_PATH):
+    with _connection_managers_lock:
+        if database_path not in _connection_managers:
+            _connection_managers[database_path] = ConnectionManager(database_path)
+        return _connection_managers[database_path]
+
+def thread_statements():
+    """Number of statements the current thread executed on the read-only connections."""
+    with _connection_managers_lock:
+        managers = list(_connection_managers.values())
+    return sum(getattr(manager.local, "statements", 0) for manager in managers)
+
+def get_connection(database_path=DATABASE_PATH):
+    """Reusable read-only connection of the current thread."""
+    return get_connection_manager(database_path).get()
+
+def connection(database_path=DATABASE_PATH):
+    """Context manager around get_connection: `with query_database.connection() as connection:`"""
+    return get_connection_manager(database_path).connection()
+
+def timed(function):
+    """Record every call of a query as a span, like instrumentation.timed(). instrumentation.py imports this module
+    to count the statements of a span, so it is only imported on the first call."""
+    timed_function = None
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        nonlocal timed_function
+        if timed_function is None:
+            import instrumentation
+            timed_function = instrumentation.timed()(function)
+        return timed_function(*args, **kwargs)
+
+    return wrapper
+
+# Countries that are named differently in the country_wise and the worldometer dataset
+COUNTRY_MAPPING = [
     ('Brunei', 'Brunei '),
     ('Burma', 'Myanmar'),
     ('Central African Republic', 'CAR'),
@@ -26,27 +146,95 @@ def mapping_datasets(cursor):
     ('United Arab Emirates', 'UAE'),
     ('United Kingdom', 'UK'),
     ('West Bank and Gaza', 'Palestine'),
-    ]
+]
+
+# China and Kosovo data does not exist in the worldometer dataset, the population in 2020 was gathered from worldbank.org
+POPULATION_OVERRIDES = {
+    "China": 1411100000,
+    "Kosovo": 1790152,
+}
+
+
+class PopulationResolver:
+    """In-memory index of the worldometer populations and the country name mapping.
+
+    Everything is read with a few queries when the resolver is created, after that names are resolved in
+    both directions and populations are looked up with dictionary lookups only.
+    """
+
+    def __init__(self, cursor):
+        self.to_worldometer_names = dict(COUNTRY_MAPPING)
+
+        # Pairs that were added to the data_mapping table by hand are used as well
+        try:
+            cursor.execute("SELECT DISTINCT country_wise_name, worldometer_name FROM data_mapping;")
+            self.to_worldometer_names.update(cursor.fetchall())
+        except sqlite3.OperationalError:  # data_mapping does not exist (yet)
+            pass
+
+        self.to_country_wise_names = {worldometer_name: country_wise_name for country_wise_name, worldometer_name in self.to_worldometer_names.items()}
+
+        cursor.execute("SELECT [Country.Region], [Population] FROM worldometer_data WHERE [Population] IS NOT NULL;")
+        self.worldometer_population = {country: int(population) for country, population in cursor.fetchall()}
+
+        # Countries per WHO region as they appear in complete_data, used for the continental and global sums
+        self.countries_per_region = {}
+        try:
+            cursor.execute("SELECT DISTINCT [WHO.Region], [Country.Region] FROM location;")
+            for region, country in cursor.fetchall():
+                self.countries_per_region.setdefault(region, set()).add(country)
+        except sqlite3.OperationalError:  # complete_data has not been ingested (yet)
+            pass
+
+        self.region_population = {
+            region: sum(self.population(country) or 0 for country in countries)
+            for region, countries in self.countries_per_region.items()
+        }
+
+        all_countries = set().union(*self.countries_per_region.values())
+        self.global_population = sum(self.population(country) or 0 for country in all_countries)
+
+    def to_worldometer(self, country):
+        """Name of the country in the worldometer dataset."""
+        return self.to_worldometer_names.get(country, country)
+
+    def to_country_wise(self, country):
+        """Name of the country in the country_wise dataset."""
+        return self.to_country_wise_names.get(country, country)
+
+    def population(self, country):
+        if country in POPULATION_OVERRIDES:
+            return POPULATION_OVERRIDES[country]
 
-    WHO_Region_Mapping = [
-        ('Eastern Mediterranean', 'EasternMediterranean'),
-        ('Western Pacific', 'WesternPacific'),
-        ('South-East Asia', 'South-EastAsia'),
-    ]
+        if country in self.worldometer_population:
+            return self.worldometer_population[country]
 
-    for country_wise_name, worldometer_name in country_mapping:
-        query = """
-        INSERT INTO data_mapping (country_wise_name, worldometer_name)
-        VALUES (?, ?);
-        """
-        cursor.execute(query, (country_wise_name, worldometer_name))
+        return self.worldometer_population.get(self.to_worldometer(country))
 
-    return
 
+_population_resolvers = {}
 
-def fetch_country_data(country):
+def database_file(cursor):
+    cursor.execute("PRAGMA database_list;")
+    return cursor.fetchone()[2]
+
+def get_population_resolver(cursor):
+    """Return the resolver of the database behind the cursor, it is only built once per database."""
+    path = database_file(cursor)
+
+    if path not in _population_resolvers:
+        _population_resolvers[path] = PopulationResolver(cursor)
+
+    return _population_resolvers[path]
+
+def clear_population_resolvers():
+    """Forget the resolvers, needed after worldometer_data or complete_data changed."""
+    _population_resolvers.clear()
+
+
+def fetch_country_data(country, connection=None):
     """Fetch relevant COVID-19 data for a given country from the database."""
-    connection = sqlite3.connect("Data/covid_database.db")
+    connection = connection or get_connection()
     cursor = connection.cursor()
 
     # Try looking up the value without the use of mapping
@@ -62,211 +250,147 @@ def fetch_country_data(country):
 
     # Check if the name corresponds to a name in the country_wise or worldometer dataset 
     if not result:
-         mapping_datasets(cursor)
-         mapping_list = ()
-
-         query = "SELECT [worldometer_name] FROM data_mapping WHERE [country_wise_name] = ?;"
-
-         cursor.execute(query, (country,))
-         queryResult = cursor.fetchone()
-         if queryResult: 
-            mapping_list = (country, str(queryResult[0]))
-
-         if not mapping_list:
-            query = "SELECT [country_wise_name] FROM data_mapping WHERE [worldometer_name] = ?;"
-            cursor.execute(query, (country,))
-            queryResult = cursor.fetchone()
-            if queryResult:
-                mapping_list = (str(queryResult[0]), country)
-
-         if mapping_list: # Lookup values with the help of the names in both datasets
-            mapped_country = str(mapping_list[0])
+        resolver = get_population_resolver(cursor)
+        country_wise_name = resolver.to_country_wise(country)
+        worldometer_name = resolver.to_worldometer(country_wise_name)
 
+        if (country_wise_name, worldometer_name) != (country, country): # Lookup values with the help of the names in both datasets
             query = """
             SELECT cw.[Active], cw.[New.cases], cw.[Recovered], cw.[New.recovered], cw.[Deaths], cw.[New.deaths],
             wd.[Population], wd.[ActiveCases], wd.[TotalDeaths], wd.[TotalRecovered]
-            FROM country_wise cw
-            JOIN data_mapping cm ON cw.[Country.Region] = cm.country_wise_name
-            JOIN worldometer_data wd ON cm.worldometer_name = wd.[Country.Region]
-            WHERE cw.[Country.Region] = ?;
+            FROM country_wise cw, worldometer_data wd
+            WHERE cw.[Country.Region] = ? AND wd.[Country.Region] = ?;
             """
-            cursor.execute(query, (mapped_country,))
+            cursor.execute(query, (country_wise_name, worldometer_name))
             result = cursor.fetchone()
 
-    connection.close()
-
     return result  # Returns a tuple with all necessary values or None if not found
 
+def day_ordinal(value):
+    """'YYYY-MM-DD' (or a date) as the number of days since 1970-01-01, the Day column of complete_data."""
+    return date.fromisoformat(str(value)[:10]).toordinal() - EPOCH_ORDINAL
+
 def date_ranges(cursor):
-    query = """
-    SELECT DATE(MIN(date)) AS min_date, DATE(MAX(date)) AS max_date
-    FROM complete_data;
-    """
+    # The bounds are kept up to date by ingest.py, reading them does not depend on the size of complete_data
+    cursor.execute("SELECT key, value FROM metadata WHERE key IN ('complete_first_day', 'complete_last_day');")
+    bounds = dict(cursor.fetchall())
 
-    cursor.execute(query)
+    if len(bounds) < 2:
+        # The primary key starts with Day, so MIN and MAX are index lookups as well
+        cursor.execute("SELECT MIN([Day]), MAX([Day]) FROM complete_facts;")
+        bounds = dict(zip(("complete_first_day", "complete_last_day"), cursor.fetchone()))
+        if bounds["complete_first_day"] is None:
+            return None, None
 
-    result = cursor.fetchone()
+    first_date = date.fromordinal(EPOCH_ORDINAL + int(bounds["complete_first_day"]))
+    last_date = date.fromordinal(EPOCH_ORDINAL + int(bounds["complete_last_day"]))
 
-    return result
+    return first_date.isoformat(), last_date.isoformat()
 
 def Country_Population(cursor, country):
-    # China and Kosovo data does not exist in the worldometer dataset, the population in 2020 was gathered from worldbank.org
-    if country == "China":
-        return 1411100000 # From worldbank.org
-    
-    if country == "Kosovo":
-        return 1790152 # From worldbank.org
-
-    query = """
-    SELECT [Population] 
-    FROM worldometer_data 
-    WHERE [Country.Region] = ?
-    """
-
-    cursor.execute(query, (country,))
-
-    result = cursor.fetchone()
-    if result: 
-        return int(result[0])
-
-    if not result:
-        mapping_datasets(cursor)
-        mapping_list = ()
-
-        query = """
-        SELECT [worldometer_name] 
-        FROM data_mapping 
-        WHERE [country_wise_name] = ?;
-        """
-
-        cursor.execute(query, (country,))
-        queryResult = cursor.fetchone()
-        if queryResult: 
-            mapping_list = (country, str(queryResult[0]))
-
-        if not mapping_list:
-            query = "SELECT [country_wise_name] FROM data_mapping WHERE [worldometer_name] = ?;"
-            cursor.execute(query, (country,))
-            queryResult = cursor.fetchone()
-            if queryResult:
-                mapping_list = (str(queryResult[0]), country)
-
-        if mapping_list:
-            query = """
-            SELECT [Population] 
-            FROM worldometer_data 
-             WHERE [Country.Region] = ?
-             """
-
-            cursor.execute(query, (mapping_list[1],))
-
-            result = cursor.fetchone()
-            return int(result[0])
-    
-    return None
+    return get_population_resolver(cursor).population(country)
 
+@timed
 def Total_Cases_Per_Day_Global(connection, startdate, enddate):
     query = """
-    SELECT date,
+    SELECT DATE([Day] * 86400, 'unixepoch') AS date,
            SUM(Confirmed) AS Total_Confirmed_Cases,
            SUM(Deaths) AS Total_Deaths,
            SUM(Recovered) AS Total_Recovered,
            SUM(Active) AS Total_Active_Cases
-    FROM complete_data
-    WHERE date BETWEEN ? AND ?
-    GROUP BY date
-    ORDER BY date;
+    FROM complete_facts
+    WHERE [Day] BETWEEN ? AND ?
+    GROUP BY [Day]
+    ORDER BY [Day];
     """
 
-    df = pd.read_sql(query, connection, params=(startdate, enddate))
-
-    cursor = connection.cursor()
-
-    query = """
-    SELECT DISTINCT [Country.Region]
-    FROM complete_data
-    """
-
-    cursor.execute(query)
-
-    result = cursor.fetchall()
-
-    population = 0
-
-    for country in result:
-        population += Country_Population(cursor, country[0])
-
-    df['Population'] = population
+    df = pd.read_sql(query, connection, params=(day_ordinal(startdate), day_ordinal(enddate)))
+    df['Population'] = get_population_resolver(connection.cursor()).global_population
 
     return df
 
+@timed
 def Total_Cases_Per_Day_Continental(connection, continent, startdate, enddate):
     query = """
-    SELECT date,
+    SELECT DATE([Day] * 86400, 'unixepoch') AS date,
            SUM(Confirmed) AS Total_Confirmed_Cases,
            SUM(Deaths) AS Total_Deaths,
            SUM(Recovered) AS Total_Recovered,
            SUM(Active) AS Total_Active_Cases
-    FROM complete_data
-    WHERE [WHO.Region] = ? AND date BETWEEN ? AND ?
-    GROUP BY date
-    ORDER BY date;
+    FROM complete_facts
+    WHERE location_id IN (SELECT location_id FROM location WHERE [WHO.Region] = ?) AND [Day] BETWEEN ? AND ?
+    GROUP BY [Day]
+    ORDER BY [Day];
     """
 
-    df = pd.read_sql(query, connection, params=(continent, startdate, enddate))
-
-    cursor = connection.cursor()
-
-    query = """
-    SELECT DISTINCT [Country.Region]
-    FROM complete_data
-    WHERE [WHO.Region] = ? 
-    """
-
-    cursor.execute(query, (continent,))
-
-    result = cursor.fetchall()
+    df = pd.read_sql(query, connection, params=(continent, day_ordinal(startdate), day_ordinal(enddate)))
+    df['Population'] = get_population_resolver(connection.cursor()).region_population.get(continent, 0)
 
-    population = 0
-
-    for country in result:
-        population += Country_Population(cursor, country[0])
-
-    df['Population'] = population
-    
     return df
 
+@timed
 def Total_Cases_Per_Day_Country(connection, continent, country, startdate, enddate):
     query = """
-    SELECT date,
+    SELECT DATE([Day] * 86400, 'unixepoch') AS date,
            SUM(Confirmed) AS Total_Confirmed_Cases,
            SUM(Deaths) AS Total_Deaths,
            SUM(Recovered) AS Total_Recovered,
            SUM(Active) AS Total_Active_Cases
-    FROM complete_data
-    WHERE [WHO.Region] = ? AND [Country.Region] = ? AND date BETWEEN ? AND ?
-    GROUP BY date
-    ORDER BY date;
+    FROM complete_facts
+    WHERE location_id IN (SELECT location_id FROM location WHERE [WHO.Region] = ? AND [Country.Region] = ?) AND [Day] BETWEEN ? AND ?
+    GROUP BY [Day]
+    ORDER BY [Day];
     """
 
-    df = pd.read_sql(query, connection, params=(continent, country, startdate, enddate))
+    df = pd.read_sql(query, connection, params=(continent, country, day_ordinal(startdate), day_ordinal(enddate)))
     df['Population'] = Country_Population(connection.cursor(), country)
 
     return df
 
+@timed
 def Total_Cases_Per_Day_Province(connection, continent, country, province, startdate, enddate):
     query = """
-    SELECT date,
+    SELECT DATE([Day] * 86400, 'unixepoch') AS date,
            SUM(Confirmed) AS Total_Confirmed_Cases,
            SUM(Deaths) AS Total_Deaths,
            SUM(Recovered) AS Total_Recovered,
            SUM(Active) AS Total_Active_Cases
-    FROM complete_data
-    WHERE [WHO.Region] = ? AND [Country.Region] = ?  AND [Province.State] = ? AND date BETWEEN ? AND ?
-    GROUP BY date
-    ORDER BY date;
+    FROM complete_facts
+    WHERE location_id = (SELECT location_id FROM location WHERE [WHO.Region] = ? AND [Country.Region] = ? AND [Province.State] = ?)
+      AND [Day] BETWEEN ? AND ?
+    GROUP BY [Day]
+    ORDER BY [Day];
     """
 
-    df = pd.read_sql(query, connection, params=(continent, country, province, startdate, enddate))
+    df = pd.read_sql(query, connection, params=(continent, country, province, day_ordinal(startdate), day_ordinal(enddate)))
 
     return df
+
+@timed
+def Top_US_Counties(connection, metric, k=5):
+    """The k counties with the highest total of metric ("Confirmed" or "Deaths"), read from county_totals."""
+    if metric not in ("Confirmed", "Deaths"):
+        raise ValueError(f"Unknown metric {metric}, use Confirmed or Deaths")
+
+    query = f"""
+    SELECT Admin2, Province_State, {metric}
+    FROM county_totals
+    ORDER BY {metric} DESC, Province_State, Admin2
+    LIMIT ?;
+    """
+
+    return pd.read_sql(query, connection, params=(k,))
+
+@timed
+def Top_US_States(connection, metric, k=5):
+    if metric not in ("Confirmed", "Deaths"):
+        raise ValueError(f"Unknown metric {metric}, use Confirmed or Deaths")
+
+    query = f"""
+    SELECT Province_State, {metric}
+    FROM state_totals
+    ORDER BY {metric} DESC, Province_State
+    LIMIT ?;
+    """
+
+    return pd.read_sql(query, connection, params=(k,))
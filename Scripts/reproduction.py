@@ -0,0 +1,160 @@
+import threading
+import numpy as np
+import pandas as pd
+import aggregation
+import instrumentation
+
+# Estimator with the value given in the assignment
+GAMMA = 1 / 4.5
+WINDOW = 7
+
+
+# All functions below work on flat arrays that are sorted by (location, date). starts is a boolean array that is
+# True on the first row of every location, so differences and windows never run from one location into the next.
+
+def sort_by_location(df, location_columns, date_column):
+    """Sort the frame once by location and date, returns the sorted frame and the segment starts."""
+    codes = [pd.factorize(df[column])[0] for column in location_columns]
+    order = np.lexsort([df[date_column].to_numpy()] + codes[::-1])
+    df = df.iloc[order].reset_index(drop=True)
+
+    return df, segment_starts([code[order] for code in codes])
+
+
+def segment_starts(keys):
+    """True where any of the key arrays differs from the previous row."""
+    length = len(keys[0])
+    starts = np.zeros(length, dtype=bool)
+    if length:
+        starts[0] = True
+        for key in keys:
+            starts[1:] |= key[1:] != key[:-1]
+
+    return starts
+
+
+def grouped_diff(values, starts):
+    """diff() per location, the first day of every location is NaN."""
+    values = np.asarray(values, dtype=np.float64)
+    result = np.empty_like(values)
+    result[1:] = values[1:] - values[:-1]
+    result[starts] = np.nan
+
+    return result
+
+
+def grouped_ffill(values, starts):
+    """ffill() per location, a value is never carried into the next location."""
+    values = np.asarray(values, dtype=np.float64)
+    positions = np.arange(len(values))
+
+    source = np.where(~np.isnan(values) | starts, positions, 0)
+    np.maximum.accumulate(source, out=source)
+
+    return values[source]
+
+
+def grouped_rolling_mean(values, starts, window=WINDOW, min_periods=1):
+    """rolling(window, min_periods).mean() per location, NaN values are skipped like pandas does."""
+    values = np.asarray(values, dtype=np.float64)
+    positions = np.arange(len(values))
+    first = np.maximum.accumulate(np.where(starts, positions, 0))
+
+    total = np.zeros_like(values)
+    count = np.zeros(len(values), dtype=np.int64)
+    for lag in range(window):
+        inside = positions - lag >= first
+        shifted = values[np.where(inside, positions - lag, 0)]
+        valid = inside & ~np.isnan(shifted)
+        total += np.where(valid, shifted, 0)
+        count += valid
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count >= min_periods, total / count, np.nan)
+
+
+def reproduction_number(deaths, active, confirmed, population, starts, gamma=GAMMA):
+    """mu, beta and the reproduction number of createDataFrame for every row, returns (mu, beta, R)."""
+    deaths, active, confirmed, population = (np.asarray(values, dtype=np.float64) for values in (deaths, active, confirmed, population))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mu = grouped_diff(deaths, starts) / active
+        beta = (grouped_diff(active, starts) + mu * active + active * gamma) * population / (active * (population - confirmed))
+
+    return mu, beta, beta * gamma
+
+
+class ReproductionStore:
+    """R(t) of every location of one level in flat arrays, location i is rows offsets[i]:offsets[i + 1]."""
+
+    def __init__(self, keys, offsets, dates, columns):
+        self.keys = keys
+        self.index = {key: position for position, key in enumerate(keys)}
+        self.offsets = offsets
+        self.dates = dates
+        self.columns = columns
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def series(self, key):
+        """Frame with the Date and all stored columns of one location."""
+        position = self.index[key]
+        rows = slice(self.offsets[position], self.offsets[position + 1])
+
+        df = pd.DataFrame({name: values[rows] for name, values in self.columns.items()})
+        df.insert(0, "Date", pd.to_datetime(self.dates[rows]))
+        return df
+
+    def nbytes(self):
+        return self.offsets.nbytes + self.dates.nbytes + sum(values.nbytes for values in self.columns.values())
+
+
+def cube_store(cube, level="country", window=WINDOW):
+    """Compute R(t) for all countries or WHO regions of the cube in one pass.
+
+    The cube is already ordered by (location, day), so the present cells only have to be flattened.
+    """
+    if level == "country":
+        values, rows, populations, index = cube.country, cube.country_rows, cube.country_population, cube.country_index
+    elif level == "region":
+        values, rows, populations, index = cube.region, cube.region_rows, cube.region_population, cube.region_index
+    else:
+        raise ValueError(f"Unknown level {level}, use country or region")
+
+    location, day = np.nonzero(rows > 0)
+    cells = values[location, day]
+    starts = segment_starts([location])
+
+    confirmed, deaths, _, active = (cells[:, column] for column in range(len(aggregation.METRICS)))
+    mu, beta, reproduction = reproduction_number(deaths, active, confirmed, populations[location], starts)
+
+    keys = sorted(index, key=index.get)
+    offsets = np.searchsorted(location, np.arange(len(keys) + 1)).astype(np.int64)
+
+    return ReproductionStore(keys, offsets, cube.dates[day].astype("datetime64[D]"), {
+        "mu": mu,
+        "beta": beta,
+        "Reproduction Number": reproduction,
+        f"Reproduction Number ({window} day mean)": grouped_rolling_mean(reproduction, starts, window),
+    })
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+@instrumentation.timed("reproduction.get_store")
+def get_store(level="country"):
+    """Store for the current cube, it is computed again when the complete.csv snapshot changes."""
+    cube = aggregation.get_cube()
+
+    # The data service asks from several threads at once, a store is computed by one of them and reused by the others
+    with _stores_lock:
+        for key in [key for key in _stores if key[1] != cube.version]:
+            del _stores[key]
+
+        if (level, cube.version) not in _stores:
+            _stores[(level, cube.version)] = cube_store(cube, level)
+
+        return _stores[(level, cube.version)]
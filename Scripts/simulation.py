@@ -0,0 +1,83 @@
+import numpy as np
+
+# numba is optional, without it the NumPy version is used
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Position of the compartments in the first axis of the simulation output
+S, I, R, D = 0, 1, 2, 3
+
+
+def step_numpy(state, alpha, beta, gamma, mu, N):
+    """Discrete SIRD recurrence, every day is computed for all parameter sets at once."""
+    for t in range(1, state.shape[2]):
+        S_prev = state[S, :, t - 1]
+        I_prev = state[I, :, t - 1]
+        R_prev = state[R, :, t - 1]
+        D_prev = state[D, :, t - 1]
+
+        infections = beta * S_prev * I_prev / N
+
+        # Same order of operations as the original loops, so the results are identical
+        delta_S = alpha * R_prev - infections
+        delta_I = infections - mu * I_prev - gamma * I_prev
+        delta_R = gamma * I_prev - alpha * R_prev
+        delta_D = mu * I_prev
+
+        state[S, :, t] = S_prev + delta_S
+        state[I, :, t] = I_prev + delta_I
+        state[R, :, t] = R_prev + delta_R
+        state[D, :, t] = D_prev + delta_D
+
+    return state
+
+
+def step_loops(state, alpha, beta, gamma, mu, N):
+    for n in range(state.shape[1]):
+        for t in range(1, state.shape[2]):
+            S_prev = state[S, n, t - 1]
+            I_prev = state[I, n, t - 1]
+            R_prev = state[R, n, t - 1]
+            D_prev = state[D, n, t - 1]
+
+            infections = beta[n] * S_prev * I_prev / N[n]
+
+            state[S, n, t] = S_prev + (alpha[n] * R_prev - infections)
+            state[I, n, t] = I_prev + (infections - mu[n] * I_prev - gamma[n] * I_prev)
+            state[R, n, t] = R_prev + (gamma[n] * I_prev - alpha[n] * R_prev)
+            state[D, n, t] = D_prev + mu[n] * I_prev
+
+    return state
+
+
+# Compiled version of the same recurrence, only available when numba is installed
+step_compiled = njit(cache=True)(step_loops) if njit else None
+
+
+def simulate_sird(S0, I0, R0, D0, alpha, beta, gamma, mu, N, days, compiled=None):
+    """Simulate the SIRD model for a whole ensemble of parameter sets.
+
+    Every argument except days can be a scalar or an array with one value per parameter set.
+    Returns an array of shape (4, number of parameter sets, days), index it with S, I, R and D.
+    When compiled is None the numba version is used if numba is installed.
+    """
+    initial = np.broadcast_arrays(*[np.atleast_1d(np.asarray(value, dtype=np.float64)) for value in (S0, I0, R0, D0, alpha, beta, gamma, mu, N)])
+    S0, I0, R0, D0, alpha, beta, gamma, mu, N = [np.ascontiguousarray(value) for value in initial]
+
+    state = np.empty((4, len(S0), days), dtype=np.float64)
+    state[S, :, 0] = S0
+    state[I, :, 0] = I0
+    state[R, :, 0] = R0
+    state[D, :, 0] = D0
+
+    if compiled is None:
+        compiled = step_compiled is not None
+
+    if compiled:
+        if step_compiled is None:
+            raise ImportError("The compiled SIRD simulation needs numba to be installed")
+        return step_compiled(state, alpha, beta, gamma, mu, N)
+
+    return step_numpy(state, alpha, beta, gamma, mu, N)
@@ -0,0 +1,458 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# Columnar snapshots of the csv files. Every column is stored as its own .npy file so it can be
+# memory mapped, which lets several processes share the same pages instead of parsing the csv again.
+#
+# Every build is written to a private directory that is renamed to the sha256 of the csv once it is complete, and
+# the manifest, which names that directory, is replaced last. Files of a published build are never written again,
+# so processes that rebuild at the same time can not mix their files and a reader always sees the columns its
+# manifest describes.
+SNAPSHOT_DIRECTORY = "Data/snapshot"
+
+# Builds that were replaced are kept this many times over, a process that read an older manifest can still open them
+KEEP_VERSIONS = 2
+# Unfinished builds of crashed processes are removed after this many seconds
+STALE_BUILD_SECONDS = 24 * 60 * 60
+# Once this many deltas are appended they are merged with the snapshot into a new build, see compact_deltas
+COMPACT_DELTAS = 8
+# mkdtemp and mkstemp only give the owner access, the published files are mapped by processes of other users too
+SHARED_DIRECTORY_MODE = 0o755
+SHARED_FILE_MODE = 0o644
+
+SOURCES = {
+    "complete": "Data/complete.csv",
+    "day_wise": "Data/day_wise.csv",
+}
+
+KEY_COLUMNS = ["WHO.Region", "Country.Region", "Province.State", "Date"]
+COUNT_COLUMNS = ["Confirmed", "Deaths", "Recovered", "Active"]
+
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def date_to_day(dates):
+    """Convert dates to int32 day ordinals (days since 1970-01-01)."""
+    dates = np.asarray(pd.to_datetime(dates), dtype="datetime64[D]")
+    return (dates - EPOCH).astype(np.int32)
+
+
+def day_to_date(days):
+    """Convert int32 day ordinals back to datetime64 values."""
+    return (EPOCH + np.asarray(days, dtype="timedelta64[D]")).astype("datetime64[ns]")
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_complete_csv(path):
+    df = pd.read_csv(path, parse_dates=["Date"])
+    df[COUNT_COLUMNS] = df[COUNT_COLUMNS].fillna(0)
+
+    # Keep only 1 row from rows that have the same WHO.Region, Country.Region, Province.State and Date as another
+    df.drop_duplicates(KEY_COLUMNS, inplace=True)
+    return df
+
+
+def read_day_wise_csv(path):
+    return pd.read_csv(path, parse_dates=["Date"])
+
+
+READERS = {
+    "complete": read_complete_csv,
+    "day_wise": read_day_wise_csv,
+}
+
+
+def encode_column(series, kind=None):
+    """Return the typed array and manifest entry for a single column, kind forces the kind of an earlier snapshot."""
+    if series.name == "Date":
+        return date_to_day(series), {"kind": "day"}
+
+    if kind == "category" or series.dtype == object or isinstance(series.dtype, (pd.CategoricalDtype, pd.StringDtype)):
+        categorical = pd.Categorical(series)
+        categories = [str(value) for value in categorical.categories]
+        dtype = np.int16 if len(categories) < np.iinfo(np.int16).max else np.int32
+        return categorical.codes.astype(dtype), {"kind": "category", "categories": categories}
+
+    if series.name in COUNT_COLUMNS or pd.api.types.is_integer_dtype(series.dtype):
+        return series.fillna(0).to_numpy().astype(np.int32), {"kind": "int32"}
+
+    return series.to_numpy().astype(np.float64), {"kind": "float64"}
+
+
+def write_columns(directory, df, kinds=None):
+    """Write every column of the frame as its own .npy file, returns the manifest entries of the columns.
+
+    The directory must be private to this process (see private_directory), the files are written in place.
+    """
+    columns = {}
+    for position, column in enumerate(df.columns):
+        values, entry = encode_column(df[column], (kinds or {}).get(column))
+        entry["file"] = f"{position:02d}.npy"
+        np.save(os.path.join(directory, entry["file"]), values)
+        columns[column] = entry
+
+    return columns
+
+
+def private_directory(parent):
+    """A new directory only this process writes to, it is moved into place with publish_directory."""
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=".build-", dir=parent)
+
+
+def publish_directory(build, target):
+    """Move a finished build to its final name, a single rename so it appears complete or not at all.
+
+    When another process published the same target first, its copy is kept and this build is thrown away.
+    """
+    os.chmod(build, SHARED_DIRECTORY_MODE)
+    try:
+        os.rename(build, target)
+    except OSError:
+        if not os.path.isdir(target):
+            raise
+        shutil.rmtree(build, ignore_errors=True)
+
+    return os.path.basename(target)
+
+
+def snapshot_directory(name, manifest):
+    return os.path.join(SNAPSHOT_DIRECTORY, name, manifest["directory"])
+
+
+def build_snapshot(name, source=None):
+    """Parse the csv once and write it as a columnar snapshot."""
+    source = source or SOURCES[name]
+    root = os.path.join(SNAPSHOT_DIRECTORY, name)
+
+    # Taken before reading, a change of the csv while it is read makes the next ensure_snapshot build again
+    stat = os.stat(source)
+    sha256 = file_hash(source)
+    df = READERS[name](source)
+
+    build = private_directory(root)
+    columns = write_columns(build, df)
+    # Processes that rebuild from the same csv write the same files, only the first one is published
+    directory = publish_directory(build, os.path.join(root, sha256[:16]))
+
+    manifest = {
+        "source": source,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": sha256,
+        "rows": len(df),
+        "directory": directory,
+        "columns": columns,
+    }
+    write_manifest(root, manifest)
+    remove_old_builds(name, directory)
+
+    return manifest
+
+
+def write_manifest(directory, manifest):
+    """Replace the manifest in one step, the temporary file is unique so concurrent writers do not collide."""
+    descriptor, temporary_path = tempfile.mkstemp(prefix=".manifest-", suffix=".tmp", dir=directory)
+    with os.fdopen(descriptor, "w") as file:
+        json.dump(manifest, file)
+    os.chmod(temporary_path, SHARED_FILE_MODE)
+    os.replace(temporary_path, os.path.join(directory, "manifest.json"))
+
+
+def remove_old_builds(name, current):
+    """Keep the current build and the KEEP_VERSIONS newest other ones, remove older builds and stale unfinished ones.
+
+    Other processes may clean up at the same time, so entries can disappear while this runs. The build the manifest
+    names right now is kept as well, it can be the one of another process that published after this one.
+    """
+    root = os.path.join(SNAPSHOT_DIRECTORY, name)
+    published = read_manifest(name) or {}
+    builds = []
+    for entry in os.scandir(root):
+        try:
+            if entry.name.startswith(".build-"):
+                if time.time() - entry.stat().st_mtime > STALE_BUILD_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.is_dir() and entry.name not in (current, published.get("directory")):
+                builds.append((entry.stat().st_mtime, entry.path))
+            elif entry.name == "deltas":
+                # Layout of an older version, the columns and deltas were stored next to the manifest
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.endswith(".npy"):
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    for _, path in sorted(builds, reverse=True)[KEEP_VERSIONS:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def read_manifest(name):
+    manifest_path = os.path.join(SNAPSHOT_DIRECTORY, name, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def ensure_snapshot(name, source=None):
+    """Return a valid manifest, rebuilding the snapshot only if the source csv changed."""
+    source = source or SOURCES[name]
+    manifest = read_manifest(name)
+
+    # Manifests of an older version have no build directory
+    if manifest is None or manifest["source"] != source or "directory" not in manifest:
+        return build_snapshot(name, source)
+
+    # A build can only be missing when processes that rebuilt at the same time removed each other's builds
+    if not os.path.isdir(snapshot_directory(name, manifest)):
+        return build_snapshot(name, source)
+
+    stat = os.stat(source)
+    if stat.st_mtime_ns == manifest["mtime_ns"] and stat.st_size == manifest["size"]:
+        return manifest
+
+    # The file was touched, only rebuild if the content actually changed
+    if stat.st_size == manifest["size"] and file_hash(source) == manifest["sha256"]:
+        manifest["mtime_ns"] = stat.st_mtime_ns
+        write_manifest(os.path.join(SNAPSHOT_DIRECTORY, name), manifest)
+        return manifest
+
+    return build_snapshot(name, source)
+
+
+def delta_history(manifest):
+    """Every delta appended to the csv, the ones that were compacted into the build first."""
+    return manifest.get("compacted", []) + manifest.get("deltas", [])
+
+
+def manifest_version(manifest):
+    """Short identifier of the snapshot content, it changes with every appended delta."""
+    deltas = delta_history(manifest)
+    if not deltas:
+        return manifest["sha256"][:16]
+
+    sha = hashlib.sha256(manifest["sha256"].encode())
+    for delta in deltas:
+        sha.update(delta["sha256"].encode())
+    return sha.hexdigest()[:16]
+
+
+def snapshot_version(name):
+    """Short identifier of the snapshot content, usable as a cache key."""
+    return manifest_version(ensure_snapshot(name))
+
+
+def append_delta(name, df, sha256):
+    """Store the rows of a delta file next to the snapshot, only the delta itself is written.
+
+    df has the columns of the snapshot, every key occurs once. Rows of a delta replace rows of the csv and of
+    earlier deltas with the same key. The positions of the replaced rows are stored with the delta, so readers do
+    not have to look for duplicates. Every COMPACT_DELTAS deltas the snapshot is compacted. Returns the new manifest.
+    """
+    manifest = ensure_snapshot(name)
+    directory = snapshot_directory(name, manifest)
+    deltas = manifest.setdefault("deltas", [])
+
+    kinds = {column: entry["kind"] for column, entry in manifest["columns"].items()}
+    parent = os.path.join(directory, "deltas")
+    build = private_directory(parent)
+    columns = write_columns(build, df[list(manifest["columns"])], kinds)
+
+    replaced = None
+    if all(column in manifest["columns"] for column in KEY_COLUMNS):
+        replaced = replaced_rows(*concatenate_parts(manifest, load_columns(directory, manifest["columns"]), directory), df)
+        np.save(os.path.join(build, "replaced.npy"), replaced)
+
+    # Appends are serialized by the database transaction of ingest.append_deltas. A part with this name is left
+    # over from an append that failed before its manifest was written, no manifest refers to it
+    target = os.path.join(parent, f"{len(deltas) + 1:04d}-{sha256[:16]}")
+    shutil.rmtree(target, ignore_errors=True)
+    part = publish_directory(build, target)
+
+    delta = {"part": part, "sha256": sha256, "rows": len(df), "columns": columns}
+    if replaced is not None:
+        delta["replaced"] = len(replaced)
+    if "Date" in df and len(df):
+        delta["first_day"] = int(date_to_day([df["Date"].min()])[0])
+    deltas.append(delta)
+    delta["version"] = manifest_version(manifest)
+
+    if len(deltas) >= COMPACT_DELTAS:
+        return compact_deltas(name, manifest)
+
+    write_manifest(os.path.join(SNAPSHOT_DIRECTORY, name), manifest)
+    return manifest
+
+
+def replaced_rows(columns, arrays, keep, df):
+    """Positions of the rows that are still current and have the key of a row of df, in the concatenation of the
+    snapshot and its deltas."""
+    codes, delta_codes = [], []
+    for column in KEY_COLUMNS:
+        if columns[column]["kind"] == "category":
+            position = {category: code for code, category in enumerate(columns[column]["categories"])}
+            # -1 is a missing value, a location that is not in the snapshot yet (-2) does not replace anything
+            delta_values = [-1 if pd.isna(value) else position.get(str(value), -2) for value in df[column]]
+            delta_codes.append(np.array(delta_values, dtype=np.int64))
+        else:
+            delta_codes.append(date_to_day(df[column]).astype(np.int64))
+        codes.append(np.asarray(arrays[column]).astype(np.int64))
+
+    # One integer per key, so the rows can be matched with np.isin
+    low = [min(values.min(initial=0), delta.min(initial=0)) for values, delta in zip(codes, delta_codes)]
+    shape = [max(values.max(initial=0), delta.max(initial=0)) - start + 1 for values, delta, start in zip(codes, delta_codes, low)]
+    keys = np.ravel_multi_index([values - start for values, start in zip(codes, low)], shape)
+    delta_keys = np.ravel_multi_index([values - start for values, start in zip(delta_codes, low)], shape)
+
+    return np.flatnonzero(keep & np.isin(keys, delta_keys))
+
+
+def compact_deltas(name, manifest):
+    """Write the snapshot merged with its deltas as a new build, so readers map it again without merging."""
+    root = os.path.join(SNAPSHOT_DIRECTORY, name)
+    directory = snapshot_directory(name, manifest)
+    manifest, arrays = merge_deltas(manifest, load_columns(directory, manifest["columns"]), directory)
+
+    build = private_directory(root)
+    columns = {}
+    for position, (column, entry) in enumerate(manifest["columns"].items()):
+        columns[column] = dict(entry, file=f"{position:02d}.npy")
+        np.save(os.path.join(build, columns[column]["file"]), arrays[column])
+    directory = publish_directory(build, os.path.join(root, f"{manifest['sha256'][:16]}-{manifest_version(manifest)}"))
+
+    # The deltas are kept in the manifest without their parts, the version and the days they changed stay known
+    compacted = [{key: value for key, value in delta.items() if key not in ("part", "columns")} for delta in delta_history(manifest)]
+    manifest = dict(manifest, directory=directory, columns=columns, deltas=[], compacted=compacted)
+    write_manifest(root, manifest)
+    remove_old_builds(name, directory)
+
+    return manifest
+
+
+def load_columns(directory, columns):
+    return {column: np.load(os.path.join(directory, entry["file"]), mmap_mode="r") for column, entry in columns.items()}
+
+
+def concatenate_parts(manifest, arrays, directory):
+    """Concatenate the snapshot with its deltas, the category codes of every part are mapped onto shared categories.
+
+    Returns the columns, the concatenated arrays and a mask of the rows that were not replaced by a later delta.
+    """
+    parts = [(manifest["columns"], arrays)]
+    replaced = []
+    for delta in manifest.get("deltas", []):
+        part = os.path.join(directory, "deltas", delta["part"])
+        parts.append((delta["columns"], load_columns(part, delta["columns"])))
+        if "replaced" in delta:
+            replaced.append(np.load(os.path.join(part, "replaced.npy")))
+
+    columns = {}
+    merged = {}
+    for column, entry in manifest["columns"].items():
+        if entry["kind"] != "category":
+            columns[column] = entry
+            merged[column] = np.concatenate([np.asarray(part_arrays[column]) for _, part_arrays in parts])
+            continue
+
+        categories = sorted(set().union(*(part_columns[column]["categories"] for part_columns, _ in parts)))
+        position = {category: code for code, category in enumerate(categories)}
+        dtype = np.int16 if len(categories) < np.iinfo(np.int16).max else np.int32
+
+        codes = []
+        for part_columns, part_arrays in parts:
+            # The extra -1 at the end keeps missing values (code -1) missing
+            remap = np.array([position[category] for category in part_columns[column]["categories"]] + [-1], dtype=dtype)
+            codes.append(remap[np.asarray(part_arrays[column])])
+
+        columns[column] = dict(entry, categories=categories)
+        merged[column] = np.concatenate(codes)
+
+    keep = np.ones(len(next(iter(merged.values()))), dtype=bool)
+    if len(replaced) == len(manifest.get("deltas", [])):
+        for positions in replaced:
+            keep[positions] = False
+    elif all(column in merged for column in KEY_COLUMNS):
+        # Deltas of an older version do not name the rows they replace, the last row of every key wins
+        keys = np.stack([merged[column].astype(np.int64) for column in KEY_COLUMNS], axis=1)
+        _, last_from_end = np.unique(keys[::-1], axis=0, return_index=True)
+        keep[:] = False
+        keep[len(keys) - 1 - last_from_end] = True
+
+    return columns, merged, keep
+
+
+def merge_deltas(manifest, arrays, directory):
+    """The snapshot with its deltas applied, rows replaced by a later delta are left out."""
+    columns, merged, keep = concatenate_parts(manifest, arrays, directory)
+    if not keep.all():
+        merged = {column: values[keep] for column, values in merged.items()}
+
+    return dict(manifest, columns=columns, rows=int(keep.sum())), merged
+
+
+def open_snapshot(name):
+    """Memory map every column of the snapshot. Returns the manifest and a dict of read-only arrays.
+
+    When deltas were appended the columns are merged with them in memory instead.
+    """
+    for attempt in range(2):
+        manifest = ensure_snapshot(name)
+        directory = snapshot_directory(name, manifest)
+        try:
+            arrays = load_columns(directory, manifest["columns"])
+            if manifest.get("deltas"):
+                return merge_deltas(manifest, arrays, directory)
+            return manifest, arrays
+        except FileNotFoundError:
+            # Another process replaced the snapshot and removed this build in the meantime, read the new manifest
+            if attempt:
+                raise
+
+
+def snapshot_to_dataframe(name, categorical=True):
+    manifest, arrays = open_snapshot(name)
+
+    data = {}
+    for column, entry in manifest["columns"].items():
+        values = arrays[column]
+        if entry["kind"] == "day":
+            data[column] = day_to_date(values)
+        elif entry["kind"] == "category":
+            data[column] = pd.Categorical.from_codes(np.asarray(values), entry["categories"])
+            if not categorical:
+                data[column] = np.asarray(data[column], dtype=object)
+        else:
+            data[column] = np.asarray(values)
+
+    return pd.DataFrame(data)
+
+
+def load_complete(categorical=True):
+    """complete.csv with NAs filled and duplicates dropped, loaded from the snapshot."""
+    return snapshot_to_dataframe("complete", categorical)
+
+
+def load_day_wise():
+    """day_wise.csv loaded from the snapshot."""
+    return snapshot_to_dataframe("day_wise", categorical=False)
+
+
+if __name__ == "__main__":
+    for name in SOURCES:
+        manifest = build_snapshot(name)
+        print(f"{name}: {manifest['rows']} rows written to {os.path.join(SNAPSHOT_DIRECTORY, name)}")
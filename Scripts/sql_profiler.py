@@ -0,0 +1,376 @@
+import argparse
+import json
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+import datasets
+import ingest
+import query_database
+
+# Profiling mode for the SQL of query_database: the statements are captured from the read-only connections,
+# replayed with EXPLAIN QUERY PLAN and timed, and for every table that is read completely an index is proposed.
+# An index is only proposed when SQLite actually uses it and no captured query gets slower with it, which is checked
+# by creating it in a transaction that is rolled back.
+
+# An index is rejected when a captured query is this much slower with it, smaller differences are timing noise
+SLOWER_TOLERANCE = 1.1
+
+EQUALITY_OPERATORS = {"=", "==", "IN", "IS"}
+RANGE_OPERATORS = {"<", ">", "<=", ">=", "BETWEEN", "LIKE"}
+KEYWORDS = {"WHERE", "ON", "JOIN", "INNER", "LEFT", "CROSS", "NATURAL", "GROUP", "ORDER", "LIMIT", "USING", "AS", "UNION", "HAVING"}
+
+IDENTIFIER = r'(?:\[[^\]]+\]|`[^`]+`|"[^"]+"|[A-Za-z_]\w*)'
+COLUMN = re.compile(rf"(?:([A-Za-z_]\w*)\.)?({IDENTIFIER})\s*(==|<=|>=|=|<|>|\bIN\b|\bIS\b|\bBETWEEN\b|\bLIKE\b)", re.IGNORECASE)
+JOINED_COLUMN = re.compile(rf"=\s*([A-Za-z_]\w*)\.({IDENTIFIER})")
+TABLE = re.compile(r"(?:\bFROM\b|\bJOIN\b|,)\s*([A-Za-z_]\w*)(?:\s+(?:AS\s+)?([A-Za-z_]\w*))?", re.IGNORECASE)
+CONDITIONS = re.compile(r"\b(?:WHERE|ON)\b(.*?)(?=\bGROUP\b|\bORDER\b|\bLIMIT\b|\bJOIN\b|\bWHERE\b|\bON\b|\bUNION\b|\bHAVING\b|;|$)", re.IGNORECASE | re.DOTALL)
+
+
+@contextmanager
+def capture(database_path=query_database.DATABASE_PATH):
+    """Collect every statement executed on the read-only connections: `with capture() as statements:`"""
+    manager = query_database.get_connection_manager(database_path)
+    manager.statement_log = statements = []
+    try:
+        yield statements
+    finally:
+        manager.statement_log = None
+
+
+def workload(connection):
+    """Run the queries of query_database and datasets the way the dashboard and partFour use them."""
+    cursor = connection.cursor()
+    startdate, enddate = query_database.date_ranges(cursor)
+    resolver = query_database.PopulationResolver(cursor)
+
+    query_database.Total_Cases_Per_Day_Global(connection, startdate, enddate)
+    for region in sorted(resolver.countries_per_region):
+        query_database.Total_Cases_Per_Day_Continental(connection, region, startdate, enddate)
+
+    cursor.execute("""
+    SELECT [WHO.Region], [Country.Region], MIN([Province.State]) FROM location
+    WHERE [Province.State] != '' GROUP BY [WHO.Region], [Country.Region] LIMIT 1;
+    """)
+    location = cursor.fetchone()
+    if location:
+        region, country, province = location
+        query_database.Total_Cases_Per_Day_Country(connection, region, country, startdate, enddate)
+        query_database.Total_Cases_Per_Day_Province(connection, region, country, province, startdate, enddate)
+
+    for metric in ("Confirmed", "Deaths"):
+        query_database.Top_US_Counties(connection, metric)
+        query_database.Top_US_States(connection, metric)
+
+    # Countries with the same name in both datasets and countries that have to be mapped
+    cursor.execute("SELECT [Country.Region] FROM country_wise ORDER BY [Country.Region];")
+    for (country,) in cursor.fetchall():
+        query_database.fetch_country_data(country, connection)
+
+    for name in datasets.VIEWS:
+        datasets.load(name, connection)
+
+
+def normalize(statement):
+    """The statement with its literals replaced by ?, statements that only differ in their values are one query."""
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"(?<![\w\]])-?\d+(?:\.\d+)?\b", "?", statement)
+    return " ".join(statement.split())
+
+
+def group_statements(statements):
+    """{normalized statement: {"calls", "example"}} of the SELECT statements, in the order they were first seen."""
+    groups = {}
+    for statement in statements:
+        if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            continue
+        group = groups.setdefault(normalize(statement), {"calls": 0, "example": statement})
+        group["calls"] += 1
+
+    return groups
+
+
+def unquote(identifier):
+    return identifier[1:-1] if identifier[0] in "[`\"" else identifier
+
+
+def schema(connection):
+    """{table: [columns]} of the tables in the database."""
+    tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+    return {table: [row[1] for row in connection.execute(f"PRAGMA table_info([{table}]);")] for table in tables}
+
+
+def statement_tables(statement, tables):
+    """{name used in the statement (alias or table): table} of the real tables the statement reads."""
+    names = {}
+    for table, alias in TABLE.findall(statement):
+        if table in tables:
+            names[table] = table
+            if alias and alias.upper() not in KEYWORDS:
+                names[alias] = table
+    return names
+
+
+def query_plan(connection, statement):
+    return [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + statement)]
+
+
+def full_scans(plan, names):
+    """Tables that are read completely, a scan of a covering index is fine because it reads no table rows.
+
+    An automatic index counts as well, SQLite builds it from a full scan every time the query runs.
+    """
+    scans = []
+    for detail in plan:
+        match = re.match(r"(?:SCAN (\w+)|SEARCH (\w+) USING AUTOMATIC)", detail)
+        name = match and (match.group(1) or match.group(2))
+        if name in names and (detail.startswith("SEARCH") or "COVERING INDEX" not in detail):
+            scans.append(names[name])
+    return scans
+
+
+def predicates(statement, names, tables):
+    """{table: (equality columns, range columns)} of the WHERE and ON conditions, in the order they appear."""
+    columns = {table: ([], []) for table in set(names.values())}
+
+    def add(alias, column, operator):
+        column = unquote(column)
+        if alias:
+            owners = [names[alias]] if alias in names else []
+        else:
+            owners = [table for table in columns if column in tables[table]]
+
+        for table in owners:
+            if column not in tables[table]:
+                continue
+            equality, ranges = columns[table]
+            target = equality if operator.upper() in EQUALITY_OPERATORS else ranges
+            if column not in equality and column not in ranges:
+                target.append(column)
+
+    for condition in CONDITIONS.findall(statement):
+        for alias, column, operator in COLUMN.findall(condition):
+            add(alias, column, operator)
+        # The other side of a join condition
+        for alias, column in JOINED_COLUMN.findall(condition):
+            add(alias, column, "=")
+
+    return columns
+
+
+def index_name(table, columns):
+    return "idx_" + re.sub(r"\W+", "_", "_".join([table] + columns)).strip("_").lower()
+
+
+def candidate_index(table, equality, ranges):
+    """Equality columns first and at most one range column, the order an index can be searched in."""
+    columns = equality + ranges[:1]
+    if not columns:
+        return None
+
+    quoted = ", ".join(f"[{column}]" for column in columns)
+    return {"table": table, "columns": columns, "name": index_name(table, columns), "sql": f"CREATE INDEX IF NOT EXISTS {index_name(table, columns)} ON [{table}] ({quoted});"}
+
+
+def time_statement(connection, statement, repeat):
+    """Best time of repeat runs, including reading all rows."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(statement).fetchall()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def measure(database_path, groups, repeat):
+    """Plan, full table scans and time of every captured query."""
+    connection = sqlite3.connect(f"file:{database_path}?mode=ro", uri=True)
+    try:
+        tables = schema(connection)
+        results = {}
+        for query, group in groups.items():
+            names = statement_tables(group["example"], tables)
+            plan = query_plan(connection, group["example"])
+            results[query] = {
+                "calls": group["calls"],
+                "plan": plan,
+                "full_scans": full_scans(plan, names),
+                "temp_b_tree": any("TEMP B-TREE" in detail for detail in plan),
+                "seconds": time_statement(connection, group["example"], repeat),
+            }
+        return results, tables
+    finally:
+        connection.close()
+
+
+def trial_indexes(database_path, indexes, groups, measured, repeat):
+    """Plan and time of every captured query whose plan changes with the indexes in place.
+
+    The indexes only exist in a transaction that is rolled back, the database is left as it was.
+    """
+    connection = sqlite3.connect(database_path, isolation_level=None, timeout=30)
+    try:
+        connection.execute("BEGIN;")
+        for index in indexes:
+            connection.execute(index["sql"])
+
+        changed = {}
+        for query, group in groups.items():
+            plan = query_plan(connection, group["example"])
+            if plan != measured[query]["plan"]:
+                changed[query] = {"plan": plan, "seconds": time_statement(connection, group["example"], repeat)}
+        return changed
+    finally:
+        connection.execute("ROLLBACK;")
+        connection.close()
+
+
+def slower_queries(measured, changed):
+    return [query for query, result in changed.items() if result["seconds"] > measured[query]["seconds"] * SLOWER_TOLERANCE]
+
+
+def advise(database_path, groups, measured, tables, repeat=5):
+    """Indexes that turn full table scans into index lookups. Only the ones SQLite really uses and that make no
+    captured query slower are kept. Returns the proposed and the rejected indexes."""
+    advice = {}
+    rejected = {}
+    trials = {}
+    for query, result in measured.items():
+        if not result["full_scans"]:
+            continue
+
+        example = groups[query]["example"]
+        names = statement_tables(example, tables)
+        columns = predicates(example, names, tables)
+
+        for table in result["full_scans"]:
+            index = candidate_index(table, *columns[table])
+            if index is None:
+                continue  # every row is needed, an index would not help
+
+            if index["name"] not in trials:
+                trials[index["name"]] = trial_indexes(database_path, [index], groups, measured, repeat)
+            changed = trials[index["name"]]
+            if index["name"] not in " ".join(changed.get(query, {}).get("plan", [])):
+                continue
+
+            slower = slower_queries(measured, changed)
+            if slower:
+                rejected[index["name"]] = dict(index, slower=slower)
+                continue
+
+            entry = advice.setdefault(index["name"], dict(index, queries=[]))
+            entry["queries"].append(query)
+
+    # An index can change the plans of the queries of another one, so the proposed indexes are tried together as well
+    advice = list(advice.values())
+    while advice:
+        changed = trial_indexes(database_path, advice, groups, measured, repeat)
+        slower = slower_queries(measured, changed)
+        if not slower:
+            break
+
+        plans = " ".join(" ".join(changed[query]["plan"]) for query in slower)
+        culprits = [index for index in advice if index["name"] in plans] or advice
+        for index in culprits:
+            rejected[index["name"]] = dict(index, slower=slower)
+        advice = [index for index in advice if index not in culprits]
+
+    return advice, list(rejected.values())
+
+
+def create_indexes(database_path, advice):
+    # No ANALYZE: the statistics it writes change the plans of queries the indexes were not tried with
+    connection = sqlite3.connect(database_path, timeout=30)
+    try:
+        for index in advice:
+            connection.execute(index["sql"])
+        connection.commit()
+    finally:
+        connection.close()
+
+    # The read-only connections have the old schema in their statement cache
+    query_database.get_connection_manager(database_path).close_all()
+
+
+def profile(statements, database_path=query_database.DATABASE_PATH, repeat=5, create=False):
+    """Profile captured statements, with create=True the proposed indexes are created and everything is measured again."""
+    groups = group_statements(statements)
+    before, tables = measure(database_path, groups, repeat)
+    advice, rejected = advise(database_path, groups, before, tables, repeat)
+
+    report = {
+        "database": database_path, "statements": len(statements), "queries": len(groups), "before": before,
+        "advice": advice, "rejected": rejected,
+    }
+    if create and advice:
+        create_indexes(database_path, advice)
+        report["after"], _ = measure(database_path, groups, repeat)
+
+    return report
+
+
+def shorten(query, width=100):
+    return query if len(query) <= width else query[:width - 3] + "..."
+
+
+def print_report(report):
+    print(f"{report['statements']} statements, {len(report['before'])} distinct queries on {report['database']}\n")
+
+    for query, result in sorted(report["before"].items(), key=lambda item: item[1]["seconds"] * item[1]["calls"], reverse=True):
+        flag = "  FULL SCAN: " + ", ".join(result["full_scans"]) if result["full_scans"] else ""
+        print(f"{result['calls']:5d} x {result['seconds'] * 1000:9.3f} ms  {shorten(query)}{flag}")
+        for detail in result["plan"]:
+            print(f"{'':22s}{detail}")
+
+    for index in report.get("rejected", []):
+        print(f"\nNot proposed, {len(index['slower'])} queries are slower with it: {index['sql']}")
+        for query in index["slower"]:
+            print(f"  {shorten(query)}")
+
+    if not report["advice"]:
+        if report.get("rejected"):
+            print("\nNo indexes to propose.")
+        else:
+            print("\nNo indexes to propose, no captured query reads a table completely that an index could avoid.")
+        return
+
+    print("\nProposed indexes:")
+    for index in report["advice"]:
+        print(f"  {index['sql']}  -- {len(index['queries'])} queries")
+
+    if "after" in report:
+        print("\nBefore and after creating them:")
+        for query, after in report["after"].items():
+            before = report["before"][query]
+            if before["plan"] == after["plan"]:
+                continue
+            speedup = before["seconds"] / after["seconds"] if after["seconds"] else float("inf")
+            flag = "  SLOWER" if after["seconds"] > before["seconds"] * SLOWER_TOLERANCE else ""
+            print(f"  {before['seconds'] * 1000:9.3f} ms -> {after['seconds'] * 1000:9.3f} ms ({speedup:5.1f}x)  {shorten(query)}{flag}")
+            print(f"{'':6s}{' / '.join(before['plan'])}\n{'':6s}-> {' / '.join(after['plan'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the SQL of query_database and propose indexes for full table scans.")
+    parser.add_argument("--database", default=query_database.DATABASE_PATH, help="Database to profile")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs of every query, the best is reported")
+    parser.add_argument("--create", action="store_true", help="Create the proposed indexes and measure again")
+    parser.add_argument("--output", help="Also write the report to this json file")
+    args = parser.parse_args()
+
+    if ingest.needs_ingest(args.database):
+        ingest.ingest_complete(args.database)
+    # Top_US_Counties and Top_US_States read the rollups, an update without new county rows changes nothing
+    ingest.update_county_rollups(args.database)
+
+    with capture(args.database) as statements:
+        workload(query_database.get_connection(args.database))
+
+    report = profile(statements, args.database, args.repeat, args.create)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
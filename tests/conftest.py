@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+# The scripts import each other as siblings, the same way they are run from the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Scripts"))
+
+import aggregation
+import map_payloads
+import partitions
+import query_database
+import reproduction
+
+# (WHO.Region, Country.Region, Province.State, first day with a row)
+LOCATIONS = [
+    ("Europe", "France", "", 0),
+    ("Europe", "France", "Reunion", 3),
+    ("Europe", "Germany", "", 0),
+    ("Europe", "Kosovo", "", 5),
+    ("Americas", "US", "", 0),
+    ("Western Pacific", "China", "Hubei", 0),
+    ("Western Pacific", "China", "Beijing", 2),
+]
+POPULATIONS = {"France": 65_000_000, "Germany": 83_000_000, "USA": 330_000_000}
+FIRST_DATE = "2020-03-01"
+
+
+def make_complete(days=30, seed=0):
+    """Cumulative counts in the layout of complete.csv, locations that start later have no rows before that."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(FIRST_DATE, periods=days).strftime("%Y-%m-%d")
+
+    frames = []
+    for region, country, province, first in LOCATIONS:
+        length = days - first
+        confirmed = np.cumsum(rng.integers(0, 500, length))
+        deaths = np.cumsum(rng.integers(0, 10, length))
+        recovered = np.minimum(np.cumsum(rng.integers(0, 200, length)), confirmed - deaths)
+        frames.append(pd.DataFrame({
+            "Province.State": province or np.nan,
+            "Country.Region": country,
+            "Lat": 1.0,
+            "Long": 2.0,
+            "Date": dates[first:],
+            "Confirmed": confirmed,
+            "Deaths": deaths,
+            "Recovered": recovered,
+            "Active": confirmed - deaths - recovered,
+            "WHO.Region": region,
+        }))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def create_workspace(path, complete):
+    """A repository root with complete.csv and a database with the worldometer populations."""
+    (path / "Data").mkdir(parents=True)
+    complete.to_csv(path / "Data" / "complete.csv", index=False)
+
+    connection = sqlite3.connect(path / "Data" / "covid_database.db")
+    pd.DataFrame({"Country.Region": list(POPULATIONS), "Population": list(POPULATIONS.values())}).to_sql("worldometer_data", connection, index=False)
+    connection.close()
+
+    return path
+
+
+def enter_workspace(path, monkeypatch):
+    """Run the scripts in path, the caches of the modules start empty and no connection of another workspace is reused."""
+    close_connections()
+    monkeypatch.chdir(path)
+    monkeypatch.setattr(aggregation, "_cube", None)
+    monkeypatch.setattr(map_payloads, "_payloads", None)
+    monkeypatch.setattr(partitions, "_store", None)
+    monkeypatch.setattr(reproduction, "_stores", {})
+    monkeypatch.setattr(query_database, "_connection_managers", {})
+
+
+def close_connections():
+    for manager in query_database._connection_managers.values():
+        manager.close_all()
+    query_database.clear_population_resolvers()
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """The scripts run in a repository root with a small complete.csv and database."""
+    enter_workspace(create_workspace(tmp_path / "repository", make_complete()), monkeypatch)
+    yield os.getcwd()
+    close_connections()
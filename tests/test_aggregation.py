@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+import aggregation
+import ingest
+import query_database
+from conftest import LOCATIONS
+
+START, END = "2020-03-04", "2020-03-25"
+
+SELECTIONS = [
+    (),
+    ("Europe",),
+    ("Western Pacific",),
+    ("Europe", "France"),
+    ("Americas", "US"),
+    ("Europe", "Kosovo"),
+    ("Western Pacific", "China"),
+    ("Europe", "France", "Reunion"),
+    ("Western Pacific", "China", "Beijing"),
+    ("Europe", "Atlantis"),
+]
+
+QUERIES = {
+    0: query_database.Total_Cases_Per_Day_Global,
+    1: query_database.Total_Cases_Per_Day_Continental,
+    2: query_database.Total_Cases_Per_Day_Country,
+    3: query_database.Total_Cases_Per_Day_Province,
+}
+
+
+@pytest.fixture
+def cube(workspace):
+    ingest.ingest_complete()
+    return aggregation.get_cube()
+
+
+@pytest.mark.parametrize("selection", SELECTIONS, ids=lambda selection: "/".join(selection) or "global")
+@pytest.mark.parametrize("window", [(START, END), ("2019-01-01", "2021-01-01")], ids=["window", "all"])
+def test_series_matches_sql(cube, selection, window):
+    with query_database.connection() as connection:
+        expected = QUERIES[len(selection)](connection, *selection, *window)
+
+    continent, country, province = selection + (None,) * (3 - len(selection))
+    result = cube.series(continent, country, province, *window).rename(columns={"Date": "date"})
+
+    assert len(result) > 0 or country == "Atlantis"
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_cube_locations(cube):
+    assert cube.date_range() == ("2020-03-01", "2020-03-30")
+    assert set(cube.country_index) == {(region, country) for region, country, _, _ in LOCATIONS}
+    assert set(cube.province_index) == {(region, country, province) for region, country, province, _ in LOCATIONS if province}
+    assert cube.select("Europe", "Atlantis") is None
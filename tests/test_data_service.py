@@ -0,0 +1,53 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import data_service
+import ingest
+import reproduction
+
+
+@pytest.fixture
+def service(workspace):
+    ingest.ingest_complete()
+
+
+@pytest.mark.parametrize("endpoint, query", [
+    ("/series", {"continent": "Nowhere"}),
+    ("/series", {"continent": "Europe", "country": "China"}),
+    ("/series", {"continent": "Europe", "country": "France", "province": "Hubei"}),
+    ("/reproduction", {"continent": "Nowhere"}),
+    ("/reproduction", {"continent": "Europe", "country": "Atlantis"}),
+])
+def test_unknown_location_is_not_found(service, endpoint, query):
+    with pytest.raises(LookupError):
+        data_service.ENDPOINTS[endpoint]["function"](**query)
+
+
+def test_series_of_a_known_location(service):
+    assert len(data_service.series(continent="Europe", country="France", province="Reunion")) == 27
+    # A location without rows in the window is still found
+    assert len(data_service.series(continent="Europe", country="France", start="2021-01-01")) == 0
+
+
+def test_top_counties_rejects_k(service):
+    for k in ("0", "-3", "five"):
+        with pytest.raises(ValueError, match="k must be a positive integer"):
+            data_service.top_counties(k=k)
+
+
+def test_reproduction_store_is_built_once(service, monkeypatch):
+    calls = []
+    cube_store = reproduction.cube_store
+
+    def slow_cube_store(*args):
+        calls.append(args)
+        time.sleep(0.05)  # long enough for every thread to ask before the first store is ready
+        return cube_store(*args)
+
+    monkeypatch.setattr(reproduction, "cube_store", slow_cube_store)
+
+    with ThreadPoolExecutor(8) as executor:
+        stores = list(executor.map(lambda _: reproduction.get_store("country"), range(32)))
+
+    assert len(calls) == 1
+    assert all(store is stores[0] for store in stores)
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+import figures
+
+
+def reference_lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets as published by Steinarsson, one point at a time."""
+    length = len(y)
+    every = (length - 2) / (threshold - 2)
+    keep = [0]
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, length)
+        average_x = np.mean(x[next_start:next_end])
+        average_y = np.mean(y[next_start:next_end])
+
+        best, best_area = None, -1.0
+        for position in range(int(bucket * every) + 1, int((bucket + 1) * every) + 1):
+            area = abs((x[previous] - average_x) * (y[position] - y[previous]) - (x[previous] - x[position]) * (average_y - y[previous]))
+            if area > best_area:
+                best, best_area = position, area
+        keep.append(best)
+        previous = best
+
+    keep.append(length - 1)
+    return np.array(keep)
+
+
+@pytest.mark.parametrize("length, threshold", [(100, 10), (1000, 97), (5003, 1000), (50, 49)])
+def test_lttb_matches_reference(length, threshold):
+    rng = np.random.default_rng(length)
+    x = np.sort(rng.uniform(0, 1000, length))
+    y = np.cumsum(rng.normal(size=length))
+
+    keep = figures.lttb(x, y, threshold)
+
+    np.testing.assert_array_equal(keep, reference_lttb(x, y, threshold))
+    assert len(keep) == threshold
+    assert keep[0] == 0 and keep[-1] == length - 1
+    assert np.all(np.diff(keep) > 0)
+
+
+def test_lttb_keeps_short_series_and_peaks():
+    assert np.array_equal(figures.lttb(np.arange(5), np.arange(5), 10), np.arange(5))
+
+    y = np.zeros(2000)
+    y[1234] = 50.0
+    assert 1234 in figures.lttb(np.arange(2000), y, 100)
+
+
+def test_downsample_dates():
+    dates = pd.date_range("2020-01-22", periods=3000).to_numpy()
+    line = {"x": dates, "y": np.sin(np.arange(3000) / 50.0), "label": "Active"}
+
+    result = figures.downsample(line, 500)
+
+    assert len(result["x"]) == len(result["y"]) == 500
+    assert result["x"][0] == dates[0] and result["x"][-1] == dates[-1]
+    assert result["label"] == "Active"
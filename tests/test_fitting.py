@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+import fitting
+
+
+def sir_trajectory(beta, gamma, days=60, population=1_000_000, infected=100.0):
+    """Infected and susceptible of the recurrence fit_sir assumes, computed day by day."""
+    susceptible = [population - infected]
+    trajectory = [infected]
+    for _ in range(days - 1):
+        new_infected = beta * susceptible[-1] * trajectory[-1] / population
+        trajectory.append(trajectory[-1] + new_infected - gamma * trajectory[-1])
+        susceptible.append(susceptible[-1] - new_infected)
+
+    return np.array(trajectory), np.array(susceptible), population
+
+
+@pytest.mark.parametrize("params", [(0.3, 0.1), (0.05, 0.2), (1.5, 0.7)])
+def test_gradient_matches_finite_differences(params):
+    rng = np.random.default_rng(1)
+    infected, susceptible, population = sir_trajectory(0.25, 0.12)
+    observed = infected * rng.uniform(0.9, 1.1, len(infected))
+    susceptible_share = susceptible / population
+    scale = np.sum(observed ** 2)
+
+    loss, gradient = fitting.loss_and_gradient(np.array(params), observed, observed[0], susceptible_share, scale)
+
+    step = 1e-6
+    numeric = []
+    for position in range(2):
+        shift = np.zeros(2)
+        shift[position] = step
+        upper, _ = fitting.loss_and_gradient(np.array(params) + shift, observed, observed[0], susceptible_share, scale)
+        lower, _ = fitting.loss_and_gradient(np.array(params) - shift, observed, observed[0], susceptible_share, scale)
+        numeric.append((upper - lower) / (2 * step))
+
+    assert np.isfinite(loss)
+    np.testing.assert_allclose(gradient, numeric, rtol=1e-5)
+
+
+def test_sensitivities_match_the_recurrence():
+    # The closed form is only used when no growth factor is zero, the loop is the recurrence itself
+    infected, susceptible, population = sir_trajectory(0.4, 0.1, days=30)
+    share = susceptible / population
+    predicted, factors = fitting.predict_infected(0.4, 0.1, infected[0], share)
+
+    d_beta, d_gamma = fitting.infected_sensitivities(predicted, factors, share)
+    expected_beta = np.zeros_like(predicted)
+    expected_gamma = np.zeros_like(predicted)
+    for t in range(1, len(predicted)):
+        expected_beta[t] = factors[t - 1] * expected_beta[t - 1] + predicted[t - 1] * share[t - 1]
+        expected_gamma[t] = factors[t - 1] * expected_gamma[t - 1] - predicted[t - 1]
+
+    np.testing.assert_allclose(predicted, infected, rtol=1e-9)
+    np.testing.assert_allclose(d_beta, expected_beta, rtol=1e-9)
+    np.testing.assert_allclose(d_gamma, expected_gamma, rtol=1e-9)
+
+
+def test_fit_recovers_the_parameters():
+    infected, susceptible, population = sir_trajectory(0.25, 0.12)
+
+    fit = fitting.fit_sir(infected, susceptible, population, starts=3)
+
+    assert fit["success"]
+    assert fit["beta"] == pytest.approx(0.25, rel=1e-3)
+    assert fit["gamma"] == pytest.approx(0.12, rel=1e-3)
+    assert fit["r2"] > 0.999
+
+
+def test_fit_without_infected_is_not_a_success():
+    infected, susceptible, population = sir_trajectory(0.25, 0.12)
+    infected[0] = 0
+
+    fit = fitting.fit_sir(infected, susceptible, population)
+
+    assert not fit["success"]
+    assert fit["message"].startswith("No infected at the start of the window")
+
+
+def test_fit_that_does_not_explain_the_data_is_not_a_success():
+    # Exponential growth over a long span overflows from the initial guess, a rise and fall can not be fitted
+    # with S close to N
+    days = np.arange(180)
+    observed = 1e5 * np.exp(-((days - 90) / 30.0) ** 2) + 10
+    population = 1e9
+
+    fit = fitting.fit_sir(observed, np.full(len(days), population - 1e6), population)
+
+    assert fit["r2"] <= 0 or not np.isfinite(fit["r2"])
+    assert not fit["success"]
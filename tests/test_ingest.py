@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+import aggregation
+import ingest
+import map_payloads
+import query_database
+import snapshot
+from conftest import create_workspace, enter_workspace, make_complete
+
+LAST_DATE = "2020-03-30"
+
+
+def make_deltas(complete):
+    """Corrections of earlier days, new days, a new location, a day before the first date and a key twice in one file."""
+    rng = np.random.default_rng(4)
+    last = complete[complete["Date"] == LAST_DATE]
+
+    deltas = []
+    for number in range(5):
+        corrections = complete.sample(6, random_state=number).copy()
+        corrections[["Confirmed", "Active"]] += rng.integers(1, 100, (len(corrections), 2))
+
+        new_day = last.copy()
+        new_day["Date"] = str((pd.Timestamp(LAST_DATE) + pd.Timedelta(days=number + 1)).date())
+        new_day["Active"] += number + 1
+        deltas.append(pd.concat([corrections, new_day], ignore_index=True))
+
+    extra = deltas[2].iloc[:3].copy()
+    extra["Province.State"] = "Bavaria"
+    extra["Country.Region"] = "Germany"
+    extra["WHO.Region"] = "Europe"
+    early = deltas[2].iloc[:1].copy()
+    early["Date"] = "2020-02-27"
+    twice = deltas[2].iloc[-1:].copy()
+    twice["Deaths"] += 1000
+    deltas[2] = pd.concat([deltas[2], extra, early, twice], ignore_index=True)
+
+    return deltas
+
+
+def locations(complete):
+    keys = complete[["WHO.Region", "Country.Region", "Province.State"]].fillna("").drop_duplicates()
+    return [tuple(key) for key in keys.itertuples(index=False)]
+
+
+def current_state(keys):
+    """Everything that is derived from complete.csv and its deltas, in a form that does not depend on how it was built."""
+    df = snapshot.load_complete(categorical=False)
+    df["Province.State"] = df["Province.State"].fillna("")
+    df = df.sort_values(snapshot.KEY_COLUMNS).reset_index(drop=True)[snapshot.KEY_COLUMNS + snapshot.COUNT_COLUMNS]
+
+    cube = aggregation.get_cube()
+    series, frames = {}, {}
+    with query_database.connection() as connection:
+        for region, country, province in keys:
+            series[(region, country, province)] = cube.series(region, country, province or None)
+            if province:
+                frames[(region, country, province)] = query_database.Total_Cases_Per_Day_Province(connection, region, country, province, "2020-01-01", "2020-12-31")
+            else:
+                frames[(region, country)] = query_database.Total_Cases_Per_Day_Country(connection, region, country, "2020-01-01", "2020-12-31")
+        for region in sorted({region for region, _, _ in keys}):
+            series[region] = cube.series(region)
+            frames[region] = query_database.Total_Cases_Per_Day_Continental(connection, region, "2020-01-01", "2020-12-31")
+        series["global"] = cube.series()
+        frames["global"] = query_database.Total_Cases_Per_Day_Global(connection, "2020-01-01", "2020-12-31")
+
+    payloads = map_payloads.get_payloads()
+    return {
+        "complete": df,
+        "series": series,
+        "frames": frames,
+        "payloads": (list(payloads.countries), payloads.regions, payloads.dates, np.asarray(payloads.active)),
+    }
+
+
+def test_append_matches_full_rebuild(workspace, tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "COMPACT_DELTAS", 3)
+    complete = make_complete()
+    ingest.ingest_complete()
+    map_payloads.ensure_payloads()
+
+    deltas = make_deltas(complete)
+    paths = []
+    for number, delta in enumerate(deltas):
+        path = str(tmp_path / f"delta-{number}.csv")
+        delta.to_csv(path, index=False)
+        paths.append(path)
+
+    ingest.append_deltas(paths[:2])
+    assert ingest.append_deltas(paths[:1]) == 0  # appended before
+    ingest.append_deltas(paths[2:])
+
+    manifest = snapshot.read_manifest("complete")
+    assert manifest.get("compacted")
+    assert len(manifest.get("deltas", [])) == 2
+
+    everything = pd.concat([complete] + deltas, ignore_index=True).drop_duplicates(snapshot.KEY_COLUMNS, keep="last")
+    keys = locations(everything)
+    assert ("Europe", "Germany", "Bavaria") in keys
+    appended = current_state(keys)
+
+    enter_workspace(create_workspace(tmp_path / "rebuilt", everything), monkeypatch)
+    ingest.ingest_complete()
+    rebuilt = current_state(keys)
+
+    pd.testing.assert_frame_equal(appended["complete"], rebuilt["complete"], check_dtype=False)
+    for key in rebuilt["series"]:
+        pd.testing.assert_frame_equal(appended["series"][key], rebuilt["series"][key], check_dtype=False, obj=str(key))
+    for key in rebuilt["frames"]:
+        pd.testing.assert_frame_equal(appended["frames"][key], rebuilt["frames"][key], check_dtype=False, obj=str(key))
+
+    countries, regions, dates, active = appended["payloads"]
+    assert countries == rebuilt["payloads"][0]
+    assert regions == rebuilt["payloads"][1]
+    np.testing.assert_array_equal(dates, rebuilt["payloads"][2])
+    np.testing.assert_array_equal(active, rebuilt["payloads"][3])
+
+
+def test_append_rejects_invalid_delta(workspace, tmp_path):
+    ingest.ingest_complete()
+    path = str(tmp_path / "invalid.csv")
+    make_complete().drop(columns="WHO.Region").to_csv(path, index=False)
+
+    with pytest.raises(ValueError, match="missing columns WHO.Region"):
+        ingest.append_deltas([path])
+
+    assert not snapshot.read_manifest("complete").get("deltas")
@@ -0,0 +1,28 @@
+import json
+import instrumentation
+
+
+@instrumentation.timed()
+def step():
+    with instrumentation.span("inner"):
+        return [1, 2, 3]
+
+
+def test_spans_outside_a_run_are_not_kept(tmp_path, monkeypatch):
+    trace = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(instrumentation, "TRACE_PATH", str(trace))
+    monkeypatch.setattr(instrumentation, "_active", True)
+    monkeypatch.setattr(instrumentation._local, "enabled", True)
+
+    for _ in range(100):
+        step()
+
+    assert instrumentation._local.records == []
+    assert instrumentation._local.run is None
+    records = [json.loads(line) for line in trace.read_text().splitlines()]
+    assert len(records) == 200
+    assert len({record["run"] for record in records}) == 100
+
+    instrumentation.start_run(True)
+    step()
+    assert [record["name"] for record in instrumentation.finish_run()] == ["inner", "step"]
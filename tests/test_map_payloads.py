@@ -0,0 +1,18 @@
+import ingest
+import map_payloads
+from conftest import make_complete
+
+
+def test_negative_active_is_reported(workspace):
+    complete = make_complete()
+    corrected = (complete["Country.Region"] == "Germany") & (complete["Date"] == "2020-03-10")
+    complete.loc[corrected, "Active"] = -1
+    complete.to_csv("Data/complete.csv", index=False)
+    ingest.ingest_complete()
+
+    frame = map_payloads.get_payloads().frame("Europe", "2020-03-10").set_index("Country.Region")
+
+    assert frame.loc["Germany", "Active"] == -1
+    # Kosovo has no report before its sixth day
+    assert "Kosovo" not in map_payloads.get_payloads().frame("Europe", "2020-03-01")["Country.Region"].tolist()
+    assert "Kosovo" in frame.index
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+import aggregation
+import ingest
+import partitions
+import reproduction
+
+
+@pytest.fixture
+def store(workspace):
+    ingest.ingest_complete()
+    partitions.build_partitions("Data/complete.csv", "Data/partitions")
+    return partitions.PartitionedStore("Data/partitions")
+
+
+@pytest.mark.parametrize("selection", [(), ("Europe",), ("Europe", "France"), ("Western Pacific", "China", "Hubei")])
+@pytest.mark.parametrize("window", [(None, None), ("2020-03-04", "2020-03-25"), ("2020-03-25", "2020-03-04"), ("2021-01-01", None)])
+def test_series_matches_cube(store, selection, window):
+    continent, country, province = selection + (None,) * (3 - len(selection))
+
+    expected = aggregation.get_cube().series(continent, country, province, *window)
+    result = store.series(continent, country, province, *window)
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("level", ["country", "region"])
+def test_reproduction_store_matches_cube(store, level):
+    expected = reproduction.get_store(level)
+    result = store.get_reproduction_store(level)
+
+    assert result.keys == expected.keys
+    np.testing.assert_array_equal(result.offsets, expected.offsets)
+    np.testing.assert_array_equal(result.dates, expected.dates)
+    for name, values in expected.columns.items():
+        np.testing.assert_allclose(result.columns[name], values, equal_nan=True)
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+import reproduction
+
+
+@pytest.fixture
+def frame():
+    """Shuffled rows of several locations with different lengths and missing values, one location has one row."""
+    rng = np.random.default_rng(2)
+    rows = []
+    for country, days in (("A", 12), ("B", 1), ("C", 9), ("D", 15)):
+        for day in range(days):
+            rows.append((country, "" if country != "D" else f"P{day % 2}", day, rng.normal(100, 30)))
+
+    df = pd.DataFrame(rows, columns=["country", "province", "day", "value"])
+    df.loc[rng.random(len(df)) < 0.25, "value"] = np.nan
+    return df.sample(frac=1, random_state=3).reset_index(drop=True)
+
+
+def expected(df, operation):
+    """The pandas groupby version of an operation, on the rows in the order of sort_by_location."""
+    grouped = df.groupby(["country", "province"], sort=False)["value"]
+    return operation(grouped).to_numpy()
+
+
+def test_sort_by_location(frame):
+    df, starts = reproduction.sort_by_location(frame, ["country", "province"], "day")
+
+    assert (df.groupby(["country", "province"])["day"].diff().dropna() > 0).all()
+    assert starts.sum() == frame.groupby(["country", "province"]).ngroups
+    np.testing.assert_array_equal(starts, df[["country", "province"]].ne(df[["country", "province"]].shift()).any(axis=1))
+
+
+def test_grouped_diff(frame):
+    df, starts = reproduction.sort_by_location(frame, ["country", "province"], "day")
+
+    np.testing.assert_allclose(reproduction.grouped_diff(df["value"], starts), expected(df, lambda grouped: grouped.diff()), equal_nan=True)
+
+
+def test_grouped_ffill(frame):
+    df, starts = reproduction.sort_by_location(frame, ["country", "province"], "day")
+
+    np.testing.assert_allclose(reproduction.grouped_ffill(df["value"], starts), expected(df, lambda grouped: grouped.ffill()), equal_nan=True)
+
+
+@pytest.mark.parametrize("window, min_periods", [(7, 1), (3, 2), (1, 1)])
+def test_grouped_rolling_mean(frame, window, min_periods):
+    df, starts = reproduction.sort_by_location(frame, ["country", "province"], "day")
+
+    result = reproduction.grouped_rolling_mean(df["value"], starts, window, min_periods)
+    reference = expected(df, lambda grouped: grouped.rolling(window, min_periods=min_periods).mean().reset_index(level=[0, 1], drop=True).sort_index())
+
+    np.testing.assert_allclose(result, reference, equal_nan=True)
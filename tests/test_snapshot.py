@@ -0,0 +1,23 @@
+import os
+import stat
+import sys
+import pytest
+import ingest
+import map_payloads
+import snapshot
+from conftest import make_complete
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX permissions")
+def test_published_files_are_readable_by_everyone(workspace, tmp_path):
+    ingest.ingest_complete()
+    delta = make_complete().tail(5)
+    delta.to_csv(tmp_path / "delta.csv", index=False)
+    ingest.append_deltas([str(tmp_path / "delta.csv")])
+    map_payloads.ensure_payloads()
+
+    for root, directories, files in os.walk(snapshot.SNAPSHOT_DIRECTORY):
+        for name in directories:
+            assert stat.S_IMODE(os.stat(os.path.join(root, name)).st_mode) & 0o055 == 0o055, os.path.join(root, name)
+        for name in files:
+            assert stat.S_IMODE(os.stat(os.path.join(root, name)).st_mode) & 0o044 == 0o044, os.path.join(root, name)